@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn.conf.py
+- preload_app: import module 1 lần ở master, worker fork ra dùng chung (copy-on-write)
+- post_fork: mỗi worker tự mở Sheets / PG_POOL / Redis (không dùng chung socket)
+
+Lưu ý: PENDING_VOUCHER, CALLBACK_COOLDOWN, qr_sessions nằm trong RAM từng process.
+Chạy nhiều worker với UPDATE_INGEST_MODE=thread thì BUY và cookie có thể rơi vào 2 worker khác nhau
+→ mặc định chỉ dùng nhiều worker khi UPDATE_INGEST_MODE=stream (web chỉ XADD, consumer riêng xử lý).
+"""
+
+import os
+
+# Đặt TRƯỚC khi gunicorn import app → module không init lúc preload
+os.environ.setdefault("BOT_DEFER_INIT", "1")
+
+_STREAM_MODE = os.getenv("UPDATE_INGEST_MODE", "thread").strip().lower() == "stream"
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "4" if _STREAM_MODE else "1"))
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+# Đủ thời gian cho bot.shutdown() drain lane + ghi checkpoint
+graceful_timeout = int(os.getenv("SHUTDOWN_GRACE_SECONDS", "20")) + 10
+
+
+def post_fork(server, worker):
+    import telegram_bot_pg_redis as bot
+    bot.init_runtime()
+
+
+def worker_exit(server, worker):
+    import telegram_bot_pg_redis as bot
+    bot.shutdown("gunicorn worker exit")
@@ -3,95 +3,532 @@
 import_wallet_to_postgres.py
 Import tab "Thanh Toan" (wallet) từ Excel/CSV vào PostgreSQL (Railway)
 
+Luồng: đọc stream từng dòng → COPY vào bảng tạm (staging) → 1 câu upsert set-based vào wallet.
+Không load cả file vào RAM → chạy được với file lớn hơn bộ nhớ.
+
 Usage:
-  pip install pandas psycopg2-binary openpyxl
+  pip install psycopg2-binary openpyxl
 
   # import từ CSV
   python import_wallet_to_postgres.py --csv wallet_import.csv
 
   # import trực tiếp từ Excel
   python import_wallet_to_postgres.py --xlsx Shopee.xlsx --sheet "Thanh Toan"
+
+  # sync định kỳ: chỉ ghi dòng thật sự đổi, không đè ví bot đã cập nhật sau lúc export
+  python import_wallet_to_postgres.py --csv wallet_import.csv --diff --keep-newer --dry-run
+
+  # migrate lớn: chia partition theo tele_id, 4 connection song song, commit mỗi 20k dòng
+  python import_wallet_to_postgres.py --csv wallet_full.csv --workers 4 --chunk-rows 20000
+  # bị ngắt giữa chừng → chạy lại y hệt lệnh cũ + --resume (bỏ qua chunk đã commit)
+  python import_wallet_to_postgres.py --csv wallet_full.csv --workers 4 --chunk-rows 20000 --resume
 """
 
-import os, sys, argparse
-import pandas as pd
+import os, sys, csv, io, json, time, queue, argparse, threading
+from datetime import datetime, timezone
 import psycopg2
 
-def load_df(args):
-    if args.csv:
-        df = pd.read_csv(args.csv)
-    else:
-        df = pd.read_excel(args.xlsx, sheet_name=args.sheet)
+COLUMNS = ("tele_id", "username", "balance", "status", "notes", "gift")
+
+# =========================================================
+# 📥 ĐỌC NGUỒN (stream, không pandas)
+# =========================================================
+def _iter_csv(path):
+    # utf-8-sig: file export từ Excel/Sheet hay có BOM ở header
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for rec in csv.DictReader(f):
+            yield rec
+
+def _iter_xlsx(path, sheet):
+    from openpyxl import load_workbook
+
+    # read_only → openpyxl đọc lazy từng dòng, không dựng cả workbook trong RAM
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb[sheet].iter_rows(values_only=True)
+        header = [str(h or "").strip() for h in next(rows, ())]
+        for values in rows:
+            yield dict(zip(header, values))
+    finally:
+        wb.close()
+
+def _to_int(v, default=None):
+    try:
+        return int(round(float(str(v).strip())))
+    except (TypeError, ValueError):
+        return default
+
+def _to_text(v, default=""):
+    if v is None:
+        return default
+    s = str(v)
+    return s if s.strip() else default
+
+def normalize(rec):
+    """Chuẩn hoá 1 dòng nguồn → tuple COLUMNS; None nếu thiếu tele_id"""
+    tele_id = _to_int(rec.get("tele_id"))
+    if tele_id is None:
+        return None
+    return (
+        tele_id,
+        _to_text(rec.get("username")),
+        _to_int(rec.get("balance"), 0),
+        _to_text(rec.get("status"), "active"),
+        _to_text(rec.get("notes")),
+        _to_text(rec.get("gift")),
+    )
+
+def iter_rows(args, stats):
+    source = _iter_csv(args.csv) if args.csv else _iter_xlsx(args.xlsx, args.sheet)
+    for rec in source:
+        stats["read"] += 1
+        row = normalize(rec)
+        if row is None:
+            stats["skipped"] += 1
+            continue
+        yield row
+
+# =========================================================
+# 🚚 COPY STREAM
+# =========================================================
+class CopyStream(io.RawIOBase):
+    """File-like cho copy_expert: encode CSV theo từng lô nhỏ từ (seq,) + row"""
+
+    def __init__(self, rows, lines_per_chunk=2000):
+        self._rows = rows
+        self._lines = lines_per_chunk
+        self._buf = b""
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        out = io.StringIO()
+        w = csv.writer(out, lineterminator="\n")
+        n = 0
+        for row in self._rows:
+            self.count += 1
+            w.writerow(row)
+            n += 1
+            if n >= self._lines:
+                break
+        return out.getvalue().encode("utf-8")
+
+    def readinto(self, b):
+        while not self._buf:
+            chunk = self._fill()
+            if not chunk:
+                return 0
+            self._buf = chunk
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+# =========================================================
+# 🗄️ SQL
+# =========================================================
+SQL_CREATE_WALLET = """
+CREATE TABLE IF NOT EXISTS wallet (
+    tele_id BIGINT PRIMARY KEY,
+    username TEXT,
+    balance BIGINT NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'active',
+    notes TEXT,
+    gift TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+SQL_CREATE_STAGE = """
+CREATE TEMP TABLE wallet_stage (
+    seq BIGINT,
+    tele_id BIGINT,
+    username TEXT,
+    balance BIGINT,
+    status TEXT,
+    notes TEXT,
+    gift TEXT
+) ON COMMIT DROP;
+"""
+
+# FORCE_NOT_NULL: ô trống → '' (giữ đúng như bản import cũ, không thành NULL)
+SQL_COPY_STAGE = (
+    "COPY wallet_stage (seq, tele_id, username, balance, status, notes, gift) FROM STDIN "
+    "WITH (FORMAT csv, FORCE_NOT_NULL (username, status, notes, gift))"
+)
+
+# Hash 1 dòng ví (NULL ≡ ''), dùng chung cho nguồn và DB → so sánh nội dung không cần đọc từng cột
+def _row_hash_sql(t):
+    return (
+        f"md5(concat_ws(chr(31), COALESCE({t}.username, ''), {t}.balance::text, "
+        f"COALESCE({t}.status, ''), COALESCE({t}.notes, ''), COALESCE({t}.gift, '')))"
+    )
+
+# Phân loại từng tele_id nguồn so với DB:
+# - new:     chưa có trong wallet
+# - same:    hash trùng → bỏ qua, không đụng updated_at
+# - newer:   DB đã đổi sau thời điểm export (chỉ khi --keep-newer)
+#            dòng do chính lượt import này ghi (updated_at = run_at, chunk trước cùng tele_id)
+#            KHÔNG tính là newer → dòng nguồn sau vẫn thắng dù nằm ở chunk sau
+# - changed: cần ghi
+SQL_CLASSIFY = f"""
+CREATE TEMP TABLE wallet_diff ON COMMIT DROP AS
+SELECT s.tele_id, s.username, s.balance, s.status, s.notes, s.gift,
+       w.balance AS old_balance,
+       CASE
+           WHEN w.tele_id IS NULL THEN 'new'
+           WHEN {_row_hash_sql('s')} = {_row_hash_sql('w')} THEN 'same'
+           WHEN %(cutoff)s::timestamptz IS NOT NULL AND w.updated_at > %(cutoff)s::timestamptz
+                AND w.updated_at <> %(run_at)s::timestamptz THEN 'newer'
+           ELSE 'changed'
+       END AS action
+FROM (
+    SELECT DISTINCT ON (tele_id) tele_id, username, balance, status, notes, gift
+    FROM wallet_stage
+    ORDER BY tele_id, seq DESC
+) s
+LEFT JOIN wallet w ON w.tele_id = s.tele_id;
+"""
+
+SQL_DIFF_SUMMARY = "SELECT action, COUNT(*) FROM wallet_diff GROUP BY action"
+
+SQL_DIFF_SAMPLE = """
+SELECT tele_id, action, old_balance, balance
+FROM wallet_diff
+WHERE action IN ('new', 'changed', 'newer')
+ORDER BY ABS(balance - COALESCE(old_balance, 0)) DESC, tele_id
+LIMIT %s
+"""
+
+# xmax = 0 → dòng vừa INSERT; khác 0 → dòng đi qua nhánh UPDATE
+# WHERE ở nhánh UPDATE: chặn luôn trường hợp bot ghi ví giữa lúc phân loại và lúc merge
+# updated_at = run_at (cố định cả lượt, giữ qua --resume) → nhận ra dòng do lượt này ghi
+SQL_MERGE = """
+WITH up AS (
+    INSERT INTO wallet (tele_id, username, balance, status, notes, gift, updated_at)
+    SELECT tele_id, username, balance, status, notes, gift, %(run_at)s::timestamptz
+    FROM wallet_diff
+    WHERE action = ANY(%(actions)s)
+    ON CONFLICT (tele_id) DO UPDATE
+    SET username=EXCLUDED.username,
+        balance=EXCLUDED.balance,
+        status=EXCLUDED.status,
+        notes=EXCLUDED.notes,
+        gift=EXCLUDED.gift,
+        updated_at=EXCLUDED.updated_at
+    WHERE %(cutoff)s::timestamptz IS NULL OR wallet.updated_at <= %(cutoff)s::timestamptz
+       OR wallet.updated_at = %(run_at)s::timestamptz
+    RETURNING (xmax = 0) AS inserted
+)
+SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM up;
+"""
+
+# =========================================================
+# 🧩 CHUNK + CHECKPOINT
+# =========================================================
+def partition_of(tele_id, partitions):
+    # Cùng tele_id luôn về cùng partition → 2 connection không bao giờ ghi cùng 1 dòng
+    return tele_id % partitions
+
+def iter_chunks(rows, partitions, chunk_rows):
+    """
+    Chia stream thành chunk (partition, số thứ tự chunk, rows) theo tele_id.
+    Ranh giới chunk chỉ phụ thuộc nguồn + partitions + chunk_rows → resume xác định được.
+    """
+    buffers = [[] for _ in range(partitions)]
+    counters = [0] * partitions
+    # seq = thứ tự dòng nguồn → trùng tele_id thì dòng sau thắng (giống bản cũ)
+    for seq, row in enumerate(rows, 1):
+        p = partition_of(row[0], partitions)
+        buffers[p].append((seq,) + tuple(row))
+        if len(buffers[p]) >= chunk_rows:
+            yield p, counters[p], buffers[p]
+            counters[p] += 1
+            buffers[p] = []
+    for p, buf in enumerate(buffers):
+        if buf:
+            yield p, counters[p], buf
+
+class Checkpoint:
+    """File JSON ghi các chunk đã commit; ghi atomic (tmp + replace)"""
+
+    def __init__(self, path, signature, resume, run_at):
+        self.path = path
+        self.signature = signature
+        self.done = set()
+        self.run_at = run_at
+        self._lock = threading.Lock()
+        if resume and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("signature") != signature:
+                raise SystemExit(
+                    f"❌ Checkpoint {path} không khớp nguồn / tham số hiện tại "
+                    "(--workers, --chunk-rows, --diff, --keep-newer, --export-at). "
+                    "Xoá file hoặc chạy lại đúng tham số cũ."
+                )
+            self.done = set(data.get("done", []))
+            # Resume = cùng 1 lượt import → giữ run_at cũ (dòng chunk đã commit không bị coi là newer)
+            if data.get("run_at"):
+                self.run_at = datetime.fromisoformat(data["run_at"])
+
+    def mark(self, chunk_id):
+        with self._lock:
+            self.done.add(chunk_id)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({
+                    "signature": self.signature,
+                    "run_at": self.run_at.isoformat(),
+                    "done": sorted(self.done),
+                }, f)
+            os.replace(tmp, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def _source_signature(args):
+    path = args.csv or args.xlsx
+    st = os.stat(path)
+    return {
+        "source": os.path.abspath(path),
+        "sheet": None if args.csv else args.sheet,
+        "size": st.st_size,
+        "mtime": int(st.st_mtime),
+        "workers": args.workers,
+        "chunk_rows": args.chunk_rows,
+        # Đổi chế độ ghi giữa chừng → chunk đã commit và chunk còn lại theo 2 luật khác nhau
+        "diff": args.diff,
+        "keep_newer": args.keep_newer,
+        "export_at": args.export_at,
+    }
+
+# =========================================================
+# ▶️ MAIN
+# =========================================================
+PHASES = ("copy", "diff", "merge", "commit")
+
+def load_chunk(conn, rows, args, cutoff, actions, run_at):
+    """1 chunk = 1 transaction: COPY staging → diff → merge → commit"""
+    t0 = time.time()
+    timings = {}
+    cur = conn.cursor()
+    try:
+        cur.execute(SQL_CREATE_STAGE)
+        cur.copy_expert(SQL_COPY_STAGE, io.BufferedReader(CopyStream(iter(rows)), buffer_size=1 << 16))
+        t0 = _phase(timings, "copy", t0)
+
+        cur.execute(SQL_CLASSIFY, {"cutoff": cutoff, "run_at": run_at})
+        cur.execute(SQL_DIFF_SUMMARY)
+        summary = dict(cur.fetchall())
+        sample = []
+        if args.dry_run and args.show > 0:
+            cur.execute(SQL_DIFF_SAMPLE, (args.show,))
+            sample = cur.fetchall()
+        t0 = _phase(timings, "diff", t0)
+
+        inserted = updated = 0
+        if args.dry_run:
+            conn.rollback()
+        else:
+            cur.execute(SQL_MERGE, {"actions": actions, "cutoff": cutoff, "run_at": run_at})
+            inserted, updated = cur.fetchone()
+            t0 = _phase(timings, "merge", t0)
 
-    df["tele_id"] = pd.to_numeric(df.get("tele_id"), errors="coerce")
-    df = df[df["tele_id"].notna()].copy()
-    df["tele_id"] = df["tele_id"].astype("int64")
+            conn.commit()
+            _phase(timings, "commit", t0)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return {"summary": summary, "sample": sample, "inserted": inserted, "updated": updated, "timings": timings}
 
-    df["username"] = df.get("username", "").fillna("").astype(str)
-    df["balance"] = pd.to_numeric(df.get("balance", 0), errors="coerce").fillna(0).astype(float).round(0).astype("int64")
-    df["status"] = df.get("status", "active").fillna("active").astype(str)
-    df["notes"] = df.get("notes", "").fillna("").astype(str)
-    df["gift"] = df.get("gift", "").fillna("").astype(str)
+def _phase(timings, name, t0):
+    timings[name] = time.time() - t0
+    return time.time()
 
-    return df[["tele_id", "username", "balance", "status", "notes", "gift"]]
+def _export_cutoff(args):
+    """Mốc export: --export-at nếu có, không thì mtime của file nguồn"""
+    if not args.keep_newer:
+        return None
+    if args.export_at:
+        ts = datetime.fromisoformat(args.export_at)
+        return ts if ts.tzinfo else ts.astimezone()
+    path = args.csv or args.xlsx
+    return datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+
+def _print_diff(summary, sample):
+    print("📋 Diff so với DB:")
+    for action in ("new", "changed", "same", "newer"):
+        print(f"   {action:<8} {summary.get(action, 0):>8}")
+    if sample:
+        print("   Top thay đổi số dư:")
+        for tele_id, action, old_balance, balance in sample:
+            old = "-" if old_balance is None else f"{old_balance:,}"
+            print(f"   {tele_id:>14} {action:<8} {old:>12} → {balance:,}")
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--csv", help="CSV wallet export")
     ap.add_argument("--xlsx", help="Excel file (.xlsx)")
     ap.add_argument("--sheet", default="Thanh Toan", help="Tên sheet trong Excel")
+    ap.add_argument("--diff", action="store_true", help="Chỉ ghi dòng mới/thay đổi (so hash với DB)")
+    ap.add_argument("--keep-newer", action="store_true",
+                    help="Không đè dòng có updated_at mới hơn thời điểm export")
+    ap.add_argument("--export-at", help="Thời điểm export (ISO), mặc định = mtime file nguồn")
+    ap.add_argument("--dry-run", action="store_true", help="Chỉ in diff, không ghi DB")
+    ap.add_argument("--show", type=int, default=20, help="Số dòng mẫu in trong diff")
+    ap.add_argument("--workers", type=int, default=int(os.getenv("IMPORT_WORKERS", "1")),
+                    help="Số connection song song (= số partition tele_id)")
+    ap.add_argument("--chunk-rows", type=int, default=int(os.getenv("IMPORT_CHUNK_ROWS", "50000")),
+                    help="Số dòng tối đa mỗi transaction")
+    ap.add_argument("--checkpoint", default=".wallet_import.ckpt.json", help="File checkpoint để resume")
+    ap.add_argument("--resume", action="store_true", help="Bỏ qua các chunk đã commit trong checkpoint")
     args = ap.parse_args()
 
     if not args.csv and not args.xlsx:
         ap.error("Bạn phải nhập --csv hoặc --xlsx")
+    if args.export_at and not args.keep_newer:
+        ap.error("--export-at chỉ dùng kèm --keep-newer")
+    if args.workers < 1 or args.chunk_rows < 1:
+        ap.error("--workers và --chunk-rows phải >= 1")
 
     dsn = os.getenv("DATABASE_URL", "").strip()
     if not dsn:
         print("❌ Thiếu DATABASE_URL env")
         sys.exit(1)
 
-    df = load_df(args)
-    print(f"✅ Loaded {len(df)} wallet rows")
+    cutoff = _export_cutoff(args)
+    # full: ghi mọi dòng (trừ 'newer'); diff: chỉ dòng mới/đổi → chi phí tỉ lệ với số thay đổi
+    actions = ["new", "changed"] if args.diff else ["new", "changed", "same"]
+    stats = {"read": 0, "skipped": 0, "staged": 0, "chunks": 0, "resumed": 0}
+    summary = {}
+    sample = []
+    timings = {}
+    inserted = updated = 0
+    t_start = time.time()
+
+    # Dry-run không ghi gì → không đụng checkpoint
+    run_at = datetime.now(timezone.utc)
+    ckpt = None if args.dry_run else Checkpoint(args.checkpoint, _source_signature(args), args.resume, run_at)
+    if ckpt is not None:
+        run_at = ckpt.run_at
 
     conn = psycopg2.connect(dsn)
-    conn.autocommit = False
-    cur = conn.cursor()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SQL_CREATE_WALLET)
+        conn.commit()
+    finally:
+        conn.close()
+    _phase(timings, "prepare", t_start)
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS wallet (
-        tele_id BIGINT PRIMARY KEY,
-        username TEXT,
-        balance BIGINT NOT NULL DEFAULT 0,
-        status TEXT NOT NULL DEFAULT 'active',
-        notes TEXT,
-        gift TEXT,
-        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-    );
-    """)
-    conn.commit()
-
-    sql = """
-    INSERT INTO wallet (tele_id, username, balance, status, notes, gift, updated_at)
-    VALUES (%s,%s,%s,%s,%s,%s, NOW())
-    ON CONFLICT (tele_id) DO UPDATE
-    SET username=EXCLUDED.username,
-        balance=EXCLUDED.balance,
-        status=EXCLUDED.status,
-        notes=EXCLUDED.notes,
-        gift=EXCLUDED.gift,
-        updated_at=NOW();
-    """
+    # ✅ 1 queue / worker, worker i giữ partition i → thứ tự chunk trong 1 partition được giữ nguyên
+    queues = [queue.Queue(maxsize=2) for _ in range(args.workers)]
+    stop = threading.Event()
+    lock = threading.Lock()
+    errors = []
+
+    def worker(q):
+        nonlocal inserted, updated
+        conn = None
+        chunk_id = None
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.autocommit = False
+            while not stop.is_set():
+                try:
+                    item = q.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    return
+                chunk_id, rows = item
+                out = load_chunk(conn, rows, args, cutoff, actions, run_at)
+                if ckpt is not None:
+                    ckpt.mark(chunk_id)
+                with lock:
+                    inserted += out["inserted"]
+                    updated += out["updated"]
+                    stats["chunks"] += 1
+                    for k, v in out["summary"].items():
+                        summary[k] = summary.get(k, 0) + v
+                    for k, v in out["timings"].items():
+                        timings[k] = timings.get(k, 0) + v
+                    sample.extend(out["sample"])
+        except Exception as e:
+            with lock:
+                errors.append((chunk_id, e))
+            stop.set()
+        finally:
+            if conn is not None:
+                conn.close()
 
-    ok = 0
-    for row in df.itertuples(index=False):
-        cur.execute(sql, (int(row.tele_id), row.username, int(row.balance), row.status, row.notes, row.gift))
-        ok += 1
+    threads = [threading.Thread(target=worker, args=(q,), daemon=True) for q in queues]
+    for t in threads:
+        t.start()
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    def _put(q, item):
+        # put có timeout để không treo khi worker đã dừng vì lỗi
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
 
-    print(f"✅ Imported/Upserted {ok} rows into wallet")
+    try:
+        for p, n, rows in iter_chunks(iter_rows(args, stats), args.workers, args.chunk_rows):
+            if stop.is_set():
+                break
+            stats["staged"] += len(rows)
+            chunk_id = f"{p}:{n}"
+            if ckpt is not None and chunk_id in ckpt.done:
+                stats["resumed"] += 1
+                continue
+            _put(queues[p], (chunk_id, rows))
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        for q in queues:
+            _put(q, None)
+        for t in threads:
+            t.join()
+
+    total = time.time() - t_start
+    staged = stats["staged"]
+    print(f"✅ Loaded {staged} wallet rows (đọc {stats['read']}, bỏ {stats['skipped']} dòng thiếu tele_id)")
+    print(f"   🧩 {stats['chunks']} chunk / {args.workers} connection"
+          + (f", bỏ qua {stats['resumed']} chunk đã commit (resume)" if stats["resumed"] else ""))
+    sample.sort(key=lambda r: (-abs(r[3] - (r[2] or 0)), r[0]))
+    _print_diff(summary, sample[:args.show])
+    if cutoff is not None:
+        print(f"   🛡️ keep-newer: bỏ qua dòng DB cập nhật sau {cutoff.isoformat()}")
+    if args.dry_run:
+        print("🧪 Dry-run: không ghi gì vào DB")
+    else:
+        print(f"✅ Merged {inserted + updated} rows into wallet: +{inserted} mới, ~{updated} cập nhật")
+    # copy/diff/merge/commit = tổng thời gian của mọi connection (chạy song song nên có thể > wall time)
+    for name in ("prepare",) + PHASES:
+        if name in timings:
+            print(f"   ⏱️ {name:<8} {timings[name]:8.3f}s")
+    rate = staged / total if total > 0 else 0
+    print(f"   🚀 Tổng {total:.3f}s | {rate:,.0f} rows/s")
+
+    if errors or stop.is_set():
+        for chunk_id, e in errors:
+            print(f"❌ Chunk {chunk_id} lỗi: {e}")
+        if ckpt is not None:
+            print(f"↩️ Chạy lại cùng lệnh + --resume (checkpoint: {ckpt.path})")
+        sys.exit(1)
+    if ckpt is not None:
+        ckpt.clear()
 
 if __name__ == "__main__":
     main()
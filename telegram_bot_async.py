@@ -0,0 +1,600 @@
+# -*- coding: utf-8 -*-
+"""
+telegram_bot_async.py
+Chế độ asyncio/ASGI cho bot NgânMiu.Store (dùng chung logic với telegram_bot_pg_redis.py)
+
+✅ httpx.AsyncClient (pool connection dùng lại) cho Telegram + Shopee
+✅ asyncpg pool cho ghi ví (trừ / hoàn / hold); đọc ví qua UserContext chung (cache Redis + replica)
+✅ Check Voucher + lưu voucher nhiều cookie chạy song song trên 1 event loop
+✅ Update cùng user xử lý tuần tự (asyncio.Lock theo user), khác user song song
+✅ Luồng còn lại (menu, admin, QR, combo...) chạy code sync qua asyncio.to_thread
+✅ /webhook-sepay + /tool/* vẫn do Flask app xử lý (bridge WSGI chạy trong thread)
+
+Chạy:
+  pip install httpx asyncpg uvicorn
+  uvicorn telegram_bot_async:app --host 0.0.0.0 --port $PORT
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import traceback
+
+import httpx
+import asyncpg
+
+import telegram_bot_pg_redis as bot
+
+# =========================================================
+# CONFIG
+# =========================================================
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "500"))  # update đang xử lý tối đa
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "200"))
+ASYNC_PG_POOL_SIZE = int(os.getenv("ASYNC_PG_POOL_SIZE", "10"))
+ASYNC_SHOPEE_CONCURRENCY = int(os.getenv("ASYNC_SHOPEE_CONCURRENCY", "8"))  # request Shopee song song / 1 lượt
+ASYNC_THREAD_OFFLOAD = int(os.getenv("ASYNC_THREAD_OFFLOAD", "16"))  # luồng sync chạy cùng lúc
+ASYNC_SHUTDOWN_TIMEOUT = 25
+# Webhook đã trả 200 trước khi xử lý → update lỗi (chưa có side effect) tự chạy lại trong process
+ASYNC_UPDATE_RETRIES = int(os.getenv("ASYNC_UPDATE_RETRIES", "2"))
+
+CHECK_VOUCHER_TEXTS = ("📊 Check Voucher", "📊 Check voucher", "/checkvoucher")
+BALANCE_TEXTS = ("💰 Số dư", "/balance")
+
+HTTP = None
+APG = None
+_OFFLOAD_SEM = None
+_IN_FLIGHT = set()
+_USER_LOCKS = {}  # {user_id: [asyncio.Lock, refcount]}
+
+# =========================================================
+# LIFECYCLE
+# =========================================================
+async def startup():
+    global HTTP, APG, _OFFLOAD_SEM
+    HTTP = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS // 2,
+        ),
+        timeout=15,
+    )
+    _OFFLOAD_SEM = asyncio.Semaphore(ASYNC_THREAD_OFFLOAD)
+
+    # Sheets / PG pool / Redis của module sync (init chậm → chạy ngoài event loop)
+    await asyncio.get_running_loop().run_in_executor(None, bot.ensure_runtime)
+
+    if bot.DATABASE_URL:
+        try:
+            APG = await asyncpg.create_pool(bot.DATABASE_URL, min_size=1, max_size=ASYNC_PG_POOL_SIZE)
+        except Exception as e:
+            print("⚠️ asyncpg init lỗi:", e)
+            APG = None
+
+    print(f"✅ Async mode ready | PG {'OK' if APG else 'DOWN'} | max in-flight {ASYNC_MAX_IN_FLIGHT}")
+
+async def shutdown():
+    if _IN_FLIGHT:
+        print(f"⏳ Waiting {len(_IN_FLIGHT)} in-flight updates...")
+        await asyncio.wait(list(_IN_FLIGHT), timeout=ASYNC_SHUTDOWN_TIMEOUT)
+    # QR watcher / flow dở của module sync → checkpoint cho process mới
+    await asyncio.get_running_loop().run_in_executor(None, bot.shutdown, "asgi lifespan")
+    if HTTP is not None:
+        await HTTP.aclose()
+    if APG is not None:
+        await APG.close()
+
+def _spawn(coro):
+    """create_task + giữ reference tới khi xong (tránh bị GC giữa chừng)"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _IN_FLIGHT.add(task)
+    task.add_done_callback(_IN_FLIGHT.discard)
+    return task
+
+async def _offload(fn, *args):
+    """Chạy hàm sync (Sheet, code cũ) trong thread, giới hạn số luồng cùng lúc"""
+    async with _OFFLOAD_SEM:
+        return await asyncio.to_thread(fn, *args)
+
+# =========================================================
+# TELEGRAM (async)
+# =========================================================
+async def tg_send(chat_id, text, reply_markup=None):
+    payload = {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": "HTML"
+    }
+    if reply_markup:
+        payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
+
+    bot.flow_touch()
+    try:
+        await HTTP.post(f"{bot.BASE_URL}/sendMessage", data=payload, timeout=15)
+    except Exception as e:
+        bot.dprint("tg_send async error:", e)
+
+async def tg_answer_callback(callback_id, text=None, show_alert=False):
+    payload = {
+        "callback_query_id": callback_id,
+        "show_alert": show_alert
+    }
+    if text:
+        payload["text"] = text
+
+    try:
+        await HTTP.post(f"{bot.BASE_URL}/answerCallbackQuery", data=payload, timeout=10)
+    except Exception as e:
+        bot.dprint("tg_answer_callback async error:", e)
+
+# =========================================================
+# SHOPEE (async)
+# =========================================================
+async def check_one_voucher(voucher, cookie):
+    """Bản async của bot.check_one_voucher. Trả về: (success: bool, message: str)"""
+    headers, payload = bot.build_check_voucher_request(voucher, cookie)
+    try:
+        r = await HTTP.post(bot.CHECK_VOUCHER_URL, headers=headers, json=payload, timeout=10)
+        return bot.format_voucher_detail(voucher, r.json())
+    except Exception as e:
+        return bot.format_check_voucher_error(voucher, e)
+
+async def save_voucher_and_check(cookie, voucher):
+    """Bản async của bot.save_voucher_and_check. Trả về: (ok: bool, reason: str)"""
+    bot.flow_touch(voucher=True)
+    headers, payload = bot.build_save_voucher_request(cookie, voucher)
+    try:
+        r = await HTTP.post(bot.SAVE_URL, headers=headers, json=payload, timeout=15)
+        if r.status_code != 200:
+            return False, f"HTTP_{r.status_code}"
+        return bot.parse_save_voucher_response(r.json())
+    except httpx.TimeoutException:
+        return False, "TIMEOUT"
+    except Exception as e:
+        return False, f"EXCEPTION_{str(e)}"
+
+async def save_voucher_multi_cookies(cookies, voucher):
+    """Lưu 1 voucher cho nhiều cookie song song. Trả về giống bản sync."""
+    sem = asyncio.Semaphore(ASYNC_SHOPEE_CONCURRENCY)
+
+    async def _one(cookie):
+        async with sem:
+            return await save_voucher_and_check(cookie, voucher)
+
+    results = await asyncio.gather(*[_one(c) for c in cookies])
+
+    success_count = 0
+    failed_details = []
+    for idx, (ok, reason) in enumerate(results, 1):
+        if ok:
+            success_count += 1
+            bot.dprint(f"✅ Cookie #{idx}: SUCCESS")
+        else:
+            failed_details.append((idx, reason))
+            bot.dprint(f"❌ Cookie #{idx}: {reason}")
+
+    return success_count, len(cookies), failed_details
+
+# =========================================================
+# WALLET (asyncpg) - dùng chung SQL với bản sync
+# =========================================================
+_SQL_CACHE = {}
+
+def _to_asyncpg(sql):
+    """Đổi placeholder %s (psycopg2) → $1, $2... (asyncpg)"""
+    out = _SQL_CACHE.get(sql)
+    if out is None:
+        counter = iter(range(1, 1000))
+        out = re.sub(r"%s", lambda _m: f"${next(counter)}", sql)
+        _SQL_CACHE[sql] = out
+    return out
+
+async def pg_fetchrow(sql, *args):
+    """
+    Lỗi → raise như pg_exec(strict=True) của bản sync, KHÔNG trả None
+    (None ở ví = "không đủ số dư / chưa có ví" → báo sai cho user):
+    - Pool chưa sẵn sàng / hết connection / mất kết nối → bot.PgUnavailable
+    - Lỗi SQL (timeout, deadlock, lỗi trong wallet_apply...) → bot.PgQueryError
+    handle_update_async → bot.update_failed báo "hệ thống bận".
+    """
+    if APG is None:
+        raise bot.PgUnavailable("asyncpg pool not ready")
+    try:
+        async with APG.acquire(timeout=bot.PG_ACQUIRE_TIMEOUT) as conn:
+            return await conn.fetchrow(_to_asyncpg(sql), *args)
+    except asyncpg.PostgresError as e:
+        raise bot.PgQueryError(f"APG query failed: {e}") from e
+    except (asyncpg.InterfaceError, asyncio.TimeoutError, OSError) as e:
+        raise bot.PgUnavailable(f"APG unavailable: {e}") from e
+
+async def get_balance_direct(user_id):
+    r = await pg_fetchrow(bot.SQL_GET_BALANCE, int(user_id))
+    return int(r[0] or 0) if r else 0
+
+def _publish_balance(user_id, new_balance):
+    """Sau lệnh ghi ví: đánh dấu read-your-writes (mọi worker) + cache Redis + sheet - chạy nền"""
+    _spawn(_offload(bot.pg_mark_recent_write, user_id))
+    _spawn(_offload(bot.wallet_cache_set_balance, user_id, new_balance))
+    _spawn(_offload(bot.mirror_balance_to_sheet, user_id, new_balance))
+
+async def update_balance_atomic(user_id, delta, kind="adjust", key=None, note=None):
+    """Cộng/hoàn tiền atomic + ghi sổ cái (key trùng → no-op). Returns: (success: bool, new_balance: int)"""
+    user_id = int(user_id)
+    # Trong 1 update → key upd:<update_id>:<kind>:<n> giống bản sync
+    key = key or bot.flow_ledger_key(user_id, kind)
+    # 1 statement: tự tạo ví nếu chưa có + cộng tiền + ghi wallet_ledger + trả số dư cũ/mới
+    r = await pg_fetchrow(bot.SQL_UPDATE_BALANCE, user_id, int(delta), kind, key, note)
+    if not r:
+        return False, 0
+
+    new_balance = int(r[1] or 0)
+    if not r[2]:
+        return True, new_balance
+    bot.flow_note(user_id, -int(delta))
+    _publish_balance(user_id, new_balance)
+    return True, new_balance
+
+async def deduct_balance_atomic(user_id, need_amount, kind="debit", key=None, note=None):
+    """Trừ tiền atomic (không đủ → không trừ) + ghi sổ cái. Returns: (success: bool, new_balance: int)"""
+    need_amount = int(need_amount or 0)
+    if need_amount <= 0:
+        return True, await get_balance_direct(user_id)
+
+    # User chưa có ví → UPDATE không match → thất bại, không cần ensure_user_exists
+    # Không đủ tiền → số dư hiện tại có sẵn ở cột old_balance, không SELECT lại
+    key = key or bot.flow_ledger_key(user_id, kind)
+    r = await pg_fetchrow(bot.SQL_DEDUCT_BALANCE, int(user_id), -need_amount, kind, key, note)
+    if not r or r[1] is None:
+        return False, int((r or (0,))[0] or 0)
+
+    new_balance = int(r[1] or 0)
+    if not r[2]:
+        return True, new_balance
+    bot.flow_note(user_id, need_amount)
+    _publish_balance(user_id, new_balance)
+    return True, new_balance
+
+async def hold_place(user_id, amount, key=None):
+    """Giữ tiền (chưa trừ số dư). Returns: (hold_id | None nếu không đủ, số dư khả dụng)"""
+    key = key or bot.flow_ledger_key(user_id, "hold")
+    r = await pg_fetchrow(bot.SQL_HOLD_PLACE, int(user_id), int(amount), key, bot.WALLET_HOLD_TTL)
+    if not r or r[0] is None:
+        return None, int((r or (0, 0))[1] or 0)
+    # Flow theo dõi hold → handler lỗi giữa chừng thì flow_end tự nhả
+    bot.flow_track_hold(r[0])
+    return int(r[0]), int(r[1] or 0)
+
+async def hold_settle(hold_id, capture, kind="purchase", key=None, note=None):
+    """Trừ capture + nhả phần còn lại trong 1 lệnh. Returns: (applied: bool, new_balance: int)"""
+    r = await pg_fetchrow(bot.SQL_HOLD_SETTLE, int(hold_id), int(capture), kind, key, note)
+    bot.flow_untrack_hold(hold_id)
+    if not r or r[0] is None:
+        return False, 0
+    new_balance = int(r[1] or 0)
+    if r[2] and capture > 0:
+        _publish_balance(int(r[0]), new_balance)
+    return bool(r[2]), new_balance
+
+# =========================================================
+# CORE UPDATE HANDLER (async)
+# =========================================================
+async def handle_update_async(update, attempt=0):
+    """
+    Cùng quy trình với bot.handle_update: dedup → flow_begin → xử lý → update_failed / flow_end.
+    Dedup, xử lý lỗi, flow_end (nhả hold) đều gọi Redis / PG → offload, không chặn event loop.
+    """
+    bot.dprint("UPDATE (async):", update)
+
+    if await _offload(bot.is_duplicate_update, update):
+        return
+
+    user_id = bot.extract_update_user_id(update)
+    entry = _USER_LOCKS.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            # flow_begin chạy ngay trong task → contextvar được copy sang mọi _offload bên dưới
+            bot.flow_begin(update)
+            try:
+                handled, uctx = await _handle_native(update)
+                if not handled:
+                    await _offload(bot.process_update, update, uctx)
+            except Exception as e:
+                print(f"[ASYNC] handle_update error: {e}")
+                bot.dprint(traceback.format_exc())
+                if await _offload(bot.update_failed, update, e) and attempt < ASYNC_UPDATE_RETRIES:
+                    _spawn(_retry_update(update, attempt + 1))
+            finally:
+                await _offload(bot.flow_end)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _USER_LOCKS.pop(user_id, None)
+
+async def _retry_update(update, attempt):
+    await asyncio.sleep(bot.WEBHOOK_RETRY_AFTER * attempt)
+    await handle_update_async(update, attempt)
+
+async def _handle_native(update):
+    """
+    Xử lý native (không chiếm thread) các luồng nặng I/O:
+    Check Voucher, Số dư, gửi cookie lưu voucher đơn.
+    Returns: (handled, uctx) - handled False → process_update (sync) xử lý tiếp với uctx đã đọc
+    (mỗi update chỉ đọc ví 1 lần).
+    """
+    msg = update.get("message")
+    if not msg or "callback_query" in update:
+        return False, None
+
+    text = (msg.get("text") or "").strip()
+    is_check = text in CHECK_VOUCHER_TEXTS
+    is_balance = text in BALANCE_TEXTS
+    user_id = msg["from"]["id"]
+    is_cookie = "SPC_" in text and not text.startswith("/") and user_id in bot.PENDING_VOUCHER
+    if not (is_check or is_balance or is_cookie):
+        return False, None
+
+    # 1 lần đọc ví (cache Redis → PG, replica khi được) dùng chung cho ban + số dư + luồng sync
+    uctx, ban_status = await _offload(_load_user_and_ban, user_id)
+    # Ban → để luồng sync gửi thông báo khóa
+    if ban_status["banned"] or not uctx.exists:
+        return False, uctx
+    balance, status = uctx.balance, uctx.status
+
+    chat_id = msg["chat"]["id"]
+    username = msg["from"].get("username", "")
+
+    if is_check:
+        await _handle_check_voucher(user_id, username)
+        return True, uctx
+
+    if is_balance:
+        # ✅ RATE LIMIT: 1 lần/3s per user (dùng chung CALLBACK_COOLDOWN)
+        key = f"balance_{user_id}"
+        if time.time() - bot.CALLBACK_COOLDOWN.get(key, 0) < 3:
+            return True, uctx
+        bot.CALLBACK_COOLDOWN[key] = time.time()
+        await tg_send(
+            chat_id,
+            f"💰 <b>Số dư:</b> <b>{balance:,}đ</b>\n"
+            f"📌 Trạng thái: <b>{status}</b>",
+            bot.build_main_keyboard(is_active=(status == "active"))
+        )
+        return True, uctx
+
+    if status != "active":
+        return False, uctx
+    return await _handle_pending_voucher(chat_id, user_id, username, text), uctx
+
+def _load_user_and_ban(user_id):
+    uctx = bot.load_user_context(user_id)
+    return uctx, bot.check_ban_status(user_id, uctx)
+
+async def _handle_check_voucher(user_id, username):
+    cookie = await _offload(bot.get_cookie_from_sheet)
+    if not cookie:
+        await tg_send(
+            user_id,
+            "❌ Không tìm thấy Cookie trong hệ thống!\n\n"
+            "Vui lòng liên hệ Admin để thêm Cookie vào tab Cookie.",
+            bot.build_main_keyboard()
+        )
+        return
+
+    await tg_send(user_id, "📊 Đang tải danh sách voucher...")
+    vouchers = await _offload(bot.get_vouchers_from_stock)
+    if not vouchers:
+        await tg_send(user_id, "❌ Không tìm thấy voucher nào trong VoucherStock!", bot.build_main_keyboard())
+        return
+
+    # ✅ Check song song (giữ thứ tự kết quả)
+    sem = asyncio.Semaphore(ASYNC_SHOPEE_CONCURRENCY)
+
+    async def _one(v):
+        async with sem:
+            return (await check_one_voucher(v, cookie))[1]
+
+    results = await asyncio.gather(*[_one(v) for v in vouchers])
+
+    chunks = bot.chunk_check_voucher_results(results)
+    if len(chunks) > 1:
+        for chunk in chunks:
+            await tg_send(user_id, chunk)
+    else:
+        await tg_send(user_id, chunks[0], bot.build_main_keyboard())
+
+    _spawn(_offload(bot.log_check_voucher, user_id, username, len(vouchers), results))
+
+async def _handle_pending_voucher(chat_id, user_id, username, text):
+    """Cookie cho voucher đơn đang chờ (PENDING_VOUCHER). Combo / QUICK_SAVE → để sync xử lý."""
+    pending = bot.PENDING_VOUCHER.get(user_id)
+    if not isinstance(pending, dict) or pending.get("cookie") or str(pending.get("cmd", "")).startswith("combo"):
+        return False
+    bot.PENDING_VOUCHER.pop(user_id, None)
+    cmd = pending["cmd"]
+
+    if time.time() - pending["ts"] > bot.PENDING_VOUCHER_TTL:
+        keyboard = await _offload(bot.build_quick_voucher_keyboard)
+        await tg_send(
+            chat_id,
+            "⏱️ <b>Phiên mua đã hết hạn</b>\n\n"
+            "Vui lòng chọn voucher lại:",
+            keyboard
+        )
+        return True
+
+    cookies = bot.parse_cookies(text)
+    if not cookies:
+        await tg_send(chat_id, "❌ Không tìm thấy cookie hợp lệ")
+        return True
+    num_cookies = len(cookies)
+
+    v, err = await _offload(bot.get_voucher, cmd)
+    if err:
+        await tg_send(chat_id, f"❌ {err}")
+        return True
+
+    price = int(v.get("Giá", 0))
+    total_price = price * num_cookies
+
+    # ✅ ATOMIC DEDUCT - Trừ tiền TRƯỚC khi lưu voucher
+    # ✅ HOLD - giữ tiền trước (chưa trừ); key theo flow (upd:<update_id>:hold:<n>)
+    # → Telegram gửi lại cùng update dùng lại hold cũ
+    hold_id, available = await hold_place(user_id, total_price)
+    if not hold_id:
+        await tg_send(
+            chat_id,
+            f"❌ Không đủ số dư\n"
+            f"💰 Cần: {total_price:,}đ ({price:,}đ × {num_cookies})\n"
+            f"💼 Số dư hiện tại: {available:,}đ"
+        )
+        return True
+
+    # ✅ ĐÃ GIỮ TIỀN - lưu song song tất cả cookie (lỗi giữa chừng → nhả hold)
+    try:
+        success_count, total_count, failed_details = await save_voucher_multi_cookies(cookies, v)
+    except Exception:
+        await hold_settle(hold_id, 0)
+        raise
+
+    # ✅ SETTLE 1 LẦN: trừ đúng số cookie thành công, phần còn lại tự nhả
+    actual_price = price * success_count
+    # Không lưu được gì → chỉ nhả hold (chưa trừ) và báo theo kết quả nhả thật
+    if success_count == 0:
+        release, real_balance = await _offload(bot.hold_release, hold_id)
+        await tg_send(
+            chat_id,
+            f"❌ Không lưu được cookie nào\n"
+            f"{bot.fmt_hold_release(release, total_price)}"
+            f"💰 Số dư hiện tại: <b>{bot.fmt_balance(real_balance)}</b>"
+        )
+        return True
+
+    # Capture có retry + đối soát (đã giao hàng → không được mất khoản trừ) → dùng chung bản sync
+    _, real_balance = await _offload(bot.hold_finish, hold_id, user_id, actual_price)
+
+    _spawn(_offload(
+        bot.log_row, user_id, username, "VOUCHER", str(actual_price),
+        f"Lưu {cmd} {success_count}/{total_count} thành công"
+    ))
+
+    icon = "✅" if success_count == total_count else "⚠️"
+    await tg_send(chat_id, f"{icon} Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{bot.fmt_balance(real_balance)}</b>")
+    await tg_send(chat_id, "👉 <b>Bấm để lưu tiếp nhanh</b>", bot.build_quick_buy_keyboard(cmd))
+    return True
+
+# =========================================================
+# WSGI BRIDGE - Flask routes (/webhook-sepay, /tool/*, /metrics...)
+# =========================================================
+def _run_wsgi(scope, body):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": "",
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    out = {}
+
+    def start_response(status, headers, exc_info=None):
+        out["status"] = int(status.split(" ", 1)[0])
+        out["headers"] = headers
+        return lambda _data: None
+
+    result = bot.app(environ, start_response)
+    try:
+        payload = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return out["status"], out["headers"], payload
+
+# =========================================================
+# ASGI APP
+# =========================================================
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def _respond(send, status, body, headers=None):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    raw_headers = [(b"content-type", b"text/plain; charset=utf-8")]
+    for k, v in (headers or []):
+        raw_headers.append((k.encode("latin-1"), str(v).encode("latin-1")))
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    body = await _read_body(receive)
+
+    # ✅ Telegram webhook: nhận update → task async, trả về ngay
+    if scope["path"] == "/webhook" and scope["method"] == "POST":
+        try:
+            update = json.loads(body or b"{}")
+        except Exception:
+            await _respond(send, 400, "bad json")
+            return
+        if len(_IN_FLIGHT) >= ASYNC_MAX_IN_FLIGHT:
+            await _respond(send, 503, "busy", [("Retry-After", bot.WEBHOOK_RETRY_AFTER)])
+            return
+        _spawn(handle_update_async(update))
+        await _respond(send, 200, "ok")
+        return
+
+    # ✅ Route khác → Flask app (chạy trong thread)
+    status, headers, payload = await _offload(_run_wsgi, scope, body)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": payload})
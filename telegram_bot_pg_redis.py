@@ -13,7 +13,11 @@ NgânMiu.Store — Telegram Bot
 """
 
 import os
+import sys
 import json
+import socket
+import hmac
+import hashlib
 import re
 import unicodedata
 import requests
@@ -25,14 +29,18 @@ from flask import Flask, request
 # PG + REDIS (Wallet DB + Anti-spam)
 # =========================================================
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
 import redis
+import threading
+import contextvars
+import itertools
+import heapq
 from contextlib import contextmanager
 
 import urllib.parse
 import time
 import traceback
-from collections import deque  # ✅ Thêm deque cho PROCESSED_UPDATE_IDS
+from collections import deque, OrderedDict  # ✅ deque cho wait-time worker pool, OrderedDict cho LRU dedup
+import queue  # ✅ Hàng đợi có giới hạn cho worker pool webhook
 
 # =========================================================
 # TIMEZONE VIETNAM (GMT+7)
@@ -68,6 +76,7 @@ CREDS_JSON = os.getenv("GOOGLE_SHEETS_CREDS_JSON", "").strip()
 ADMIN_ID   = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))
 
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "").strip()  # replica (tuỳ chọn) cho query chỉ đọc
 REDIS_URL    = os.getenv("REDIS_URL", "").strip()
 
 # Mirror ví tiền ra Google Sheet để bạn theo dõi (không bắt buộc)
@@ -81,70 +90,637 @@ SAVE_URL = "https://shopee.vn/api/v2/voucher_wallet/save_vouchers"
 # PG POOL + REDIS CLIENT
 # =========================================================
 PG_POOL = None
+PG_READ_POOL = None  # pool replica; None → mọi query đi primary
 RDS = None
 
+PG_POOL_SIZE = int(os.getenv("PG_POOL_SIZE", "10"))
+PG_ACQUIRE_TIMEOUT = float(os.getenv("PG_ACQUIRE_TIMEOUT", "5"))  # giây chờ tối đa khi pool hết connection
+PG_READ_POOL_SIZE = int(os.getenv("PG_READ_POOL_SIZE", "5"))
+PG_READ_STICKY_SECONDS = float(os.getenv("PG_READ_STICKY_SECONDS", "5"))  # user vừa ghi → đọc primary (replica lag)
+
+# ✅ LIVENESS: Railway restart PG / proxy cắt connection idle → không đưa connection chết cho caller
+PG_CONN_MAX_AGE = int(os.getenv("PG_CONN_MAX_AGE", "1800"))     # connection sống quá 30 phút → mở mới
+PG_CONN_PING_IDLE = float(os.getenv("PG_CONN_PING_IDLE", "30"))  # idle quá 30s → SELECT 1 trước khi dùng
+PG_CONNECT_RETRIES = int(os.getenv("PG_CONNECT_RETRIES", "3"))   # reconnect có backoff
+PG_CONNECT_TIMEOUT = int(os.getenv("PG_CONNECT_TIMEOUT", "5"))
+PG_EXEC_RETRIES = 1  # chỉ retry khi connection chết TRƯỚC commit (chắc chắn chưa ghi gì)
+PG_KEEPALIVE = {
+    "keepalives": 1,
+    "keepalives_idle": int(os.getenv("PG_KEEPALIVE_IDLE", "30")),
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+}
+
+# ⏱️ INSTRUMENTATION: statement_timeout mỗi connection + log query chậm
+PG_STATEMENT_TIMEOUT_MS = int(os.getenv("PG_STATEMENT_TIMEOUT_MS", "15000"))
+PG_SLOW_QUERY_MS = float(os.getenv("PG_SLOW_QUERY_MS", "500"))
+PG_QUERY_SAMPLES = 512  # số mẫu latency gần nhất giữ cho mỗi fingerprint (tính p50/p95/p99)
+
+class PgUnavailable(Exception):
+    """Không lấy được connection PG (pool bận quá timeout / DB không kết nối được)"""
+
+class PgQueryError(PgUnavailable):
+    """Câu SQL lỗi (timeout, deadlock, exception trong function) khi gọi pg_exec(strict=True)"""
+
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_SPACE_RE = re.compile(r"\s+")
+
+class QueryStats:
+    """
+    Thống kê theo fingerprint SQL (bỏ khoảng trắng thừa, literal → ?):
+    count, lỗi, rows, tổng thời gian, p50/p95/p99 trên PG_QUERY_SAMPLES mẫu gần nhất.
+    """
+
+    def __init__(self, samples=PG_QUERY_SAMPLES):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._fingerprints = {}  # sql gốc → fingerprint (module chỉ có vài chục câu SQL)
+        self._stats = {}
+
+    def fingerprint(self, sql):
+        fp = self._fingerprints.get(sql)
+        if fp is None:
+            fp = _SQL_SPACE_RE.sub(" ", _SQL_LITERAL_RE.sub("?", sql)).strip()[:160]
+            self._fingerprints[sql] = fp
+        return fp
+
+    def record(self, sql, elapsed, rows=0, error=False):
+        fp = self.fingerprint(sql)
+        with self._lock:
+            st = self._stats.get(fp)
+            if st is None:
+                st = self._stats[fp] = {
+                    "count": 0, "errors": 0, "rows": 0, "total": 0.0, "max": 0.0, "slow": 0,
+                    "lat": deque(maxlen=self.samples),
+                }
+            st["count"] += 1
+            st["rows"] += max(int(rows or 0), 0)
+            st["total"] += elapsed
+            st["max"] = max(st["max"], elapsed)
+            st["lat"].append(elapsed)
+            if error:
+                st["errors"] += 1
+            if elapsed * 1000 >= PG_SLOW_QUERY_MS:
+                st["slow"] += 1
+        return fp
+
+    def snapshot(self, top=None):
+        """List thống kê, sắp theo tổng thời gian giảm dần (câu nào chiếm DB nhiều nhất)"""
+        with self._lock:
+            items = [(fp, dict(st, lat=sorted(st["lat"]))) for fp, st in self._stats.items()]
+        out = []
+        for fp, st in items:
+            lat = st.pop("lat")
+            pct = lambda q: round(lat[min(len(lat) - 1, int(len(lat) * q))] * 1000, 2) if lat else 0.0
+            out.append({
+                "sql": fp,
+                "count": st["count"],
+                "errors": st["errors"],
+                "slow": st["slow"],
+                "rows": st["rows"],
+                "total_ms": round(st["total"] * 1000, 1),
+                "avg_ms": round(st["total"] / st["count"] * 1000, 2) if st["count"] else 0.0,
+                "p50_ms": pct(0.50),
+                "p95_ms": pct(0.95),
+                "p99_ms": pct(0.99),
+                "max_ms": round(st["max"] * 1000, 2),
+            })
+        out.sort(key=lambda x: x["total_ms"], reverse=True)
+        return out[:top] if top else out
+
+PG_QUERY_STATS = QueryStats()
+
+def _pg_caller():
+    """Hàm gọi pg_exec (bỏ qua các frame của chính pg_exec / helper PG)"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_name in ("pg_exec", "_pg_exec_on", "pg_conn", "__exit__", "__enter__"):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{frame.f_code.co_name}:{frame.f_lineno}"
+
+class PgPool:
+    """
+    Pool PostgreSQL an toàn đa luồng (thay SimpleConnectionPool).
+    - Tối đa `size` connection, mở dần khi cần
+    - Hết connection → chờ trong hàng đợi tối đa acquire_timeout rồi raise PgUnavailable
+      (không trả None để caller hiểu nhầm thành "không có user" / "không đủ tiền")
+    - Ghi histogram thời gian chờ mỗi lần lấy connection
+    """
+
+    WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, dsn, size, acquire_timeout):
+        self.dsn = dsn
+        self.size = max(1, int(size))
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._total = 0  # đang mở (idle + đang dùng)
+        self._meta = {}  # id(conn) → [created_at, last_used]
+        self._cond = threading.Condition()
+        self._hist = [0] * (len(self.WAIT_BUCKETS_MS) + 1)
+        self.stats = {
+            "acquired": 0,
+            "timeouts": 0,
+            "connect_errors": 0,
+            "reconnects": 0,
+            "evicted_dead": 0,
+            "evicted_age": 0,
+            "discarded": 0,
+            "waiting": 0,
+            "in_use": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    def _connect(self, deadline):
+        """Mở connection mới (TCP keepalive), retry có backoff trong phạm vi deadline"""
+        last_err = None
+        for attempt in range(max(1, PG_CONNECT_RETRIES)):
+            if attempt:
+                delay = min(0.2 * (2 ** attempt), max(0.0, deadline - time.time()))
+                if delay <= 0:
+                    break
+                time.sleep(delay)
+                with self._cond:
+                    self.stats["reconnects"] += 1
+            try:
+                conn = psycopg2.connect(
+                    self.dsn,
+                    connect_timeout=PG_CONNECT_TIMEOUT,
+                    options=f"-c statement_timeout={PG_STATEMENT_TIMEOUT_MS}" if PG_STATEMENT_TIMEOUT_MS > 0 else None,
+                    **PG_KEEPALIVE
+                )
+                now = time.time()
+                with self._cond:
+                    self._meta[id(conn)] = [now, now]
+                return conn
+            except Exception as e:
+                last_err = e
+                dprint(f"PG connect attempt {attempt + 1} failed: {e}")
+        raise last_err
+
+    def _is_usable(self, conn):
+        """Kiểm tra connection lấy từ idle: còn mở, chưa quá tuổi, ping nếu idle lâu"""
+        if conn.closed:
+            self._count("evicted_dead")
+            return False
+        created, last_used = self._meta.get(id(conn), (0, 0))
+        now = time.time()
+        if now - created > PG_CONN_MAX_AGE:
+            self._count("evicted_age")
+            return False
+        if now - last_used > PG_CONN_PING_IDLE:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                self._count("evicted_dead")
+                return False
+        return True
+
+    def _count(self, key):
+        with self._cond:
+            self.stats[key] += 1
+
+    def _drop(self, conn):
+        self._meta.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        t0 = time.time()
+        deadline = t0 + timeout
+        conn = None
+        need_connect = False
+
+        with self._cond:
+            self.stats["waiting"] += 1
+            try:
+                while True:
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._total < self.size:
+                        self._total += 1
+                        need_connect = True
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise PgUnavailable(f"PG pool exhausted ({self.size} connections, waited {timeout}s)")
+                    self._cond.wait(remaining)
+            finally:
+                self.stats["waiting"] -= 1
+
+        # Connection idle chết / quá tuổi → đóng, mở lại ngay trên slot đó
+        if conn is not None and not self._is_usable(conn):
+            self._drop(conn)
+            conn = None
+            need_connect = True
+
+        if need_connect:
+            try:
+                conn = self._connect(deadline)
+            except Exception as e:
+                with self._cond:
+                    self._total -= 1
+                    self.stats["connect_errors"] += 1
+                    self._cond.notify()
+                raise PgUnavailable(f"PG connect failed: {e}") from e
+
+        waited = time.time() - t0
+        with self._cond:
+            self.stats["acquired"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+            ms = waited * 1000
+            idx = next((i for i, b in enumerate(self.WAIT_BUCKETS_MS) if ms <= b), len(self.WAIT_BUCKETS_MS))
+            self._hist[idx] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Trả connection. close=True (hoặc conn đã đóng) → bỏ hẳn, lần sau mở mới."""
+        close = close or bool(getattr(conn, "closed", 0))
+        if close:
+            self._drop(conn)
+        else:
+            meta = self._meta.get(id(conn))
+            if meta:
+                meta[1] = time.time()
+        with self._cond:
+            self.stats["in_use"] -= 1
+            if close:
+                self._total -= 1
+                self.stats["discarded"] += 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+        for conn in idle:
+            self._drop(conn)
+
+    def snapshot(self):
+        with self._cond:
+            s = dict(self.stats)
+            s["size"] = self.size
+            s["open"] = self._total
+            s["idle"] = len(self._idle)
+            hist = list(self._hist)
+        s["wait_avg_ms"] = round(s.pop("wait_total") / s["acquired"] * 1000, 2) if s["acquired"] else 0.0
+        s["wait_max_ms"] = round(s.pop("wait_max") * 1000, 2)
+        labels = [f"<={b}ms" for b in self.WAIT_BUCKETS_MS] + [f">{self.WAIT_BUCKETS_MS[-1]}ms"]
+        s["wait_hist"] = dict(zip(labels, hist))
+        return s
+
 def _init_pg():
-    global PG_POOL
+    global PG_POOL, PG_READ_POOL
     if not DATABASE_URL:
         print("⚠️ DATABASE_URL trống -> bot sẽ fallback dùng Google Sheet cho ví tiền (không khuyến nghị).")
         return
     if PG_POOL is None:
-        PG_POOL = SimpleConnectionPool(
-            minconn=1,
-            maxconn=5,
-            dsn=DATABASE_URL,
-        )
+        PG_POOL = PgPool(DATABASE_URL, PG_POOL_SIZE, PG_ACQUIRE_TIMEOUT)
+    if DATABASE_READ_URL and PG_READ_POOL is None:
+        PG_READ_POOL = PgPool(DATABASE_READ_URL, PG_READ_POOL_SIZE, PG_ACQUIRE_TIMEOUT)
+        print(f"✅ PG read replica pool ({PG_READ_POOL_SIZE} connections)")
 
 @contextmanager
-def pg_conn():
-    """Lấy connection từ pool, tự trả lại."""
-    if PG_POOL is None:
+def pg_conn(pool=None):
+    """Lấy connection từ pool (mặc định primary), tự trả lại. Pool bận / DB down → raise PgUnavailable."""
+    pool = pool or PG_POOL
+    if pool is None:
         yield None
         return
-    conn = PG_POOL.getconn()
+    conn = pool.getconn()
+    broken = False
     try:
         yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
     finally:
+        pool.putconn(conn, close=broken)
+
+# ✅ READ-YOUR-WRITES: user vừa ghi (trong request này hoặc vài giây trước) → đọc primary
+# - Trong request: set thread-local (không tốn round trip)
+# - Giữa các worker / process: key Redis pg:recent_write:<id> TTL PG_READ_STICKY_SECONDS
+#   (request sau của user có thể rơi vào worker khác → dict trong process không đủ)
+# - Không có Redis / Redis lỗi → dict trong process (chỉ đúng khi chạy 1 process)
+_PG_WRITES_LOCAL = threading.local()
+_PG_RECENT_WRITERS = {}  # {tele_id: ts ghi gần nhất} - fallback khi không có Redis
+_PG_RECENT_WRITERS_LOCK = threading.Lock()
+
+def _pg_recent_write_key(user_id):
+    return f"pg:recent_write:{int(user_id)}"
+
+def pg_mark_recent_write(user_id):
+    """Đánh dấu user vừa ghi cho MỌI worker (không đụng set thread-local của thread đang chạy)"""
+    if PG_READ_POOL is None:
+        return
+    user_id = int(user_id)
+    if RDS is not None:
         try:
-            PG_POOL.putconn(conn)
-        except Exception:
-            pass
+            RDS.set(_pg_recent_write_key(user_id), 1, px=max(1, int(PG_READ_STICKY_SECONDS * 1000)))
+            return
+        except Exception as e:
+            dprint(f"pg recent write mark error: {e}")
+    now = time.time()
+    with _PG_RECENT_WRITERS_LOCK:
+        _PG_RECENT_WRITERS[user_id] = now
+        if len(_PG_RECENT_WRITERS) > 10000:
+            cutoff = now - PG_READ_STICKY_SECONDS
+            for uid in [u for u, ts in _PG_RECENT_WRITERS.items() if ts < cutoff]:
+                del _PG_RECENT_WRITERS[uid]
+
+def pg_note_write(user_id):
+    if PG_READ_POOL is None:
+        return
+    user_id = int(user_id)
+    writes = getattr(_PG_WRITES_LOCAL, "users", None)
+    if writes is None:
+        writes = _PG_WRITES_LOCAL.users = set()
+    writes.add(user_id)
+    pg_mark_recent_write(user_id)
 
-def pg_exec(sql: str, params=None, fetchone=False, fetchall=False):
-    if PG_POOL is None:
-        return None
-    with pg_conn() as conn:
-        if conn is None:
-            return None
-        conn.autocommit = False
-        cur = conn.cursor()
+def pg_reset_request_writes():
+    """Đầu mỗi update: quên danh sách user đã ghi của request trước trên thread này"""
+    _PG_WRITES_LOCAL.users = set()
+
+def _pg_recently_written(user_id):
+    if RDS is not None:
         try:
-            cur.execute(sql, params or ())
-            out = None
-            if fetchone:
-                out = cur.fetchone()
-            elif fetchall:
-                out = cur.fetchall()
-            conn.commit()
-            return out
+            return bool(RDS.exists(_pg_recent_write_key(user_id)))
         except Exception as e:
+            dprint(f"pg recent write check error: {e}")
+    with _PG_RECENT_WRITERS_LOCK:
+        ts = _PG_RECENT_WRITERS.get(user_id)
+    return bool(ts and time.time() - ts < PG_READ_STICKY_SECONDS)
+
+def _pg_read_pool(user_id=None):
+    """Pool cho query chỉ đọc: replica, trừ khi user vừa ghi (tránh đọc số dư cũ do replica lag)"""
+    if PG_READ_POOL is None:
+        return PG_POOL
+    if user_id is not None:
+        user_id = int(user_id)
+        if user_id in (getattr(_PG_WRITES_LOCAL, "users", None) or ()):
+            return PG_POOL
+        if _pg_recently_written(user_id):
+            return PG_POOL
+    return PG_READ_POOL
+
+def _pg_record(sql, t0, rows, error=None):
+    elapsed = time.time() - t0
+    fp = PG_QUERY_STATS.record(sql, elapsed, rows, error is not None)
+    if elapsed * 1000 >= PG_SLOW_QUERY_MS:
+        print(
+            f"🐢 SLOW QUERY {elapsed * 1000:.0f}ms | caller={_pg_caller()} | rows={rows}"
+            f"{' | error=' + str(error).strip() if error is not None else ''} | {fp}"
+        )
+
+def pg_exec(sql: str, params=None, fetchone=False, fetchall=False, read=False, user_id=None, strict=False):
+    """
+    read=True: query chỉ đọc → replica (nếu có DATABASE_READ_URL).
+    user_id: giữ read-your-writes - user vừa ghi thì vẫn đọc primary.
+    strict=True: SQL lỗi → raise PgQueryError thay vì trả None
+    (dùng khi None có nghĩa nghiệp vụ, vd "tx đã xử lý").
+    """
+    if PG_POOL is None:
+        return None
+    if read:
+        pool = _pg_read_pool(user_id)
+        if pool is not PG_POOL:
             try:
-                conn.rollback()
-            except Exception:
-                pass
-            dprint(f"PG error: {e}")
-            return None
-        finally:
+                return _pg_exec_on(pool, sql, params, fetchone, fetchall, strict)
+            except PgUnavailable as e:
+                # Replica bận / down → đọc primary, không làm hỏng request
+                dprint(f"PG replica unavailable, fallback primary: {e}")
+    return _pg_exec_on(PG_POOL, sql, params, fetchone, fetchall, strict)
+
+def pg_batch(statements, fetchone=False, fetchall=False, strict=False):
+    """
+    Nhiều statement độc lập → 1 round trip + 1 transaction (lỗi 1 câu → rollback cả lô).
+    statements: list SQL hoặc (sql, params). Trả kết quả của statement CUỐI.
+    strict=True: lỗi SQL → raise PgQueryError (như pg_exec)
+    """
+    if PG_POOL is None or not statements:
+        return None
+    stmts = [(q, None) if isinstance(q, str) else (q[0], q[1]) for q in statements]
+    return _pg_exec_on(PG_POOL, stmts, None, fetchone, fetchall, strict)
+
+def _pg_exec_on(pool, sql, params=None, fetchone=False, fetchall=False, strict=False):
+    batch = isinstance(sql, list)
+    # Thống kê theo template (không theo SQL đã gắn giá trị)
+    label = " ; ".join(q for q, _ in sql) if batch else sql
+    for attempt in range(PG_EXEC_RETRIES + 1):
+        with pg_conn(pool) as conn:
+            if conn is None:
+                return None
+            conn.autocommit = False
+            cur = conn.cursor()
+            committing = False
+            t0 = time.time()
             try:
-                cur.close()
-            except Exception:
-                pass
+                if batch:
+                    # psycopg2 không có pipeline mode → gắn tham số phía client, nối thành 1 lệnh gửi đi
+                    cur.execute(b";\n".join(
+                        cur.mogrify(q, p) if p is not None else q.encode() for q, p in sql
+                    ))
+                else:
+                    cur.execute(sql, params or ())
+                out = None
+                if fetchone:
+                    out = cur.fetchone()
+                elif fetchall:
+                    out = cur.fetchall()
+                committing = True
+                conn.commit()
+                _pg_record(label, t0, cur.rowcount)
+                return out
+            except Exception as e:
+                _pg_record(label, t0, 0, e)
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                dprint(f"PG error: {e}")
+                if conn.closed:
+                    # Connection chết → pool bỏ connection này khi trả lại.
+                    # Chết trước commit → transaction chưa ghi gì, retry trên connection mới an toàn.
+                    # Chết lúc commit → không biết đã ghi chưa, KHÔNG retry (tránh trừ/cộng tiền 2 lần).
+                    if not committing and attempt < PG_EXEC_RETRIES:
+                        dprint("PG connection lost before commit → retry on fresh connection")
+                        continue
+                    raise PgUnavailable(f"PG connection lost: {e}") from e
+                if strict:
+                    raise PgQueryError(f"PG query failed: {e}") from e
+                return None
+            finally:
+                try:
+                    cur.close()
+                except Exception:
+                    pass
+
+# Đổi số dư + ghi sổ cái trong cùng 1 transaction (1 round trip)
+# - Khoá dòng ví, key đã có trong sổ → không làm gì (retry = no-op), trả số dư hiện tại
+# - p_strict: trừ tiền, không đủ (tính cả tiền đang hold) → new_balance NULL, old = số dư khả dụng;
+#   ngược lại tự tạo ví và chặn số dư âm
+SQL_CREATE_WALLET_APPLY = """
+CREATE OR REPLACE FUNCTION wallet_apply(
+    p_tele_id BIGINT, p_delta BIGINT, p_kind TEXT, p_key TEXT, p_note TEXT, p_strict BOOLEAN
+) RETURNS TABLE (old_balance BIGINT, new_balance BIGINT, applied BOOLEAN)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_old BIGINT;
+    v_new BIGINT;
+    v_held BIGINT;
+BEGIN
+    SELECT w.balance INTO v_old FROM wallet w WHERE w.tele_id = p_tele_id FOR UPDATE;
+    IF NOT FOUND THEN
+        IF p_strict THEN
+            RETURN QUERY SELECT NULL::BIGINT, NULL::BIGINT, FALSE;
+            RETURN;
+        END IF;
+        INSERT INTO wallet (tele_id, username, balance, status, notes, gift)
+        VALUES (p_tele_id, '', 0, 'new', 'Chưa kích hoạt', '')
+        ON CONFLICT (tele_id) DO NOTHING;
+        SELECT w.balance INTO v_old FROM wallet w WHERE w.tele_id = p_tele_id FOR UPDATE;
+    END IF;
+
+    IF p_key IS NOT NULL AND EXISTS (SELECT 1 FROM wallet_ledger l WHERE l.idem_key = p_key) THEN
+        RETURN QUERY SELECT v_old, v_old, FALSE;
+        RETURN;
+    END IF;
+
+    IF p_strict THEN
+        -- Tiền đang bị giữ (hold còn hạn) không được dùng cho lệnh trừ khác
+        SELECT COALESCE(SUM(h.amount), 0) INTO v_held FROM wallet_hold h
+        WHERE h.tele_id = p_tele_id AND h.status = 'active' AND h.expires_at > NOW();
+        IF v_old - v_held + p_delta < 0 THEN
+            RETURN QUERY SELECT v_old - v_held, NULL::BIGINT, FALSE;
+            RETURN;
+        END IF;
+    END IF;
+
+    v_new := GREATEST(v_old + p_delta, 0);
+    UPDATE wallet SET balance = v_new, updated_at = NOW() WHERE tele_id = p_tele_id;
+    INSERT INTO wallet_ledger (tele_id, kind, amount, balance_after, idem_key, note)
+    VALUES (p_tele_id, p_kind, v_new - v_old, v_new, p_key, p_note);
+    RETURN QUERY SELECT v_old, v_new, TRUE;
+END
+$$;
+"""
+
+# Giữ tiền (hold): chưa trừ số dư, chỉ giảm số dư khả dụng = balance - hold còn hạn.
+# Process chết giữa chừng → hold tự hết hạn, không cần hoàn tiền.
+# params: (tele_id, amount, idem_key, ttl_seconds) → (hold_id | NULL nếu không đủ, available)
+SQL_CREATE_HOLD_PLACE = """
+CREATE OR REPLACE FUNCTION wallet_hold_place(
+    p_tele_id BIGINT, p_amount BIGINT, p_key TEXT, p_ttl INTEGER
+) RETURNS TABLE (hold_id BIGINT, available BIGINT)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_bal BIGINT;
+    v_held BIGINT;
+    v_id BIGINT;
+BEGIN
+    SELECT w.balance INTO v_bal FROM wallet w WHERE w.tele_id = p_tele_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT NULL::BIGINT, 0::BIGINT;
+        RETURN;
+    END IF;
+
+    UPDATE wallet_hold h SET status = 'expired', settled_at = NOW()
+    WHERE h.tele_id = p_tele_id AND h.status = 'active' AND h.expires_at <= NOW();
+
+    SELECT COALESCE(SUM(h.amount), 0) INTO v_held FROM wallet_hold h
+    WHERE h.tele_id = p_tele_id AND h.status = 'active';
+
+    IF p_key IS NOT NULL THEN
+        SELECT h.id INTO v_id FROM wallet_hold h WHERE h.idem_key = p_key;
+        IF FOUND THEN
+            RETURN QUERY SELECT v_id, v_bal - v_held;
+            RETURN;
+        END IF;
+    END IF;
+
+    IF v_bal - v_held < p_amount THEN
+        RETURN QUERY SELECT NULL::BIGINT, v_bal - v_held;
+        RETURN;
+    END IF;
+
+    INSERT INTO wallet_hold (tele_id, amount, idem_key, expires_at)
+    VALUES (p_tele_id, p_amount, p_key, NOW() + make_interval(secs => p_ttl))
+    RETURNING id INTO v_id;
+    RETURN QUERY SELECT v_id, v_bal - v_held - p_amount;
+END
+$$;
+"""
+
+# Settle 1 lần: trừ đúng p_capture (≤ amount) + ghi sổ cái, phần còn lại tự nhả.
+# Hold đã settle / đã hết hạn bị dọn → applied FALSE, không trừ lần 2.
+# params: (hold_id, capture, kind, idem_key, note) → (owner_id, new_balance, applied)
+SQL_CREATE_HOLD_SETTLE = """
+CREATE OR REPLACE FUNCTION wallet_hold_settle(
+    p_hold_id BIGINT, p_capture BIGINT, p_kind TEXT, p_key TEXT, p_note TEXT
+) RETURNS TABLE (owner_id BIGINT, new_balance BIGINT, applied BOOLEAN)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_tele BIGINT;
+    v_amount BIGINT;
+    v_status TEXT;
+    v_bal BIGINT;
+    v_capture BIGINT;
+BEGIN
+    SELECT h.tele_id INTO v_tele FROM wallet_hold h WHERE h.id = p_hold_id;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT NULL::BIGINT, NULL::BIGINT, FALSE;
+        RETURN;
+    END IF;
+
+    -- Khoá ví trước rồi mới tới hold (cùng thứ tự với wallet_hold_place)
+    SELECT w.balance INTO v_bal FROM wallet w WHERE w.tele_id = v_tele FOR UPDATE;
+    SELECT h.amount, h.status INTO v_amount, v_status FROM wallet_hold h WHERE h.id = p_hold_id FOR UPDATE;
+    IF v_status <> 'active' THEN
+        RETURN QUERY SELECT v_tele, v_bal, FALSE;
+        RETURN;
+    END IF;
+
+    v_capture := LEAST(GREATEST(p_capture, 0), v_amount);
+    UPDATE wallet_hold h
+    SET status = CASE WHEN v_capture > 0 THEN 'captured' ELSE 'released' END,
+        captured = v_capture, settled_at = NOW()
+    WHERE h.id = p_hold_id;
+
+    IF v_capture > 0 THEN
+        v_bal := GREATEST(v_bal - v_capture, 0);
+        UPDATE wallet w SET balance = v_bal, updated_at = NOW() WHERE w.tele_id = v_tele;
+        INSERT INTO wallet_ledger (tele_id, kind, amount, balance_after, idem_key, note)
+        VALUES (v_tele, p_kind, -v_capture, v_bal, COALESCE(p_key, 'hold:' || p_hold_id), p_note);
+    END IF;
+    RETURN QUERY SELECT v_tele, v_bal, TRUE;
+END
+$$;
+"""
+
+# Nhiều worker khởi động cùng lúc → CREATE OR REPLACE FUNCTION song song có thể lỗi
+# ("tuple concurrently updated") → khoá advisory trong transaction, worker sau chờ worker trước
+PG_INIT_LOCK_ID = 7_403_311_001
 
 def pg_init_tables():
-    """Tạo bảng ví + bảng chống nạp trùng (tx_id)"""
+    """Tạo bảng ví + bảng chống nạp trùng (tx_id) - toàn bộ DDL gửi 1 round trip"""
     if PG_POOL is None:
         return
-    pg_exec("""
+    ddl = [("SELECT pg_advisory_xact_lock(%s)", (PG_INIT_LOCK_ID,))]
+    ddl.append("""
     CREATE TABLE IF NOT EXISTS wallet (
         tele_id BIGINT PRIMARY KEY,
         username TEXT,
@@ -155,7 +731,7 @@ def pg_init_tables():
         updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
     );
     """)
-    pg_exec("""
+    ddl.append("""
     CREATE TABLE IF NOT EXISTS processed_tx (
         tx_id TEXT PRIMARY KEY,
         tele_id BIGINT NOT NULL,
@@ -163,6 +739,57 @@ def pg_init_tables():
         created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
     );
     """)
+    # Sổ cái ví: mọi lần cộng / trừ / hoàn / tặng, idem_key chống áp dụng 2 lần
+    ddl.append("""
+    CREATE TABLE IF NOT EXISTS wallet_ledger (
+        id BIGSERIAL PRIMARY KEY,
+        tele_id BIGINT NOT NULL,
+        kind TEXT NOT NULL,
+        amount BIGINT NOT NULL,
+        balance_after BIGINT NOT NULL,
+        idem_key TEXT UNIQUE,
+        note TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    CREATE INDEX IF NOT EXISTS wallet_ledger_tele_created_idx ON wallet_ledger (tele_id, created_at);
+    CREATE INDEX IF NOT EXISTS wallet_ledger_created_idx ON wallet_ledger (created_at);
+    """)
+    # Giữ tiền cho lượt mua nhiều cookie (hold → capture / release 1 lần)
+    ddl.append("""
+    CREATE TABLE IF NOT EXISTS wallet_hold (
+        id BIGSERIAL PRIMARY KEY,
+        tele_id BIGINT NOT NULL,
+        amount BIGINT NOT NULL,
+        captured BIGINT NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'active',
+        idem_key TEXT UNIQUE,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        expires_at TIMESTAMPTZ NOT NULL,
+        settled_at TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS wallet_hold_active_idx ON wallet_hold (tele_id) WHERE status = 'active';
+    """)
+    ddl.append(SQL_CREATE_WALLET_APPLY)
+    ddl.append(SQL_CREATE_HOLD_PLACE)
+    ddl.append(SQL_CREATE_HOLD_SETTLE)
+    # Cột pass (mật khẩu Tool PC) - DB cũ tạo trước khi có cột này
+    ddl.append("ALTER TABLE wallet ADD COLUMN IF NOT EXISTS pass TEXT;")
+    # Checkpoint khi tắt process: QR đang watch, update chưa chạy, flow mua đang dở
+    ddl.append("""
+    CREATE TABLE IF NOT EXISTS runtime_checkpoint (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        tele_id BIGINT,
+        payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+    try:
+        pg_batch(ddl, strict=True)
+    except PgUnavailable as e:
+        # Lô DDL rollback cả → thiếu bảng / function → không chạy tiếp với schema dở
+        print(f"❌ pg_init_tables lỗi, schema chưa được tạo: {e}")
+        raise
 
 def _init_redis():
     global RDS
@@ -215,6 +842,7 @@ COOKIE_VALIDITY_DAYS = 7  # Cookie hiệu lực 7 ngày
 import threading
 qr_sessions = {}  # {session_id: {"user_id": user_id, "created": timestamp, "status": "waiting", "qr_image": base64}}
 qr_lock = threading.Lock()
+QR_WATCHERS = set()  # thread auto-watch đang chạy (shutdown chờ chúng dừng)
 
 # QR Failure Tracking (chống spam get QR)
 qr_failures = {}  # {user_id: {"count": int, "last_fail": timestamp}}
@@ -295,104 +923,78 @@ scope = [
 ]
 
 MAX_RETRIES = 3
-retry_count = 0
-connected = False
-
-while retry_count < MAX_RETRIES and not connected:
-    try:
-        if not CREDS_JSON:
-            raise Exception("CREDS_JSON is empty")
 
-        print(f"🔄 Connecting to Google Sheets (attempt {retry_count + 1}/{MAX_RETRIES})...")
-        start_time = time.time()
+def connect_google_sheets():
+    """Kết nối Google Sheets (có retry). Chạy SAU fork - mỗi worker 1 kết nối riêng"""
+    global SHEET_READY, sh, ws_money, ws_voucher, ws_log, ws_nap_tien, ws_cookies
 
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
-            json.loads(CREDS_JSON),
-            scope
-        )
-        print(f"✅ Step 1: Credentials loaded ({time.time()-start_time:.2f}s)")
-
-        gc = gspread.authorize(creds)
-        print(f"✅ Step 2: Gspread authorized ({time.time()-start_time:.2f}s)")
-
-        sh = gc.open_by_key(SHEET_ID)
-        print(f"✅ Step 3: Sheet opened ({time.time()-start_time:.2f}s)")
-
-        ws_money   = sh.worksheet("Thanh Toan")
-        ws_voucher = sh.worksheet("VoucherStock")
-        ws_log     = sh.worksheet("Logs")
-        print(f"✅ Step 4: Core worksheets loaded ({time.time()-start_time:.2f}s)")
+    retry_count = 0
+    connected = False
 
+    while retry_count < MAX_RETRIES and not connected:
         try:
-            ws_nap_tien = sh.worksheet("Nap Tien")
-            print(f"✅ Step 5: Nap Tien loaded ({time.time()-start_time:.2f}s)")
-        except Exception as e:
-            ws_nap_tien = None
-            print(f"⚠️ Nap Tien tab not found: {e}")
+            if not CREDS_JSON:
+                raise Exception("CREDS_JSON is empty")
 
-        # ✅ Load tab Cookie cho chức năng Check Voucher
-        try:
-            ws_cookies = sh.worksheet("Cookie")
-            print(f"✅ Step 6: Cookie tab loaded ({time.time()-start_time:.2f}s)")
-        except Exception as e:
-            ws_cookies = None
-            print(f"⚠️ Cookie tab not found: {e}")
+            print(f"🔄 Connecting to Google Sheets (attempt {retry_count + 1}/{MAX_RETRIES})...")
+            start_time = time.time()
 
-        SHEET_READY = True
-        connected = True
-        print("=" * 60)
-        print("✅ ✅ ✅ GOOGLE SHEETS CONNECTED SUCCESSFULLY!")
-        print("=" * 60)
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(
+                json.loads(CREDS_JSON),
+                scope
+            )
+            print(f"✅ Step 1: Credentials loaded ({time.time()-start_time:.2f}s)")
 
-    except Exception as e:
-        retry_count += 1
-        wait_time = 2 ** retry_count
+            gc = gspread.authorize(creds)
+            print(f"✅ Step 2: Gspread authorized ({time.time()-start_time:.2f}s)")
 
-        print("=" * 60)
-        print(f"❌ Connection failed (attempt {retry_count}/{MAX_RETRIES})")
-        print(f"❌ Error: {str(e)}")
-        print(f"❌ Error type: {type(e).__name__}")
+            sh = gc.open_by_key(SHEET_ID)
+            print(f"✅ Step 3: Sheet opened ({time.time()-start_time:.2f}s)")
 
-        if retry_count < MAX_RETRIES:
-            print(f"⏳ Retrying in {wait_time}s...")
-            time.sleep(wait_time)
-        else:
-            print("❌ ❌ ❌ ALL RETRIES FAILED - SHEET_READY = False")
-            import traceback
-            traceback.print_exc()
-            print("=" * 60)
-            SHEET_READY = False
+            ws_money   = sh.worksheet("Thanh Toan")
+            ws_voucher = sh.worksheet("VoucherStock")
+            ws_log     = sh.worksheet("Logs")
+            print(f"✅ Step 4: Core worksheets loaded ({time.time()-start_time:.2f}s)")
 
-# =========================================================
-# ✅ Init PostgreSQL + Redis — LUÔN chạy, không phụ thuộc Sheet
-# =========================================================
-print("🔄 Initializing PostgreSQL + Redis...")
-system_init_pg_redis()
+            try:
+                ws_nap_tien = sh.worksheet("Nap Tien")
+                print(f"✅ Step 5: Nap Tien loaded ({time.time()-start_time:.2f}s)")
+            except Exception as e:
+                ws_nap_tien = None
+                print(f"⚠️ Nap Tien tab not found: {e}")
 
-# =========================================================
-# 🔥 PRELOAD USERS + ROW CACHE (chạy 1 lần khi khởi động)
-# =========================================================
-if SHEET_READY:
-    print("🔄 Preloading users + row numbers into cache...")
-    try:
-        all_users = ws_money.get_all_values()
-        preload_count = 0
+            # ✅ Load tab Cookie cho chức năng Check Voucher
+            try:
+                ws_cookies = sh.worksheet("Cookie")
+                print(f"✅ Step 6: Cookie tab loaded ({time.time()-start_time:.2f}s)")
+            except Exception as e:
+                ws_cookies = None
+                print(f"⚠️ Cookie tab not found: {e}")
 
-        for idx, row in enumerate(all_users[1:], start=2):  # start=2 vì header ở row 1
-            if len(row) >= 1 and row[0]:
-                try:
-                    user_id = int(row[0])
+            SHEET_READY = True
+            connected = True
+            print("=" * 60)
+            print("✅ ✅ ✅ GOOGLE SHEETS CONNECTED SUCCESSFULLY!")
+            print("=" * 60)
 
-                    # ✅ CACHE ROW NUMBER sẽ được khai báo sau
-                    # cache_user_row(user_id, idx)
-                    preload_count += 1
-                except Exception:
-                    continue
+        except Exception as e:
+            retry_count += 1
+            wait_time = 2 ** retry_count
 
-        print(f"✅ Will preload {preload_count} users into cache")
+            print("=" * 60)
+            print(f"❌ Connection failed (attempt {retry_count}/{MAX_RETRIES})")
+            print(f"❌ Error: {str(e)}")
+            print(f"❌ Error type: {type(e).__name__}")
 
-    except Exception as e:
-        print(f"⚠️ Preload failed (non-critical): {e}")
+            if retry_count < MAX_RETRIES:
+                print(f"⏳ Retrying in {wait_time}s...")
+                time.sleep(wait_time)
+            else:
+                print("❌ ❌ ❌ ALL RETRIES FAILED - SHEET_READY = False")
+                import traceback
+                traceback.print_exc()
+                print("=" * 60)
+                SHEET_READY = False
 
 # =========================================================
 # STATE (GLOBAL)
@@ -452,22 +1054,55 @@ BROADCAST_USER_CACHE_TTL = 300  # 5 phút
 LAST_BROADCAST_TIME = None
 BROADCAST_COOLDOWN = 60
 
-# ✅ MESSAGE DEDUPLICATION
-PROCESSED_MESSAGES = set()
-MAX_PROCESSED_MESSAGES = 1000
+# ✅ UPDATE + MESSAGE DEDUPLICATION (2 tầng) - Tránh Telegram resend khi Sheet lag
+# Tầng 1: LRU trong process (O(1), không tốn network)
+# Tầng 2: Redis SET NX EX → đúng cả khi chạy nhiều worker / consumer
+DEDUP_LRU_SIZE = int(os.getenv("DEDUP_LRU_SIZE", "5000"))
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "86400"))  # Telegram retry webhook tối đa ~24h
+
+class LruSet:
+    """Set có giới hạn, tự drop key cũ nhất. add/discard/contains đều O(1)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Returns: True nếu key mới, False nếu đã có"""
+        with self._lock:
+            if key in self._d:
+                self._d.move_to_end(key)
+                return False
+            self._d[key] = None
+            if len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._d.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._d
 
-# ✅ UPDATE_ID DEDUPLICATION - Tránh Telegram resend khi Sheet lag
-# Dùng deque thay vì set để xóa theo thứ tự FIFO
-PROCESSED_UPDATE_IDS = deque(maxlen=2000)  # Auto-drop oldest when full
+    def __len__(self):
+        return len(self._d)
+
+PROCESSED_UPDATE_KEYS = LruSet(DEDUP_LRU_SIZE)
+DEDUP_STATS = {"dup_local": 0, "dup_redis": 0, "redis_errors": 0}
 
 # ✅ BROADCAST LOCK
 IS_BROADCASTING = False
 
 # =========================================================
-# 🔥 CHẠY PRELOAD THỰC SỰ (SAU KHI ĐỊNH NGHĨA CACHE FUNCTIONS)
+# 🔥 PRELOAD USERS + ROW CACHE (mỗi worker 1 lần, sau fork)
 # =========================================================
-if SHEET_READY:
-    print("🔄 Actually preloading users into ROW_CACHE...")
+def preload_user_rows():
+    if not SHEET_READY:
+        return
+    print("🔄 Preloading users into ROW_CACHE...")
     try:
         all_users = ws_money.get_all_values()
         preload_count = 0
@@ -487,6 +1122,54 @@ if SHEET_READY:
     except Exception as e:
         print(f"⚠️ Preload failed (non-critical): {e}")
 
+# =========================================================
+# 🔁 RUNTIME INIT - FORK-SAFE
+# =========================================================
+# Import module (pha preload) chỉ parse config, định nghĩa hàm / bảng route / template
+# → an toàn để gunicorn --preload chia sẻ copy-on-write giữa các worker.
+# Mọi thứ giữ socket / thread (Sheets, PG_POOL, RDS, row cache) mở trong init_runtime(),
+# chạy 1 lần cho mỗi process (theo pid). Pool lane (BoundedWorkQueue) tự start thread sau fork.
+# BOT_DEFER_INIT=1 (gunicorn.conf.py đặt) → không init lúc import, đợi post_fork.
+BOT_DEFER_INIT = os.getenv("BOT_DEFER_INIT", "0").strip() in ("1", "true", "True")
+RUNTIME_PID = None
+RUNTIME_LOCK = threading.Lock()
+
+def init_runtime():
+    """Mở kết nối Sheets / PostgreSQL / Redis cho process hiện tại"""
+    global RUNTIME_PID, PG_POOL, PG_READ_POOL, RDS
+    with RUNTIME_LOCK:
+        pid = os.getpid()
+        if RUNTIME_PID == pid:
+            return
+
+        # Kế thừa từ process cha (nếu có) → bỏ tham chiếu, không dùng chung socket
+        PG_POOL = None
+        PG_READ_POOL = None
+        RDS = None
+
+        connect_google_sheets()
+
+        # ✅ Init PostgreSQL + Redis — LUÔN chạy, không phụ thuộc Sheet
+        print("🔄 Initializing PostgreSQL + Redis...")
+        system_init_pg_redis()
+
+        preload_user_rows()
+        RUNTIME_PID = pid
+        start_cache_bus()
+        print(f"✅ Runtime ready (pid={pid})")
+
+    # Update / QR / flow dở từ process trước (redeploy)
+    if PG_POOL is not None:
+        resume_checkpoints()
+
+def ensure_runtime():
+    if RUNTIME_PID != os.getpid():
+        init_runtime()
+
+@app.before_request
+def _ensure_runtime_before_request():
+    ensure_runtime()
+
 # =========================================================
 # 🔥 VOUCHER STOCK CACHE - GIẢM 90% CALLS KHI MUA VOUCHER
 # =========================================================
@@ -494,11 +1177,12 @@ VOUCHER_STOCK_CACHE = {
     "rows": None,
     "ts": 0
 }
-VOUCHER_STOCK_TTL = 60  # 60 giây
+# Admin sửa Sheet + /update → bus xoá cache mọi worker, nên TTL để dài được
+VOUCHER_STOCK_TTL = int(os.getenv("VOUCHER_STOCK_TTL", "300"))
 
 def get_voucher_stock_cached():
     """
-    ✅ Cache voucher stock 60s để tránh đốt Sheet
+    ✅ Cache voucher stock (VOUCHER_STOCK_TTL) để tránh đốt Sheet
     Returns: list of dict
     """
     global VOUCHER_STOCK_CACHE
@@ -542,6 +1226,7 @@ def tg_send(chat_id, text, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
 
+    flow_touch()
     try:
         requests.post(f"{BASE_URL}/sendMessage", data=payload, timeout=15)
     except Exception as e:
@@ -554,6 +1239,7 @@ def tg_send_photo(chat_id, photo, caption=None, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
 
+    flow_touch()
     try:
         # ✅ Nếu là URL (nạp tiền / ảnh online) → gửi thẳng
         if isinstance(photo, str) and (photo.startswith("http://") or photo.startswith("https://")):
@@ -607,6 +1293,7 @@ def tg_edit_message(chat_id, message_id, text, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
 
+    flow_touch()
     try:
         requests.post(f"{BASE_URL}/editMessageText", data=payload, timeout=10)
     except Exception as e:
@@ -679,13 +1366,10 @@ def format_currency_check(value):
     return "{:,.0f}đ".format(value).replace(",", ".")
 
 
-def check_one_voucher(voucher, cookie):
-    """
-    Check 1 voucher và trả về thông tin formatted
-    Trả về: (success: bool, message: str)
-    """
-    url = "https://shopee.vn/api/v2/voucher_wallet/get_voucher_detail"
-    
+CHECK_VOUCHER_URL = "https://shopee.vn/api/v2/voucher_wallet/get_voucher_detail"
+
+def build_check_voucher_request(voucher, cookie):
+    """Headers + payload cho API get_voucher_detail (dùng chung sync/async)"""
     headers = {
         'User-Agent': 'Android app Shopee appver=28320 app_type=1',
         'Cookie': cookie,
@@ -701,11 +1385,27 @@ def check_one_voucher(voucher, cookie):
         "source": "0", 
         "addition": []
     }
+    return headers, payload
+
+def check_one_voucher(voucher, cookie):
+    """
+    Check 1 voucher và trả về thông tin formatted
+    Trả về: (success: bool, message: str)
+    """
+    headers, payload = build_check_voucher_request(voucher, cookie)
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        data = response.json()
-        
+        response = requests.post(CHECK_VOUCHER_URL, headers=headers, json=payload, timeout=10)
+        return format_voucher_detail(voucher, response.json())
+    except Exception as e:
+        return format_check_voucher_error(voucher, e)
+
+def format_voucher_detail(voucher, data):
+    """
+    Format response get_voucher_detail
+    Trả về: (success: bool, message: str)
+    """
+    try:
         if data.get('error') == 0:
             info = data['data']['voucher_basic_info']
             
@@ -762,9 +1462,12 @@ def check_one_voucher(voucher, cookie):
             return (False, msg)
 
     except Exception as e:
-        display_name = voucher.get('display_name', voucher['code'])
-        msg = f"❌ {display_name}: Lỗi kết nối ({str(e)[:30]})\n" + "─" * 30
-        return (False, msg)
+        return format_check_voucher_error(voucher, e)
+
+def format_check_voucher_error(voucher, e):
+    display_name = voucher.get('display_name', voucher['code'])
+    msg = f"❌ {display_name}: Lỗi kết nối ({str(e)[:30]})\n" + "─" * 30
+    return (False, msg)
 
 
 def get_vouchers_from_stock():
@@ -853,40 +1556,47 @@ def handle_check_voucher(user_id, username):
         time.sleep(0.3)  # Tránh spam API
 
     # 4. Gửi tất cả kết quả trong 1 message duy nhất
-    final_message = "\n\n".join(results)
-    
-    # Split nếu quá dài (Telegram limit 4096 chars)
-    if len(final_message) > 4000:
-        # Chia thành nhiều message nếu quá dài
-        chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for result in results:
-            result_length = len(result) + 2  # +2 cho \n\n
-            if current_length + result_length > 4000:
-                chunks.append("\n\n".join(current_chunk))
-                current_chunk = [result]
-                current_length = result_length
-            else:
-                current_chunk.append(result)
-                current_length += result_length
-        
-        if current_chunk:
-            chunks.append("\n\n".join(current_chunk))
-        
+    chunks = chunk_check_voucher_results(results)
+    if len(chunks) > 1:
         # Gửi từng chunk
         for chunk in chunks:
             tg_send(user_id, chunk)
             time.sleep(0.5)
     else:
         # Gửi 1 message duy nhất
-        tg_send(user_id, final_message, build_main_keyboard())
+        tg_send(user_id, chunks[0], build_main_keyboard())
 
     # 5. Log (không hiển thị tổng kết cho user)
+    log_check_voucher(user_id, username, len(vouchers), results)
+
+def chunk_check_voucher_results(results, limit=4000):
+    """Ghép kết quả check voucher, chia nhiều message nếu quá dài (Telegram limit 4096 chars)"""
+    final_message = "\n\n".join(results)
+    if len(final_message) <= limit:
+        return [final_message]
+
+    chunks = []
+    current_chunk = []
+    current_length = 0
+
+    for result in results:
+        result_length = len(result) + 2  # +2 cho \n\n
+        if current_length + result_length > limit:
+            chunks.append("\n\n".join(current_chunk))
+            current_chunk = [result]
+            current_length = result_length
+        else:
+            current_chunk.append(result)
+            current_length += result_length
+
+    if current_chunk:
+        chunks.append("\n\n".join(current_chunk))
+    return chunks
+
+def log_check_voucher(user_id, username, num_vouchers, results):
     success_count = sum(1 for r in results if not r.startswith("❌"))
     fail_count = len(results) - success_count
-    
+
     if SHEET_READY and ws_log:
         try:
             ws_log.append_row([
@@ -895,7 +1605,7 @@ def handle_check_voucher(user_id, username):
                 username,
                 "CHECK_VOUCHER",
                 "0",
-                f"Checked {len(vouchers)} vouchers: {success_count} OK, {fail_count} fail"
+                f"Checked {num_vouchers} vouchers: {success_count} OK, {fail_count} fail"
             ])
         except Exception as e:
             dprint(f"Log error: {e}")
@@ -937,6 +1647,7 @@ def create_qr_session(user_id):
     url = f"{QR_API_BASE}/api/qr/create"
     payload = {"user_id": user_id}
     
+    flow_touch()
     dprint(f"[QR CREATE] URL: {url}")
     dprint(f"[QR CREATE] Payload: {payload}")
     
@@ -1150,6 +1861,8 @@ def track_qr_failure(user_id, username, chat_id):
             # Ban user trong PostgreSQL
             try:
                 pg_exec("UPDATE wallet SET status='BANNED_QR_SPAM', updated_at=NOW() WHERE tele_id=%s", (int(user_id),))
+                wallet_cache_invalidate(user_id)
+                publish_invalidation("user", user_id=int(user_id))
 
                 # Mirror Sheet (fire-and-forget)
                 if SHEET_READY:
@@ -1201,13 +1914,13 @@ def get_user_cookie(user_id):
             return None
         
         return cookie_data["cookie"]
-def handle_get_cookie_qr(chat_id, user_id, username):
+def handle_get_cookie_qr(chat_id, user_id, username, uctx=None):
     """
     Xử lý lệnh Get Cookie QR
     ✅ TỰ ĐỘNG WATCH - Không cần bấm nút
     """
     # Check user tồn tại
-    exists, balance, status = get_user_data(user_id)
+    exists = (uctx or load_user_context(user_id)).exists
     if not exists:
         send_message(chat_id, "❌ Vui lòng /start trước khi dùng chức năng này")
         return
@@ -1258,34 +1971,50 @@ def handle_get_cookie_qr(chat_id, user_id, username):
             qr_sessions[session_id]["username"] = username
 
     # ✅ START AUTO-WATCH THREAD
-    watch_thread = threading.Thread(
-        target=auto_watch_qr_and_send_cookie,
-        args=(session_id, chat_id, user_id, username),
-        daemon=True
-    )
-    watch_thread.start()
+    start_qr_watcher(session_id, chat_id, user_id, username)
     
     dprint(f"[QR] Auto-watch started for session {session_id}")
 
+def start_qr_watcher(session_id, chat_id, user_id, username, started_at=None):
+    """Chạy auto_watch trên thread riêng, đăng ký vào QR_WATCHERS để shutdown chờ được"""
+    def _run():
+        try:
+            auto_watch_qr_and_send_cookie(session_id, chat_id, user_id, username, started_at)
+        finally:
+            with qr_lock:
+                QR_WATCHERS.discard(threading.current_thread())
+
+    watch_thread = threading.Thread(target=_run, name=f"qr-watch-{session_id}", daemon=True)
+    with qr_lock:
+        QR_WATCHERS.add(watch_thread)
+    watch_thread.start()
+
 # =========================================================
 # 2. AUTO WATCH QR - TỰ ĐỘNG CHECK VÀ GỬI COOKIE
 # =========================================================
-def auto_watch_qr_and_send_cookie(session_id, chat_id, user_id, username):
+def auto_watch_qr_and_send_cookie(session_id, chat_id, user_id, username, started_at=None):
     """
     ✅ TỰ ĐỘNG theo dõi QR và gửi cookie khi quét xong
     ✅ Không cần user bấm nút
+    - started_at: thời điểm tạo QR (khi resume từ checkpoint → chỉ watch phần thời gian còn lại)
     """
     dprint(f"[QR AUTO] Started watching session {session_id} for user {user_id}")
     
     # Delay 2s để user kịp thấy QR
-    time.sleep(2)
+    if started_at is None:
+        time.sleep(2)
 
-    start_time = time.time()
+    start_time = started_at or time.time()
     check_count = 0
     last_status = None
     
     while time.time() - start_time < QR_TIMEOUT:
         check_count += 1
+
+        # ✅ PROCESS ĐANG TẮT → dừng, session được checkpoint để process mới watch tiếp
+        if SHUTTING_DOWN.is_set():
+            dprint(f"[QR AUTO] Shutdown - leaving session {session_id} for checkpoint")
+            return
         
         # ✅ CHECK CANCELLED
         with qr_lock:
@@ -1325,7 +2054,21 @@ def auto_watch_qr_and_send_cookie(session_id, chat_id, user_id, username):
                 
                 # ✅ TRỪ 100Đ KHI GET QR THÀNH CÔNG
                 QR_FEE = 100  # Phí Get QR
-                success_deduct, new_balance = deduct_balance_atomic(user_id, QR_FEE)
+                try:
+                    success_deduct, new_balance = deduct_balance_atomic(
+                        user_id, QR_FEE, kind="qr_fee", key=f"qr:{session_id}:fee"
+                    )
+                except PgUnavailable as e:
+                    # Thread watcher không có handler update → tự báo bận, không báo "không đủ số dư"
+                    print(f"⚠️ [QR AUTO] PG lỗi khi trừ phí {user_id}: {e}")
+                    send_message(
+                        chat_id,
+                        "⚠️ <b>Hệ thống đang bận</b>\nChưa trừ phí, vui lòng Get QR lại sau ít giây.",
+                        reply_markup=build_main_keyboard()
+                    )
+                    with qr_lock:
+                        qr_sessions.pop(session_id, None)
+                    return
                 
                 if not success_deduct:
                     # Không đủ tiền
@@ -1613,7 +2356,7 @@ def get_all_user_ids():
         if PG_POOL is not None:
             rows = pg_exec(
                 "SELECT tele_id FROM wallet WHERE status NOT IN ('banned', 'banned_qr_spam')",
-                fetchall=True
+                fetchall=True, read=True
             )
             if rows:
                 user_ids = [int(r[0]) for r in rows]
@@ -1786,6 +2529,7 @@ def check_broadcast_cooldown_from_sheet():
     return True, 0
 
 def log_row(user_id, username, action, value="", note=""):
+    flow_touch()
     if not SHEET_READY:
         return
     try:
@@ -1806,6 +2550,7 @@ def log_voucher_save(user_id, username, voucher_name, num_cookies, price, balanc
         balance_after: Số dư sau khi lưu
         status: Trạng thái (✅ hoặc ❌ + lỗi)
     """
+    flow_touch()
     if not SHEET_READY:
         return
     try:
@@ -1815,7 +2560,7 @@ def log_voucher_save(user_id, username, voucher_name, num_cookies, price, balanc
             username,
             f"SAVE_VOUCHER",
             f"{voucher_name} x{num_cookies}",
-            f"{status} | Price: {price:,}đ | Balance: {balance_after:,}đ"
+            f"{status} | Price: {price:,}đ | Balance: {fmt_balance(balance_after)}"
         ])
     except Exception as e:
         dprint(f"log_voucher_save error: {e}")
@@ -1888,70 +2633,295 @@ def track_error(user_id, username="", reason=""):
 
     return False
 
-def check_ban_status(user_id):
+# =========================================================
+# 👤 USER CONTEXT - 1 SELECT / UPDATE
+# =========================================================
+SQL_GET_USER_CONTEXT = """
+    SELECT balance, status, notes, gift, pass, username
+    FROM wallet WHERE tele_id=%s
+"""
+
+class UserContext:
     """
-    ✅ V7: Đọc ban status từ cột 'status' trong PostgreSQL.
-    - status = 'banned'     → Ban vĩnh viễn
-    - status = 'ban_1h'     → Ban 1h, check thời gian từ notes
-    - status = 'BANNED_QR_SPAM' → Ban QR spam (permanent)
+    Ảnh chụp dòng wallet của user, đọc 1 lần cho cả update.
+    Số dư được cập nhật lại từ RETURNING của lệnh cộng/trừ tiền, không SELECT lại.
     """
-    user_id = int(user_id)
-
-    if PG_POOL is None:
-        return {"banned": False}
-
-    r = pg_exec("SELECT status, notes FROM wallet WHERE tele_id=%s", (user_id,), fetchone=True)
-    if not r:
-        return {"banned": False}
+    __slots__ = ("user_id", "exists", "balance", "status", "notes", "gift", "password", "username")
+
+    def __init__(self, user_id, row=None):
+        self.user_id = int(user_id)
+        self.exists = row is not None
+        row = row or (0, "", "", "", "", "")
+        self.balance = int(row[0] or 0)
+        self.status = (row[1] or "").strip()
+        self.notes = (row[2] or "").strip()
+        self.gift = (row[3] or "").strip()
+        self.password = (row[4] or "").strip()
+        self.username = (row[5] or "").strip()
+
+    def as_wallet(self):
+        """(exists, balance, status) - cùng format với get_user_data()"""
+        return self.exists, self.balance, self.status
 
-    status = (r[0] or "").strip().lower()
-    notes  = (r[1] or "").strip()
+# =========================================================
+# ⚡ WALLET CACHE (REDIS) - ĐỌC VÍ / STATUS KHÔNG CHẠM PG
+# =========================================================
+# wallet:<tele_id> = hash các cột của SQL_GET_USER_CONTEXT (+ exists)
+# - Ghi ví → cập nhật balance từ RETURNING; đổi status / notes / pass → xoá key
+# - TTL ngắn: admin sửa tay trong DB tự hết hạn; /update xoá toàn bộ
+# - wallet:ver:<tele_id> tăng mỗi lần ghi → fill chỉ ghi khi version không đổi từ lúc đọc PG
+#   và key vẫn chưa có (không đè số dư mới hơn bằng dòng đọc cũ / replica lag)
+WALLET_CACHE_TTL = int(os.getenv("WALLET_CACHE_TTL", "30"))
+WALLET_CACHE_STATS = {"hit": 0, "miss": 0, "fill": 0, "fill_skip": 0, "invalidate": 0, "error": 0}
+_WALLET_CACHE_FIELDS = ("balance", "status", "notes", "gift", "pass", "username")
+
+# Chỉ cập nhật balance khi key đang có dòng ví thật; key "chưa có ví" → xoá (ví vừa được tạo)
+_LUA_WALLET_SET_BALANCE = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+local e = redis.call('HGET', KEYS[1], 'exists')
+if e == '1' then
+    redis.call('HSET', KEYS[1], 'balance', ARGV[1])
+elseif e then
+    redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
-    try:
-        # Ban vĩnh viễn
-        if status in ("banned", "banned_qr_spam"):
-            return {"banned": True, "type": "PERMANENT", "until": "Vĩnh viễn"}
+# ARGV[1] = version đọc trước khi query PG, ARGV[2] = TTL, ARGV[3..] = field, value...
+_LUA_WALLET_FILL = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+# Version phải sống lâu hơn 1 lần đọc PG; hết hạn giữa chừng → '' ≠ version cũ → bỏ fill (an toàn)
+_WALLET_VERSION_TTL = max(300, WALLET_CACHE_TTL * 2)
 
-        # Ban 1 giờ — thời gian lưu trong notes
-        if status == "ban_1h":
-            try:
-                ban_until_str = notes.split("BAN 1H:")[1].strip() if "BAN 1H:" in notes else ""
-                if ban_until_str:
-                    ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M")
-                    if now_datetime() < ban_until:
-                        return {"banned": True, "type": "1H", "until": ban_until_str}
-                    else:
-                        # hết hạn → reset status + notes
-                        pg_exec("UPDATE wallet SET status='active', notes='auto từ bot', updated_at=NOW() WHERE tele_id=%s", (user_id,))
-                        # mirror sheet (fire-and-forget)
-                        if SHEET_READY:
-                            try:
-                                row = get_user_row(user_id)
-                                if row:
-                                    ws_money.update_cell(row, 4, "active")
-                                    ws_money.update_cell(row, 6, "auto từ bot")
-                            except Exception:
-                                pass
-                        return {"banned": False}
-                else:
-                    # notes không có thời gian → treat as expired, reset
-                    pg_exec("UPDATE wallet SET status='active', updated_at=NOW() WHERE tele_id=%s", (user_id,))
-                    return {"banned": False}
-            except Exception:
-                return {"banned": False}
+def _wallet_cache_key(user_id):
+    return f"wallet:{int(user_id)}"
 
-        return {"banned": False}
+def _wallet_version_key(user_id):
+    return f"wallet:ver:{int(user_id)}"
 
+def wallet_cache_version(user_id):
+    """Version hiện tại ('' nếu chưa ghi gần đây) | None nếu không có cache / Redis lỗi → không fill"""
+    if RDS is None or WALLET_CACHE_TTL <= 0:
+        return None
+    try:
+        return RDS.get(_wallet_version_key(user_id)) or ""
     except Exception as e:
-        dprint("check_ban_status error:", e)
-        return {"banned": False}
-
-def notify_admin_spam(user_id, username, ban_type, error_count):
-    if not ADMIN_ID or ADMIN_ID == 0:
-        return
+        WALLET_CACHE_STATS["error"] += 1
+        dprint(f"wallet cache version error: {e}")
+        return None
 
+def wallet_cache_get(user_id):
+    """Returns: None (miss) | False (đã biết chưa có ví) | row như SQL_GET_USER_CONTEXT"""
+    if RDS is None or WALLET_CACHE_TTL <= 0:
+        return None
     try:
-        exists, balance, status = get_user_data(user_id)
+        h = RDS.hgetall(_wallet_cache_key(user_id))
+    except Exception as e:
+        WALLET_CACHE_STATS["error"] += 1
+        dprint(f"wallet cache get error: {e}")
+        return None
+    if not h:
+        WALLET_CACHE_STATS["miss"] += 1
+        return None
+    WALLET_CACHE_STATS["hit"] += 1
+    if h.get("exists") != "1":
+        return False
+    return tuple(h.get(f, "") for f in _WALLET_CACHE_FIELDS)
+
+def wallet_cache_fill(user_id, row, version):
+    """Ghi row vừa đọc vào cache - chỉ khi version chưa đổi và key chưa có (có lệnh ghi xen giữa → bỏ)"""
+    if RDS is None or WALLET_CACHE_TTL <= 0 or version is None:
+        return
+    if row:
+        mapping = {f: ("" if v is None else str(v)) for f, v in zip(_WALLET_CACHE_FIELDS, row)}
+        mapping["exists"] = "1"
+    else:
+        mapping = {"exists": "0"}
+    args = [version, WALLET_CACHE_TTL]
+    for f, v in mapping.items():
+        args += [f, v]
+    try:
+        if RDS.eval(_LUA_WALLET_FILL, 2, _wallet_cache_key(user_id), _wallet_version_key(user_id), *args):
+            WALLET_CACHE_STATS["fill"] += 1
+        else:
+            WALLET_CACHE_STATS["fill_skip"] += 1
+    except Exception as e:
+        WALLET_CACHE_STATS["error"] += 1
+        dprint(f"wallet cache fill error: {e}")
+
+def wallet_cache_set_balance(user_id, new_balance):
+    if RDS is None or WALLET_CACHE_TTL <= 0:
+        return
+    try:
+        RDS.eval(
+            _LUA_WALLET_SET_BALANCE, 2, _wallet_cache_key(user_id), _wallet_version_key(user_id),
+            int(new_balance), _WALLET_VERSION_TTL
+        )
+    except Exception as e:
+        WALLET_CACHE_STATS["error"] += 1
+        dprint(f"wallet cache set balance error: {e}")
+
+def wallet_cache_invalidate(user_id):
+    pg_note_write(user_id)  # mọi lệnh đổi status / notes / pass đều gọi hàm này
+    if RDS is None:
+        return
+    try:
+        pipe = RDS.pipeline(transaction=False)
+        pipe.incr(_wallet_version_key(user_id))
+        pipe.expire(_wallet_version_key(user_id), _WALLET_VERSION_TTL)
+        pipe.delete(_wallet_cache_key(user_id))
+        pipe.execute()
+        WALLET_CACHE_STATS["invalidate"] += 1
+    except Exception as e:
+        WALLET_CACHE_STATS["error"] += 1
+        dprint(f"wallet cache invalidate error: {e}")
+
+def wallet_cache_clear():
+    """Xoá toàn bộ wallet:* (admin /update) - trả về số key đã xoá"""
+    if RDS is None:
+        return 0
+    count = 0
+    try:
+        batch = []
+        for key in RDS.scan_iter(match="wallet:*", count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                count += RDS.delete(*batch)
+                batch = []
+        if batch:
+            count += RDS.delete(*batch)
+    except Exception as e:
+        WALLET_CACHE_STATS["error"] += 1
+        dprint(f"wallet cache clear error: {e}")
+    return count
+
+def format_wallet_cache_stats():
+    st = WALLET_CACHE_STATS
+    total = st["hit"] + st["miss"]
+    rate = f"{st['hit'] * 100 // total}%" if total else "-"
+    return (
+        f"• Hit/Miss: {st['hit']}/{st['miss']} ({rate}) | TTL: {WALLET_CACHE_TTL}s\n"
+        f"• Fill: {st['fill']} (bỏ qua {st['fill_skip']}) | Invalidate: {st['invalidate']} | Lỗi: {st['error']}"
+    )
+
+def load_user_context(user_id):
+    if PG_POOL is None:
+        return UserContext(user_id)
+    cached = wallet_cache_get(user_id)
+    if cached is not None:
+        return UserContext(user_id, cached or None)
+    # Version lấy TRƯỚC khi đọc PG: lệnh ghi nào xen giữa cũng làm fill bị bỏ
+    version = wallet_cache_version(user_id)
+    # strict: lỗi PG → raise; tới được fill thì row None = user thật sự chưa có ví
+    # (không cache "chưa có ví" từ 1 lỗi thoáng qua cho mọi worker suốt WALLET_CACHE_TTL)
+    row = pg_exec(SQL_GET_USER_CONTEXT, (int(user_id),), fetchone=True, read=True, user_id=user_id, strict=True)
+    wallet_cache_fill(user_id, row, version)
+    return UserContext(user_id, row)
+
+# UserContext của update đang chạy trên thread này (để lệnh ghi ví cập nhật lại số dư)
+_USER_CTX_LOCAL = threading.local()
+
+def bind_user_context(uctx):
+    _USER_CTX_LOCAL.uctx = uctx
+
+def refresh_user_balance(user_id, new_balance):
+    """Số dư mới (RETURNING của lệnh ghi ví) → UserContext đang chạy + cache Redis"""
+    pg_note_write(user_id)
+    wallet_cache_set_balance(user_id, new_balance)
+    uctx = getattr(_USER_CTX_LOCAL, "uctx", None)
+    if uctx is not None and uctx.user_id == int(user_id):
+        uctx.exists = True
+        uctx.balance = int(new_balance)
+
+def evaluate_ban(uctx, now=None):
+    """
+    Tính trạng thái ban từ UserContext, không đọc / ghi DB.
+    - status = 'banned' / 'banned_qr_spam' → Ban vĩnh viễn
+    - status = 'ban_1h'                    → Ban 1h, thời gian hết hạn trong notes ("BAN 1H: ...")
+    Returns: {"banned": bool, "type", "until"} + "expired": True nếu ban 1h đã hết hạn (cần reset)
+    """
+    status = uctx.status.lower()
+    notes = uctx.notes
+
+    # Ban vĩnh viễn
+    if status in ("banned", "banned_qr_spam"):
+        return {"banned": True, "type": "PERMANENT", "until": "Vĩnh viễn"}
+
+    # Ban 1 giờ — thời gian lưu trong notes
+    if status == "ban_1h":
+        ban_until_str = notes.split("BAN 1H:")[1].strip() if "BAN 1H:" in notes else ""
+        if not ban_until_str:
+            # notes không có thời gian → treat as expired, reset
+            return {"banned": False, "expired": True, "clear_notes": False}
+        try:
+            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M")
+        except Exception:
+            return {"banned": False}
+        if (now or now_datetime()) < ban_until:
+            return {"banned": True, "type": "1H", "until": ban_until_str}
+        return {"banned": False, "expired": True, "clear_notes": True}
+
+    return {"banned": False}
+
+def check_ban_status(user_id, uctx=None):
+    """
+    ✅ V7: Ban status từ cột 'status' trong PostgreSQL (qua UserContext).
+    Ban 1h hết hạn → reset status về active.
+    """
+    user_id = int(user_id)
+
+    if PG_POOL is None:
+        return {"banned": False}
+
+    try:
+        if uctx is None:
+            uctx = load_user_context(user_id)
+        if not uctx.exists:
+            return {"banned": False}
+
+        ban = evaluate_ban(uctx)
+        if ban.pop("expired", False):
+            if ban.pop("clear_notes", False):
+                # hết hạn → reset status + notes
+                pg_exec("UPDATE wallet SET status='active', notes='auto từ bot', updated_at=NOW() WHERE tele_id=%s", (user_id,))
+                uctx.notes = "auto từ bot"
+                # mirror sheet (fire-and-forget)
+                if SHEET_READY:
+                    try:
+                        row = get_user_row(user_id)
+                        if row:
+                            ws_money.update_cell(row, 4, "active")
+                            ws_money.update_cell(row, 6, "auto từ bot")
+                    except Exception:
+                        pass
+            else:
+                pg_exec("UPDATE wallet SET status='active', updated_at=NOW() WHERE tele_id=%s", (user_id,))
+            wallet_cache_invalidate(user_id)
+            uctx.status = "active"
+        return ban
+
+    except PgUnavailable:
+        raise
+    except Exception as e:
+        dprint("check_ban_status error:", e)
+        return {"banned": False}
+
+def notify_admin_spam(user_id, username, ban_type, error_count):
+    if not ADMIN_ID or ADMIN_ID == 0:
+        return
+
+    try:
+        exists, balance, status = get_user_data(user_id)
 
         if ban_type == "PERMANENT":
             ban_text = "🔨 Hành động: Ban vĩnh viễn"
@@ -2009,6 +2979,8 @@ def apply_ban(user_id, ban_type):
         if PG_POOL is not None:
             pg_exec("UPDATE wallet SET status=%s, notes=%s, updated_at=NOW() WHERE tele_id=%s",
                     (new_status, note, user_id))
+            wallet_cache_invalidate(user_id)
+            publish_invalidation("user", user_id=user_id)
 
         # ✅ mirror sheet (fire-and-forget)
         if SHEET_READY:
@@ -2056,6 +3028,76 @@ def get_user_row(user_id):
         dprint(f"   Traceback: {traceback.format_exc()}")
         return None
 
+# =========================================================
+# WALLET SQL (dùng chung cho bản sync psycopg2 và bản async asyncpg)
+# =========================================================
+# Chỉ ghi khi tạo mới hoặc username thật sự đổi (không bump updated_at vô ích)
+# WHERE sai → ON CONFLICT không trả dòng → bọc CTE để luôn có 1 dòng (inserted)
+SQL_ENSURE_USER = """
+    WITH up AS (
+        INSERT INTO wallet (tele_id, username, balance, status, notes, gift)
+        VALUES (%s, %s, 0, 'new', 'Chưa kích hoạt', '')
+        ON CONFLICT (tele_id) DO UPDATE SET
+            username = EXCLUDED.username,
+            updated_at = NOW()
+        WHERE EXCLUDED.username <> '' AND wallet.username IS DISTINCT FROM EXCLUDED.username
+        RETURNING (xmax = 0) AS inserted, TRUE AS changed
+    )
+    SELECT COALESCE((SELECT inserted FROM up), FALSE), EXISTS (SELECT 1 FROM up)
+"""
+
+SQL_GET_USER_DATA = "SELECT balance, status FROM wallet WHERE tele_id=%s"
+
+SQL_GET_BALANCE = "SELECT balance FROM wallet WHERE tele_id=%s"
+
+# Cộng / hoàn tiền qua wallet_apply (tự tạo ví, ghi sổ cái)
+# params: (tele_id, delta, kind, idem_key, note) → (old_balance, new_balance, applied)
+SQL_UPDATE_BALANCE = "SELECT old_balance, new_balance, applied FROM wallet_apply(%s, %s, %s, %s, %s, FALSE)"
+
+# Trừ tiền: params (tele_id, -amount, kind, idem_key, note)
+# Luôn trả 1 dòng: old NULL → chưa có ví, new NULL → không đủ tiền (số dư hiện tại = old)
+SQL_DEDUCT_BALANCE = "SELECT old_balance, new_balance, applied FROM wallet_apply(%s, %s, %s, %s, %s, TRUE)"
+
+# User đã chắc chắn có trong wallet (process này đã tạo/thấy) → bỏ qua ensure_user_exists
+KNOWN_USERS = LruSet(int(os.getenv("KNOWN_USERS_SIZE", "20000")))
+
+def sheet_mirror_async(fn, *args):
+    """Đẩy việc ghi Sheet ra thread nền - không bao giờ chặn luồng trừ/cộng tiền"""
+    if not SHEET_READY:
+        return
+    if not SHEET_MIRROR_QUEUE.submit(fn, *args):
+        dprint(f"⚠️ Sheet mirror queue full, drop {getattr(fn, '__name__', fn)}{args}")
+
+def _mirror_balance_to_sheet_now(user_id, new_balance):
+    try:
+        row = get_user_row(user_id)
+        if row:
+            ws_money.update_cell(row, 3, new_balance)
+    except Exception as e:
+        dprint(f"mirror wallet to sheet error: {e}")
+
+def mirror_balance_to_sheet(user_id, new_balance):
+    """✅ Mirror balance ra Sheet để bạn theo dõi (lỗi không ảnh hưởng ví, chạy nền)"""
+    if SHEET_MIRROR_WALLET:
+        sheet_mirror_async(_mirror_balance_to_sheet_now, user_id, new_balance)
+
+def _append_new_user_to_sheet(user_id, username):
+    try:
+        row = get_user_row(user_id)
+        if not row:
+            ws_money.append_row([
+                str(user_id),
+                username or "",
+                0,
+                "new",
+                "Chưa kích hoạt",
+                "",
+                ""
+            ])
+            invalidate_user_row_cache(user_id)
+    except Exception as e:
+        dprint(f"ensure_user_exists sheet mirror error: {e}")
+
 def ensure_user_exists(user_id, username=""):
     """
     ✅ V6 PG-PRIMARY:
@@ -2068,32 +3110,23 @@ def ensure_user_exists(user_id, username=""):
     if PG_POOL is None:
         return
 
-    # 1) PG: INSERT mới với status='new', balance=0 hoặc update username nếu đã có
-    pg_exec("""
-        INSERT INTO wallet (tele_id, username, balance, status, notes, gift)
-        VALUES (%s, %s, 0, 'new', 'Chưa kích hoạt', '')
-        ON CONFLICT (tele_id) DO UPDATE SET
-            username = CASE WHEN %s <> '' THEN %s ELSE wallet.username END,
-            updated_at = NOW()
-    """, (user_id, username or "", username or "", username or ""))
+    # 0) Đã thấy user (cùng username) trong process này → không cần ghi gì
+    known_key = f"{user_id}:{username or ''}"
+    if known_key in KNOWN_USERS:
+        return
 
-    # 2) Sheet mirror (fire-and-forget) — chỉ để theo dõi
-    if SHEET_READY:
-        try:
-            row = get_user_row(user_id)
-            if not row:
-                ws_money.append_row([
-                    str(user_id),
-                    username or "",
-                    0,
-                    "new",
-                    "Chưa kích hoạt",
-                    "",
-                    ""
-                ])
-                invalidate_user_row_cache(user_id)
-        except Exception as e:
-            dprint(f"ensure_user_exists sheet mirror error: {e}")
+    # 1) PG: INSERT mới với status='new', balance=0 hoặc update username nếu đổi (không đổi → không ghi)
+    r = pg_exec(SQL_ENSURE_USER, (user_id, username or ""), fetchone=True)
+    if not r:
+        return
+    KNOWN_USERS.add(known_key)
+    if r[1]:
+        wallet_cache_invalidate(user_id)
+
+    # 2) Sheet mirror (nền) — chỉ user vừa tạo mới cần thêm dòng
+    if r[0]:
+        publish_invalidation("users")
+        sheet_mirror_async(_append_new_user_to_sheet, user_id, username)
 
 def get_user_data(user_id):
     """
@@ -2102,66 +3135,47 @@ def get_user_data(user_id):
     - Không phụ thuộc Google Sheet
     Returns: (exists: bool, balance: int, status: str)
     """
-    if PG_POOL is None:
-        return False, 0, ""
-
-    r = pg_exec("SELECT balance, status FROM wallet WHERE tele_id=%s", (int(user_id),), fetchone=True)
-    if not r:
-        return False, 0, ""
-
-    bal = int(r[0] or 0)
-    status = (r[1] or "").strip()
-    return True, bal, status
+    return load_user_context(user_id).as_wallet()
 
 def get_balance_direct(user_id):
     """
     ✅ V6 PG-ONLY: Đọc balance từ PostgreSQL.
     """
-    if PG_POOL is None:
-        return 0
-
-    r = pg_exec("SELECT balance FROM wallet WHERE tele_id=%s", (int(user_id),), fetchone=True)
-    if not r:
-        return 0
-    try:
-        return int(r[0] or 0)
-    except:
-        return 0
+    return load_user_context(user_id).balance
 
-def update_balance_atomic(user_id, delta):
+def update_balance_atomic(user_id, delta, kind="adjust", key=None, note=None):
     """
     🔥 ATOMIC UPDATE BALANCE (PostgreSQL)
     - Không race-condition
     - Không lệch tiền khi nhiều request song song
-    - Mirror ra Google Sheet (tuỳ chọn) để bạn theo dõi
+    - 1 round trip: tự tạo ví nếu chưa có, ghi sổ cái wallet_ledger, trả về số dư mới
+    - key (idempotency): đã áp dụng rồi → không cộng lần 2, trả số dư hiện tại
+      (không truyền key mà đang chạy trong 1 update → tự dùng upd:<update_id>:<kind>:<n>)
+    - Mirror ra Google Sheet (tuỳ chọn, chạy nền) để bạn theo dõi
+    Returns: (success: bool, new_balance: int)
     """
     if PG_POOL is None:
         dprint("⚠️ update_balance_atomic: PG_POOL is None")
         return False, 0
 
-    ensure_user_exists(user_id, username="")
-
-    r = pg_exec("""
-        UPDATE wallet
-        SET balance = GREATEST(balance + %s, 0),
-            updated_at = NOW()
-        WHERE tele_id=%s
-        RETURNING balance
-    """, (int(delta), int(user_id)), fetchone=True)
+    user_id = int(user_id)
+    key = key or flow_ledger_key(user_id, kind)
+    r = pg_exec(SQL_UPDATE_BALANCE, (user_id, int(delta), kind, key, note), fetchone=True)
 
     if not r:
         return False, 0
 
-    new_balance = int(r[0] or 0)
+    old_balance, new_balance = int(r[0] or 0), int(r[1] or 0)
+    refresh_user_balance(user_id, new_balance)
+    if not r[2]:
+        dprint(f"💰 Wallet {user_id}: {key} đã áp dụng trước đó → bỏ qua")
+        return True, new_balance
+
+    dprint(f"💰 Wallet {user_id}: {old_balance:,} → {new_balance:,} ({int(delta):+,})")
+    flow_note(user_id, -int(delta))
 
     # ✅ Mirror sheet để bạn theo dõi
-    if SHEET_READY and SHEET_MIRROR_WALLET:
-        try:
-            row = get_user_row(user_id)
-            if row:
-                ws_money.update_cell(row, 3, new_balance)
-        except Exception as e:
-            dprint(f"mirror wallet to sheet error: {e}")
+    mirror_balance_to_sheet(user_id, new_balance)
 
     return True, new_balance
 
@@ -2173,9 +3187,11 @@ def add_balance(user_id, amount):
     dprint(f"⚠️ WARNING: add_balance() is deprecated, use update_balance_atomic()")
     return update_balance_atomic(user_id, amount)
 
-def deduct_balance_atomic(user_id, need_amount):
+def deduct_balance_atomic(user_id, need_amount, kind="debit", key=None, note=None):
     """
-    ✅ ATOMIC DEDUCT (PostgreSQL)
+    ✅ ATOMIC DEDUCT (PostgreSQL) - ghi sổ cái, key như update_balance_atomic
+    (retry cùng key → coi như đã trừ, không trừ lần 2)
+    Lỗi PG → raise PgUnavailable / PgQueryError (handler update báo "hệ thống bận")
     Returns:
         (success: bool, new_balance: int)
     """
@@ -2188,52 +3204,265 @@ def deduct_balance_atomic(user_id, need_amount):
         dprint("⚠️ deduct_balance_atomic: PG_POOL is None")
         return False, 0
 
-    ensure_user_exists(user_id, username="")
+    # Chưa có ví → không có gì để trừ, không cần tạo ví trước
+    user_id = int(user_id)
+    key = key or flow_ledger_key(user_id, kind)
+    # strict: lỗi SQL (timeout / deadlock / lỗi trong wallet_apply) → raise PgQueryError,
+    # không trả None rồi bị hiểu nhầm thành "không đủ số dư: 0đ"
+    r = pg_exec(SQL_DEDUCT_BALANCE, (user_id, -need_amount, kind, key, note), fetchone=True, strict=True)
+
+    if not r or r[1] is None:
+        # không đủ tiền -> trả balance hiện tại (đã có trong cùng kết quả, không SELECT lại)
+        return False, int((r or (0,))[0] or 0)
+
+    old_balance, new_balance = int(r[0] or 0), int(r[1] or 0)
+    refresh_user_balance(user_id, new_balance)
+    if not r[2]:
+        dprint(f"💰 Wallet {user_id}: {key} đã trừ trước đó → bỏ qua")
+        return True, new_balance
 
-    r = pg_exec("""
-        UPDATE wallet
-        SET balance = balance - %s,
-            updated_at = NOW()
-        WHERE tele_id=%s AND balance >= %s
-        RETURNING balance
-    """, (need_amount, int(user_id), need_amount), fetchone=True)
+    dprint(f"💰 Wallet {user_id}: {old_balance:,} → {new_balance:,} (-{need_amount:,})")
+    flow_note(user_id, need_amount)
 
-    if not r:
-        # không đủ tiền -> trả balance hiện tại
-        bal = get_balance_direct(user_id)
-        return False, bal
+    # mirror sheet
+    mirror_balance_to_sheet(user_id, new_balance)
 
-    new_balance = int(r[0] or 0)
+    return True, new_balance
 
-    # mirror sheet
-    if SHEET_READY and SHEET_MIRROR_WALLET:
-        try:
-            row = get_user_row(user_id)
-            if row:
-                ws_money.update_cell(row, 3, new_balance)
-        except Exception as e:
-            dprint(f"mirror wallet to sheet error: {e}")
+# =========================================================
+# 🔒 WALLET HOLD - GIỮ TIỀN → TRỪ ĐÚNG SỐ THÀNH CÔNG / NHẢ
+# =========================================================
+WALLET_HOLD_TTL = int(os.getenv("WALLET_HOLD_TTL", "600"))  # giây; process chết → hold tự hết hạn
+
+SQL_HOLD_PLACE = "SELECT hold_id, available FROM wallet_hold_place(%s, %s, %s, %s)"
+SQL_HOLD_SETTLE = "SELECT owner_id, new_balance, applied FROM wallet_hold_settle(%s, %s, %s, %s, %s)"
+
+def hold_place(user_id, amount, key=None, ttl=None):
+    """
+    Giữ amount trong ví (chưa trừ số dư). Key như update_balance_atomic (retry → cùng hold).
+    Lỗi PG → raise (không trả (None, 0) = "không đủ số dư")
+    Returns: (hold_id | None nếu không đủ, số dư khả dụng)
+    """
+    if PG_POOL is None:
+        return None, 0
+
+    user_id = int(user_id)
+    key = key or flow_ledger_key(user_id, "hold")
+    r = pg_exec(
+        SQL_HOLD_PLACE, (user_id, int(amount), key, int(ttl or WALLET_HOLD_TTL)), fetchone=True, strict=True
+    )
+    if not r or r[0] is None:
+        return None, int((r or (0, 0))[1] or 0)
+
+    hold_id = int(r[0])
+    flow_track_hold(hold_id)
+    dprint(f"🔒 Hold {hold_id}: {user_id} giữ {int(amount):,}đ (khả dụng còn {int(r[1] or 0):,}đ)")
+    return hold_id, int(r[1] or 0)
+
+def hold_settle(hold_id, capture, kind="purchase", key=None, note=None, strict=False):
+    """
+    1 lệnh duy nhất: trừ capture (phần thành công) + nhả phần còn lại. capture=0 → nhả toàn bộ.
+    strict=True: lỗi PG → raise (hold vẫn được flow theo dõi), không trả (False, 0)
+    Returns: (applied: bool, new_balance: int)
+    """
+    if PG_POOL is None:
+        return False, 0
+
+    r = pg_exec(SQL_HOLD_SETTLE, (int(hold_id), int(capture), kind, key, note), fetchone=True, strict=strict)
+    flow_untrack_hold(hold_id)
+    if not r or r[0] is None:
+        return False, 0
+
+    user_id, new_balance = int(r[0]), int(r[1] or 0)
+    if not r[2]:
+        dprint(f"🔒 Hold {hold_id}: đã settle / hết hạn trước đó → bỏ qua")
+        return False, new_balance
 
+    dprint(f"🔒 Hold {hold_id}: {user_id} trừ {int(capture):,}đ → {new_balance:,}đ")
+    if int(capture) > 0:
+        refresh_user_balance(user_id, new_balance)
+        mirror_balance_to_sheet(user_id, new_balance)
     return True, new_balance
 
-def is_tx_exists(tx_id):
+HOLD_CAPTURE_RETRIES = 3
+HOLD_RECONCILE_KEY = os.getenv("HOLD_RECONCILE_KEY", "hold:reconcile")  # không đặt dưới wallet:* (/update xoá)
+
+def fmt_balance(balance):
+    """Số dư cho tin nhắn; None = chưa đọc được (không bịa 0đ)"""
+    return "đang cập nhật" if balance is None else f"{int(balance):,}đ"
+
+def _hold_capture_once(hold_id, user_id, capture, kind, note):
+    """Returns: (True, balance) đã trừ (lần này hoặc trước đó) | (False, None) lỗi PG"""
+    try:
+        applied, new_balance = hold_settle(hold_id, capture, kind=kind, note=note, strict=True)
+        if applied:
+            return True, new_balance
+        st = pg_exec("SELECT status FROM wallet_hold WHERE id=%s", (int(hold_id),), fetchone=True, strict=True)
+    except PgUnavailable as e:
+        dprint(f"🔒 Hold {hold_id}: capture lỗi PG: {e}")
+        return False, None
+    if st and st[0] == "captured":
+        # Lần trước đã commit nhưng mất kết nối lúc trả kết quả
+        return True, new_balance
+    # Hold đã hết hạn / bị nhả → trừ thẳng, cùng key với settle → không bao giờ trừ 2 lần
+    ok, bal = update_balance_atomic(user_id, -int(capture), kind=kind, key=f"hold:{int(hold_id)}", note=note)
+    return (True, bal) if ok else (False, None)
+
+def hold_finish(hold_id, user_id, capture, kind="purchase", note=None):
     """
-    ✅ Check trùng tx_id
-    Ưu tiên Postgres (UNIQUE), fallback Sheet nếu PG chưa cấu hình.
+    Kết thúc hold sau khi đã lưu voucher. capture > 0 → hàng ĐÃ giao, khoản trừ không được mất:
+    - Lỗi PG → retry (settle idempotent theo trạng thái hold)
+    - Vẫn lỗi → ghi HOLD_RECONCILE_KEY + báo admin, KHÔNG nhả hold (tiền vẫn bị giữ tới khi đối soát)
+    capture = 0 → nhả hold (như hold_release; cần biết đã nhả hay chưa → gọi hold_release).
+    Returns: (applied: bool, balance: int | None) - balance None = chưa đọc được
     """
-    if not tx_id:
-        return False
+    capture = int(capture)
+    if capture <= 0:
+        status, bal = hold_release(hold_id, kind=kind, note=note)
+        return status == "released", bal
 
-    if PG_POOL is not None:
-        r = pg_exec("SELECT 1 FROM processed_tx WHERE tx_id=%s", (str(tx_id),), fetchone=True)
-        return bool(r)
+    for attempt in range(HOLD_CAPTURE_RETRIES):
+        ok, bal = _hold_capture_once(hold_id, user_id, capture, kind, note)
+        if ok:
+            return True, bal
+        time.sleep(0.5 * (2 ** attempt))
+
+    # Hết retry → flow_end không được nhả hold này
+    flow_untrack_hold(hold_id)
+    record = {"hold_id": int(hold_id), "user_id": int(user_id), "capture": capture, "kind": kind, "note": note, "ts": now_str()}
+    print(f"💥 HOLD CAPTURE FAILED → reconcile: {record}")
+    if RDS is not None:
+        try:
+            RDS.rpush(HOLD_RECONCILE_KEY, json.dumps(record, ensure_ascii=False))
+        except Exception as e:
+            print(f"[HOLD] reconcile push error: {e}")
+    if ADMIN_ID:
+        tg_send(
+            ADMIN_ID,
+            f"💥 <b>Chưa trừ được tiền sau khi lưu voucher</b>\n"
+            f"User <code>{user_id}</code> | hold {hold_id} | {capture:,}đ ({kind})\n"
+            f"Đã ghi đối soát, process sau tự thử lại."
+        )
+    return False, None
 
-    # fallback sheet
+def hold_release(hold_id, kind="purchase", note=None):
+    """
+    Nhả hold khi không giao được hàng (chưa trừ đồng nào → KHÔNG phải hoàn tiền).
+    Returns: (status, balance | None)
+      "released" vừa nhả | "already" đã nhả / hết hạn trước đó | "captured" đã bị trừ ở lần chạy trước
+      | "pending" lỗi PG → hold tự hết hạn sau WALLET_HOLD_TTL
+    """
     try:
-        col = ws_nap_tien.col_values(6)
-        return str(tx_id) in col
-    except:
-        return False
+        applied, bal = hold_settle(hold_id, 0, kind=kind, note=note, strict=True)
+        if applied:
+            return "released", bal
+        st = pg_exec("SELECT status FROM wallet_hold WHERE id=%s", (int(hold_id),), fetchone=True, strict=True)
+    except PgUnavailable as e:
+        dprint(f"🔒 Hold {hold_id}: nhả lỗi PG: {e}")
+        return "pending", None
+    if not st:
+        return "already", None
+    return ("captured" if st[0] == "captured" else "already"), bal
+
+def fmt_hold_release(status, amount):
+    """Dòng báo user sau hold_release - theo kết quả settle thật, không báo "hoàn tiền" khi chưa trừ"""
+    if status == "released":
+        return f"🔓 Không trừ tiền (đã nhả <b>{amount:,}đ</b> tạm giữ)\n"
+    if status == "pending":
+        return f"🔓 Không trừ tiền - <b>{amount:,}đ</b> tạm giữ tự nhả trong {WALLET_HOLD_TTL // 60} phút\n"
+    if status == "captured":
+        return f"⚠️ Giao dịch này đã bị trừ <b>{amount:,}đ</b> ở lần xử lý trước - liên hệ admin nếu cần hoàn\n"
+    return "🔓 Không trừ tiền\n"
+
+def hold_reconcile_pending():
+    """Thử trừ lại các khoản capture lỗi (chạy lúc khởi động). Returns: số khoản đã xử lý xong."""
+    if RDS is None or PG_POOL is None:
+        return 0
+    done = 0
+    for _ in range(RDS.llen(HOLD_RECONCILE_KEY)):
+        raw = RDS.lpop(HOLD_RECONCILE_KEY)
+        if not raw:
+            break
+        try:
+            rec = json.loads(raw)
+        except Exception:
+            continue
+        ok, _ = _hold_capture_once(rec["hold_id"], rec["user_id"], rec["capture"], rec.get("kind", "purchase"), rec.get("note"))
+        if ok:
+            done += 1
+            log_row(rec["user_id"], "", "HOLD_RECONCILED", str(rec["capture"]), f"hold {rec['hold_id']}")
+        else:
+            RDS.rpush(HOLD_RECONCILE_KEY, raw)
+    return done
+
+# =========================================================
+# 📒 WALLET LEDGER - LỊCH SỬ / TỔNG KẾT TỪ POSTGRES
+# =========================================================
+def ledger_history(user_id, kinds=None, limit=10):
+    """Giao dịch gần nhất của user (index tele_id, created_at) - cũ → mới"""
+    if PG_POOL is None:
+        return []
+    rows = pg_exec(
+        """
+        SELECT created_at, kind, amount, balance_after, idem_key, note
+        FROM wallet_ledger
+        WHERE tele_id=%s AND (%s::text[] IS NULL OR kind = ANY(%s::text[]))
+        ORDER BY created_at DESC LIMIT %s
+        """,
+        (int(user_id), kinds, kinds, int(limit)), fetchall=True, read=True, user_id=user_id
+    ) or []
+    return list(reversed(rows))
+
+def ledger_daily_totals(day=None):
+    """Tổng theo loại trong 1 ngày (giờ VN): {kind: (lượt, tổng tiền, số user)}"""
+    if PG_POOL is None:
+        return {}
+    day = day or datetime.now(VIETNAM_TZ).date()
+    start = datetime.combine(day, datetime.min.time()).replace(tzinfo=VIETNAM_TZ)
+    rows = pg_exec(
+        """
+        SELECT kind, COUNT(*), COALESCE(SUM(amount), 0), COUNT(DISTINCT tele_id)
+        FROM wallet_ledger
+        WHERE created_at >= %s AND created_at < %s + INTERVAL '1 day'
+        GROUP BY kind
+        """,
+        (start, start), fetchall=True, read=True
+    ) or []
+    return {r[0]: (int(r[1]), int(r[2]), int(r[3])) for r in rows}
+
+# Ghi tx_id + cộng tiền trong 1 statement: tx_id đã có → không dòng nào, không cộng
+# params: (tx_id, tele_id, amount, tele_id, total_add, note)
+SQL_CREDIT_TOPUP_ONCE = """
+    WITH tx AS (
+        INSERT INTO processed_tx (tx_id, tele_id, amount)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (tx_id) DO NOTHING
+        RETURNING tx_id
+    )
+    SELECT w.old_balance, w.new_balance
+    FROM tx, LATERAL wallet_apply(%s, %s, 'topup', 'sepay:' || tx.tx_id, %s, FALSE) w
+"""
+
+def credit_topup_once(tx_id, user_id, amount, total_add, note=None):
+    """
+    ✅ Exactly-once: SePay gửi lại bao nhiêu lần, song song hay không, cũng chỉ cộng 1 lần.
+    Returns: (credited: bool, new_balance: int) - credited=False → tx_id đã xử lý
+    Raises: PgUnavailable / PgQueryError - lỗi DB bất kỳ (KHÔNG được coi là trùng)
+    """
+    user_id = int(user_id)
+    r = pg_exec(
+        SQL_CREDIT_TOPUP_ONCE,
+        (str(tx_id), user_id, int(amount), user_id, int(total_add), note),
+        fetchone=True, strict=True
+    )
+    if not r:
+        return False, 0
+
+    new_balance = int(r[1] or 0)
+    dprint(f"💰 Wallet {user_id}: {int(r[0] or 0):,} → {new_balance:,} (+{int(total_add):,} sepay:{tx_id})")
+    refresh_user_balance(user_id, new_balance)
+    mirror_balance_to_sheet(user_id, new_balance)
+    return True, new_balance
 
 def save_topup_to_sheet(user_id, username, amount, loai, tx_id, note=""):
     if not SHEET_READY or ws_nap_tien is None:
@@ -2253,6 +3482,22 @@ def save_topup_to_sheet(user_id, username, amount, loai, tx_id, note=""):
         print("[SAVE_TOPUP_ERROR]", e)
 
 def topup_history_text(user_id, limit=10):
+    # ✅ Sổ cái PG trước (không quét Sheet); chỉ user chưa có giao dịch trong sổ mới đọc Sheet cũ
+    try:
+        logs = ledger_history(user_id, kinds=["topup"], limit=limit)
+    except Exception as e:
+        dprint(f"ledger_history error: {e}")
+        logs = []
+    if logs:
+        out = ["📜 <b>Lịch sử nạp tiền (SEPAY)</b>"]
+        for created_at, _, amount, _, idem_key, _ in logs:
+            out.append(
+                f"- {created_at.astimezone(VIETNAM_TZ).strftime('%Y-%m-%d %H:%M:%S')} | "
+                f"+{int(amount):,}đ | "
+                f"{(idem_key or '').split(':', 1)[-1]}"
+            )
+        return "\n".join(out)
+
     if not SHEET_READY or ws_nap_tien is None:
         return "❌ Hệ thống lịch sử nạp tiền đang lỗi."
 
@@ -2324,7 +3569,8 @@ def get_voucher(cmd):
 
     return None, "Không tìm thấy voucher"
 
-def save_voucher_and_check(cookie, voucher):
+def build_save_voucher_request(cookie, voucher):
+    """Headers + payload cho API save_vouchers (dùng chung sync/async)"""
     payload = {
         "voucher_identifiers": [{
             "promotion_id": int(voucher.get("Promotionid")),
@@ -2343,6 +3589,11 @@ def save_voucher_and_check(cookie, voucher):
         "Referer": "https://shopee.vn/",
         "Cookie": cookie
     }
+    return headers, payload
+
+def save_voucher_and_check(cookie, voucher):
+    flow_touch(voucher=True)
+    headers, payload = build_save_voucher_request(cookie, voucher)
 
     try:
         r = requests.post(SAVE_URL, headers=headers, json=payload, timeout=15)
@@ -2350,7 +3601,18 @@ def save_voucher_and_check(cookie, voucher):
         if r.status_code != 200:
             return False, f"HTTP_{r.status_code}"
 
-        js = r.json()
+        return parse_save_voucher_response(r.json())
+
+    except requests.exceptions.Timeout:
+        return False, "TIMEOUT"
+    except Exception as e:
+        return False, f"EXCEPTION_{str(e)}"
+
+def parse_save_voucher_response(js):
+    """
+    Map response save_vouchers → (ok: bool, reason: str)
+    """
+    try:
         if "responses" not in js or not js["responses"]:
             return False, "INVALID_RESPONSE"
 
@@ -2372,8 +3634,6 @@ def save_voucher_and_check(cookie, voucher):
         # ❌ OTHER ERRORS
         return False, f"SHOPEE_{error_code}"
 
-    except requests.exceptions.Timeout:
-        return False, "TIMEOUT"
     except Exception as e:
         return False, f"EXCEPTION_{str(e)}"
 
@@ -2419,6 +3679,7 @@ def format_shopee_error(error_code):
 # ⭐ MULTI-COOKIE VOUCHER SAVER ⭐
 # =========================================================
 def save_voucher_multi_cookies(cookies, voucher):
+    flow_touch()
     success_count = 0
     failed_details = []
 
@@ -2567,7 +3828,7 @@ VOUCHER_KEYBOARD_CACHE = {
     "info_text": None,
     "last_update": 0
 }
-KEYBOARD_CACHE_DURATION = 60
+KEYBOARD_CACHE_DURATION = int(os.getenv("KEYBOARD_CACHE_DURATION", "300"))
 
 def apply_strikethrough(text):
     strikethrough_map = {
@@ -2865,13 +4126,12 @@ def handle_active_gift_5k(user_id, username):
     user_id = int(user_id)
     ensure_user_exists(user_id, username)
 
-    # Đọc status + balance từ PG
-    r = pg_exec("SELECT balance, status FROM wallet WHERE tele_id=%s", (user_id,), fetchone=True)
+    # Đọc status từ PG (số dư mới lấy từ lệnh cộng tiền)
+    r = pg_exec("SELECT status FROM wallet WHERE tele_id=%s", (user_id,), fetchone=True)
     if not r:
         return False, "❌ Không tìm thấy tài khoản."
 
-    current_balance = int(r[0] or 0)
-    status = (r[1] or "").strip()
+    status = (r[0] or "").strip()
 
     # ✅ CHECK 1: Đã active rồi
     if status == "active":
@@ -2886,14 +4146,17 @@ def handle_active_gift_5k(user_id, username):
         )
 
     try:
-        new_balance = current_balance + ACTIVE_GIFT_AMOUNT
-
-        # ✅ Update PG (nguồn chính)
-        pg_exec("""
-            UPDATE wallet
-            SET balance = %s, status = 'active', updated_at = NOW()
-            WHERE tele_id = %s
-        """, (new_balance, user_id))
+        # ✅ Update PG (nguồn chính) - status + cộng quà trong 1 round trip / 1 transaction
+        # key gift:<id> → mỗi user chỉ nhận 1 lần
+        r = pg_batch([
+            ("UPDATE wallet SET status='active', updated_at=NOW() WHERE tele_id=%s", (user_id,)),
+            (SQL_UPDATE_BALANCE, (user_id, ACTIVE_GIFT_AMOUNT, "gift", f"gift:{user_id}", "ACTIVE_GIFT_CLICK")),
+        ], fetchone=True)
+        if not r:
+            return False, "❌ Lỗi khi kích hoạt"
+        new_balance = int(r[1] or 0)
+        wallet_cache_invalidate(user_id)
+        refresh_user_balance(user_id, new_balance)
 
         # ✅ Mirror Sheet (fire-and-forget)
         if SHEET_READY:
@@ -2921,317 +4184,589 @@ def handle_active_gift_5k(user_id, username):
         return False, "❌ Lỗi khi kích hoạt"
 
 # =========================================================
-# CALLBACK QUERY HANDLER
+# 🧭 UPDATE ROUTER
+# - Lệnh / nút bấm: dict khớp chính xác (O(1))
+# - Callback data: prefix trie (BUY:, QUICK_SAVE:, SYSTEM:, qr_cancel:...)
+# - Mỗi route khai báo context cần đọc → chỉ tốn đúng query cần dùng
+#     "ban"    → check_ban_status trước khi chạy handler
+#     "user"   → bắt buộc đã có ví (chưa có → nhắc /start)
+#     "wallet" → nạp sẵn ví (balance, status) vào ctx
+# - Mỗi route khai báo priority class (payment/purchase/interactive/bulk)
+#   để webhook xếp update vào đúng pool trước khi xử lý
 # =========================================================
-def handle_callback_query(cb):
-    cb_id = cb.get("id")
-    data = cb.get("data", "")
-    from_user = cb.get("from", {})
-    user_id = from_user.get("id")
-    username = from_user.get("username", "")
-    chat_id = cb.get("message", {}).get("chat", {}).get("id")
+ROUTE_TIMING_SAMPLES = 200
+
+class RouteContext:
+    """Context của 1 update; UserContext đọc lười (1 SELECT) và dùng chung cho ban / ví / handler"""
+
+    def __init__(self, user_id, chat_id, username, msg=None, cb=None, user=None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.username = username
+        self.msg = msg or {}
+        self.cb = cb or {}
+        self.text = (self.msg.get("text") or "").strip()
+        self.data = self.cb.get("data", "")
+        self.cb_id = self.cb.get("id")
+        self.cb_msg_id = self.cb.get("message", {}).get("message_id")
+        self._user = user
+        if user is not None:
+            bind_user_context(user)
+
+    def user(self):
+        """UserContext của update (đọc 1 lần, số dư tự cập nhật sau lệnh ghi ví)"""
+        if self._user is None:
+            self._user = load_user_context(self.user_id)
+            bind_user_context(self._user)
+        return self._user
+
+    def wallet(self):
+        """Returns: (exists, balance, status)"""
+        return self.user().as_wallet()
+
+class Route:
+    __slots__ = ("name", "handler", "needs", "priority")
+
+    def __init__(self, name, handler, needs, priority="interactive"):
+        self.name = name
+        self.handler = handler
+        self.needs = frozenset(needs)
+        self.priority = priority
+
+    def priority_for(self, key, user_id):
+        """priority có thể là chuỗi cố định hoặc hàm (key, user_id) → chuỗi"""
+        if callable(self.priority):
+            return self.priority(key, user_id)
+        return self.priority
+
+class PrefixTrie:
+    """Trie theo ký tự, trả về route có prefix dài nhất khớp với key"""
+
+    _END = object()
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, prefix, value):
+        node = self._root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[self._END] = value
+
+    def longest_match(self, key):
+        """Returns: (value, prefix_len) hoặc (None, 0)"""
+        node = self._root
+        best, best_len = node.get(self._END), 0
+        for i, ch in enumerate(key, 1):
+            node = node.get(ch)
+            if node is None:
+                break
+            if self._END in node:
+                best, best_len = node[self._END], i
+        return best, best_len
+
+class UpdateRouter:
+    """Bảng route: exact dict → prefix trie → fallback, kèm timing theo handler"""
+
+    def __init__(self, name, on_banned=None, on_missing_user=None):
+        self.name = name
+        self.on_banned = on_banned
+        self.on_missing_user = on_missing_user
+        self._exact = {}
+        self._prefixes = PrefixTrie()
+        self._fallback = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def exact(self, *keys, needs=(), priority="interactive"):
+        def deco(fn):
+            route = Route(fn.__name__, fn, needs, priority)
+            for key in keys:
+                self._exact[key] = route
+            return fn
+        return deco
+
+    def prefix(self, *prefixes, needs=(), priority="interactive"):
+        def deco(fn):
+            route = Route(fn.__name__, fn, needs, priority)
+            for p in prefixes:
+                self._prefixes.insert(p, route)
+            return fn
+        return deco
+
+    def fallback(self, needs=(), priority="interactive"):
+        def deco(fn):
+            self._fallback = Route(fn.__name__, fn, needs, priority)
+            return fn
+        return deco
+
+    def resolve(self, key):
+        """Returns: (route, arg) - arg là phần sau prefix (exact → "")"""
+        route = self._exact.get(key)
+        if route is not None:
+            return route, ""
+
+        route, n = self._prefixes.longest_match(key)
+        if route is not None:
+            return route, key[n:]
+
+        return self._fallback, key
+
+    def priority_for(self, key, user_id):
+        route, _ = self.resolve(key)
+        if route is None:
+            return "interactive"
+        return route.priority_for(key, user_id)
+
+    def dispatch(self, key, ctx):
+        route, arg = self.resolve(key)
+        if route is None:
+            return False
 
-    # ===== QR CALLBACKS =====
+        t0 = time.time()
+        ok = False
+        try:
+            if "ban" in route.needs:
+                ban_status = check_ban_status(ctx.user_id, ctx.user())
+                if ban_status["banned"]:
+                    if self.on_banned:
+                        self.on_banned(ctx, ban_status)
+                    ok = True
+                    return True
 
-    if data.startswith("qr_cancel:"):
-        session_id = data.split(":", 1)[1]
-        tg_answer_callback(cb_id)
-        handle_qr_cancel(chat_id, session_id)
-        return
+            if "user" in route.needs or "wallet" in route.needs:
+                exists = ctx.wallet()[0]
+                if "user" in route.needs and not exists:
+                    if self.on_missing_user:
+                        self.on_missing_user(ctx)
+                    ok = True
+                    return True
 
-    # ===== ACTIVATE GIFT CALLBACK =====
-    if data == "activate_gift":
-        tg_answer_callback(cb_id)
-        success, result = handle_active_gift_5k(user_id, username)
-        
-        if success:
-            # result là new_balance
-            new_balance = result
-            tg_send(
-                chat_id,
-                f"🎉 <b>KÍCH HOẠT THÀNH CÔNG!</b>\n\n"
-                f"💰 Bạn đã nhận <b>{ACTIVE_GIFT_AMOUNT:,}đ</b>\n"
-                f"💼 Số dư hiện tại: <b>{new_balance:,}đ</b>\n\n"
-                f"━━━━━━━━━━━━━━━━━━━━\n"
-                f"🆕 <b>TÍNH NĂNG MỚI</b>\n\n"
-                f"🔑 <b>Get Cookie QR</b>\n"
-                f"├ Quét QR lấy Cookie Shopee\n"
-                f"├ Không cần nhập thủ công\n"
-                f"└ Cookie tự động lưu 7 ngày\n\n"
-                f"🖥️ <b>Tool ADD Voucher PC</b>\n"
-                f"├ Lưu voucher từ máy tính\n"
-                f"├ Nhanh gấp 10 lần bot Telegram\n"
-                f"├ Hỗ trợ nhiều tài khoản\n"
-                f"└ Bấm nút bên dưới để tải\n\n"
-                f"📊 <b>Check Voucher</b>\n"
-                f"├ Kiểm tra voucher còn hạn không\n"
-                f"├ Xem % đã dùng, lượt lưu\n"
-                f"└ Cập nhật real-time\n"
-                f"━━━━━━━━━━━━━━━━━━━━\n\n"
-                f"🛒 <b>Bắt đầu mua voucher ngay!</b>",
-                build_main_keyboard(is_active=True)
-            )
-        else:
-            # result là error message
-            tg_send(chat_id, result, build_main_keyboard(is_active=True))
-        return
+            route.handler(ctx, arg)
+            ok = True
+            return True
+        finally:
+            bind_user_context(None)
+            self._record(route.name, time.time() - t0, ok)
+
+    def _record(self, name, elapsed, ok):
+        with self._lock:
+            st = self._stats.get(name)
+            if st is None:
+                st = self._stats[name] = {
+                    "count": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                    "samples": deque(maxlen=ROUTE_TIMING_SAMPLES),
+                }
+            st["count"] += 1
+            if not ok:
+                st["errors"] += 1
+            st["total"] += elapsed
+            st["max"] = max(st["max"], elapsed)
+            st["samples"].append(elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            items = [(name, dict(st, samples=sorted(st["samples"]))) for name, st in self._stats.items()]
+
+        out = {}
+        for name, st in items:
+            samples = st["samples"]
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0
+            out[name] = {
+                "count": st["count"],
+                "errors": st["errors"],
+                "avg_ms": round(st["total"] / st["count"] * 1000, 1) if st["count"] else 0.0,
+                "p95_ms": round(p95 * 1000, 1),
+                "max_ms": round(st["max"] * 1000, 1),
+            }
+        return out
 
-    # ===== QUICK SAVE VOUCHER CALLBACKS =====
-    if data.startswith("QUICK_SAVE:"):
-        voucher_key = data.split(":", 1)[1]
-        voucher_key = normalize_voucher_key(voucher_key)
-        
-        if voucher_key == "back":
-            tg_answer_callback(cb_id)
-            tg_send(chat_id, "👋 Đã quay về menu chính", build_main_keyboard())
-            return
-        
-        # Lấy cookie đã lưu
-        cookie = get_user_cookie(user_id)
-        
-        if not cookie:
-            tg_answer_callback(cb_id, "❌ Cookie đã hết hạn. Vui lòng Get Cookie QR lại!", True)
-            return
-        
-        # Check balance
-        exists, balance, status = get_user_data(user_id)
-        if not exists:
-            tg_answer_callback(cb_id, "❌ Bạn chưa có tài khoản", True)
-            return
-        
-        if status != "active":
-            tg_answer_callback(cb_id, "❌ Tài khoản chưa được kích hoạt", True)
-            return
-        
-        # ✅ GỬI MESSAGE "ĐANG LƯU VOUCHER..."
-        tg_answer_callback(cb_id)
-        tg_send(chat_id, "⏳ <b>Đang lưu voucher...</b>")
-        
-        # ✅ TÌM VOUCHER ĐỘNG TỪ SHEET (không dùng voucher_map)
-        # voucher_key đã normalize (no space, lowercase)
-        voucher_info = None
-        voucher_cmd = voucher_key  # ← FIX: Define voucher_cmd
-        err_msg = None
-        
-        try:
-            rows = get_voucher_stock_cached()
-            
-            for r in rows:
-                ten_ma = normalize_voucher_key(r.get("Tên Mã", ""))
-                if ten_ma == voucher_key:
-                    # Check trạng thái
-                    if r.get("Trạng Thái") != "Còn Mã":
-                        err_msg = "Voucher này tạm hết mã"
-                        break
-                    voucher_info = r
-                    voucher_cmd = r.get("Tên Mã", voucher_key)  # ← FIX: Lấy tên gốc
-                    break
-            
-            if not voucher_info and not err_msg:
-                err_msg = "Không tìm thấy voucher"
-        except Exception as e:
-            dprint(f"[ERROR] Finding voucher: {e}")
-            dprint(f"[ERROR] Traceback: {traceback.format_exc()}")
-            err_msg = f"Lỗi đọc sheet: {str(e)}"
-        
-        if not voucher_info:
-            tg_send(
-                chat_id,
-                f"❌ <b>LƯU THẤT BẠI</b>\n\n"
-                f"⚠️ Lỗi: {err_msg}"
-            )
-            return
-        
-        price = int(voucher_info.get("Giá", 0))
-        display_name = voucher_info.get("Tên Mã", voucher_key)
-        
-        # Check balance
-        if balance < price:
-            tg_send(
-                chat_id,
-                f"❌ <b>KHÔNG ĐỦ SỐ DƯ</b>\n\n"
-                f"💰 Cần: <b>{price:,}đ</b>\n"
-                f"💼 Số dư: <b>{balance:,}đ</b>\n"
-                f"💸 Thiếu: <b>{price - balance:,}đ</b>"
-            )
-            return
-        
-        # Trừ tiền trước
-        success, new_balance = deduct_balance_atomic(user_id, price)
-        
-        if not success:
+def _route_send_banned(ctx, ban_status):
+    msg_text = (
+        "⛔ <b>TÀI KHOẢN BỊ KHÓA</b>\n\n"
+        "🚫 <b>Lý do:</b> Spam hệ thống\n"
+    )
+
+    if ban_status["type"] == "PERMANENT":
+        msg_text += "⏰ <b>Thời gian:</b> Vĩnh viễn\n\n"
+    else:
+        msg_text += (
+            f"⏰ <b>Thời gian:</b> 1 giờ\n"
+            f"⏱️ <b>Hết hạn:</b> {ban_status['until']}\n\n"
+        )
+
+    msg_text += "📞 <b>Liên hệ:</b> @BonBonxHPx"
+
+    if ctx.cb_id:
+        tg_answer_callback(ctx.cb_id)
+    if ctx.chat_id:
+        tg_send(ctx.chat_id, msg_text)
+
+def _fallback_message_priority(text, user_id):
+    """Tin nhắn rơi vào fallback: cookie / lệnh mua → purchase, còn lại interactive"""
+    if user_id in PENDING_VOUCHER or "SPC_" in text:
+        return "purchase"
+    if text.startswith("/voucher") or text.startswith("/combo"):
+        return "purchase"
+    return "interactive"
+
+def _route_send_missing_user(ctx):
+    tg_send(ctx.chat_id, "❌ Bạn chưa có ID. Bấm /start để kích hoạt.")
+
+MESSAGE_ROUTER = UpdateRouter("message", _route_send_banned, _route_send_missing_user)
+CALLBACK_ROUTER = UpdateRouter("callback", _route_send_banned)
+
+def format_route_stats(limit=8):
+    """Top route theo tổng thời gian xử lý (cho /stats)"""
+    rows = []
+    for router in (MESSAGE_ROUTER, CALLBACK_ROUTER):
+        for name, st in router.snapshot().items():
+            rows.append((st["avg_ms"] * st["count"], name, st))
+    rows.sort(reverse=True)
+
+    if not rows:
+        return "• Chưa có dữ liệu"
+
+    return "\n".join(
+        f"• {name}: {st['count']} lần | avg {st['avg_ms']}ms | p95 {st['p95_ms']}ms | lỗi {st['errors']}"
+        for _, name, st in rows[:limit]
+    )
+
+# =========================================================
+# CALLBACK QUERY HANDLER
+# =========================================================
+@CALLBACK_ROUTER.prefix("qr_cancel:")
+def _cb_qr_cancel(ctx, arg):
+    cb_id, chat_id = ctx.cb_id, ctx.chat_id
+    session_id = arg
+    tg_answer_callback(cb_id)
+    handle_qr_cancel(chat_id, session_id)
+
+
+@CALLBACK_ROUTER.exact("activate_gift", needs=("ban",), priority="purchase")
+def _cb_activate_gift(ctx, arg):
+    cb_id, chat_id, user_id, username = ctx.cb_id, ctx.chat_id, ctx.user_id, ctx.username
+    tg_answer_callback(cb_id)
+    success, result = handle_active_gift_5k(user_id, username)
+
+    if success:
+        # result là new_balance
+        new_balance = result
+        tg_send(
+            chat_id,
+            f"🎉 <b>KÍCH HOẠT THÀNH CÔNG!</b>\n\n"
+            f"💰 Bạn đã nhận <b>{ACTIVE_GIFT_AMOUNT:,}đ</b>\n"
+            f"💼 Số dư hiện tại: <b>{new_balance:,}đ</b>\n\n"
+            f"━━━━━━━━━━━━━━━━━━━━\n"
+            f"🆕 <b>TÍNH NĂNG MỚI</b>\n\n"
+            f"🔑 <b>Get Cookie QR</b>\n"
+            f"├ Quét QR lấy Cookie Shopee\n"
+            f"├ Không cần nhập thủ công\n"
+            f"└ Cookie tự động lưu 7 ngày\n\n"
+            f"🖥️ <b>Tool ADD Voucher PC</b>\n"
+            f"├ Lưu voucher từ máy tính\n"
+            f"├ Nhanh gấp 10 lần bot Telegram\n"
+            f"├ Hỗ trợ nhiều tài khoản\n"
+            f"└ Bấm nút bên dưới để tải\n\n"
+            f"📊 <b>Check Voucher</b>\n"
+            f"├ Kiểm tra voucher còn hạn không\n"
+            f"├ Xem % đã dùng, lượt lưu\n"
+            f"└ Cập nhật real-time\n"
+            f"━━━━━━━━━━━━━━━━━━━━\n\n"
+            f"🛒 <b>Bắt đầu mua voucher ngay!</b>",
+            build_main_keyboard(is_active=True)
+        )
+    else:
+        # result là error message
+        tg_send(chat_id, result, build_main_keyboard(is_active=True))
+
+
+@CALLBACK_ROUTER.exact("QUICK_SAVE:back")
+def _cb_quick_save_back(ctx, arg):
+    cb_id, chat_id = ctx.cb_id, ctx.chat_id
+    tg_answer_callback(cb_id)
+    tg_send(chat_id, "👋 Đã quay về menu chính", build_main_keyboard())
+
+
+@CALLBACK_ROUTER.prefix("QUICK_SAVE:", needs=("ban", "wallet"), priority="purchase")
+def _cb_quick_save(ctx, arg):
+    cb_id, chat_id, user_id, username = ctx.cb_id, ctx.chat_id, ctx.user_id, ctx.username
+    voucher_key = normalize_voucher_key(arg)
+
+    # Lấy cookie đã lưu
+    cookie = get_user_cookie(user_id)
+
+    if not cookie:
+        tg_answer_callback(cb_id, "❌ Cookie đã hết hạn. Vui lòng Get Cookie QR lại!", True)
+        return
+
+    # Check balance (ví đã được router nạp sẵn)
+    exists, balance, status = ctx.wallet()
+    if not exists:
+        tg_answer_callback(cb_id, "❌ Bạn chưa có tài khoản", True)
+        return
+
+    if status != "active":
+        tg_answer_callback(cb_id, "❌ Tài khoản chưa được kích hoạt", True)
+        return
+
+    # ✅ GỬI MESSAGE "ĐANG LƯU VOUCHER..."
+    tg_answer_callback(cb_id)
+    tg_send(chat_id, "⏳ <b>Đang lưu voucher...</b>")
+
+    # ✅ TÌM VOUCHER ĐỘNG TỪ SHEET (không dùng voucher_map)
+    # voucher_key đã normalize (no space, lowercase)
+    voucher_info = None
+    voucher_cmd = voucher_key  # ← FIX: Define voucher_cmd
+    err_msg = None
+
+    try:
+        rows = get_voucher_stock_cached()
+
+        for r in rows:
+            ten_ma = normalize_voucher_key(r.get("Tên Mã", ""))
+            if ten_ma == voucher_key:
+                # Check trạng thái
+                if r.get("Trạng Thái") != "Còn Mã":
+                    err_msg = "Voucher này tạm hết mã"
+                    break
+                voucher_info = r
+                voucher_cmd = r.get("Tên Mã", voucher_key)  # ← FIX: Lấy tên gốc
+                break
+
+        if not voucher_info and not err_msg:
+            err_msg = "Không tìm thấy voucher"
+    except Exception as e:
+        dprint(f"[ERROR] Finding voucher: {e}")
+        dprint(f"[ERROR] Traceback: {traceback.format_exc()}")
+        err_msg = f"Lỗi đọc sheet: {str(e)}"
+
+    if not voucher_info:
+        tg_send(
+            chat_id,
+            f"❌ <b>LƯU THẤT BẠI</b>\n\n"
+            f"⚠️ Lỗi: {err_msg}"
+        )
+        return
+
+    price = int(voucher_info.get("Giá", 0))
+    display_name = voucher_info.get("Tên Mã", voucher_key)
+
+    # Check balance
+    if balance < price:
+        tg_send(
+            chat_id,
+            f"❌ <b>KHÔNG ĐỦ SỐ DƯ</b>\n\n"
+            f"💰 Cần: <b>{price:,}đ</b>\n"
+            f"💼 Số dư: <b>{balance:,}đ</b>\n"
+            f"💸 Thiếu: <b>{price - balance:,}đ</b>"
+        )
+        return
+
+    # Giữ tiền trước (chưa trừ) → lưu xong mới settle 1 lần
+    hold_id, available = hold_place(user_id, price)
+
+    if not hold_id:
+        tg_send(
+            chat_id,
+            f"❌ <b>TRỪ TIỀN THẤT BẠI</b>\n\n"
+            f"💰 Cần: <b>{price:,}đ</b>\n"
+            f"💼 Số dư: <b>{available:,}đ</b>"
+        )
+        return
+
+    # Lưu voucher
+    settled = False
+    try:
+        ok, result = save_voucher_and_check(cookie, voucher_info)
+
+        # Thành công → trừ tiền; thất bại → nhả hold (chưa trừ → không có gì để hoàn)
+        if ok:
+            _, real_balance = hold_finish(hold_id, user_id, price)
+        else:
+            release, real_balance = hold_release(hold_id)
+        settled = True
+
+        if ok:
             tg_send(
                 chat_id,
-                f"❌ <b>TRỪ TIỀN THẤT BẠI</b>\n\n"
-                f"💰 Cần: <b>{price:,}đ</b>\n"
-                f"💼 Số dư: <b>{new_balance:,}đ</b>"
+                f"🎉 <b>LƯU THÀNH CÔNG</b>\n\n"
+                f"✅ <b>{voucher_info.get('Tên Mã', voucher_cmd)}</b>\n"
+                f"🍪 1 cookie\n"
+                f"💰 <b>-{price:,}đ</b>\n"
+                f"💼 Số dư: <b>{fmt_balance(real_balance)}</b>",
+                build_main_keyboard()
             )
-            return
-        
-        # Lưu voucher
-        try:
-            ok, result = save_voucher_and_check(cookie, voucher_info)
-            
-            if ok:
-                # Thành công
-                real_balance = get_balance_direct(user_id)
-                
-                tg_send(
-                    chat_id,
-                    f"🎉 <b>LƯU THÀNH CÔNG</b>\n\n"
-                    f"✅ <b>{voucher_info.get('Tên Mã', voucher_cmd)}</b>\n"
-                    f"🍪 1 cookie\n"
-                    f"💰 <b>-{price:,}đ</b>\n"
-                    f"💼 Số dư: <b>{real_balance:,}đ</b>",
-                    build_main_keyboard()
-                )
-                
-                # Log
-                log_voucher_save(user_id, username, voucher_cmd, 1, price, real_balance, "✅")
-                
-            else:
-                # Thất bại → Hoàn tiền
-                update_balance_atomic(user_id, price)
-                real_balance = get_balance_direct(user_id)
-                
-                # Format lỗi thân thiện
-                error_message = format_shopee_error(result)
-                
-                tg_send(
-                    chat_id,
-                    f"{error_message}\n\n"
-                    f"💸 Đã hoàn tiền: <b>+{price:,}đ</b>\n"
-                    f"💼 Số dư: <b>{real_balance:,}đ</b>",
-                    build_main_keyboard()
-                )
-                
-                # Log
-                log_voucher_save(user_id, username, voucher_cmd, 1, 0, real_balance, f"❌ {result}")
-        
-        except Exception as e:
-            # ❌ EXCEPTION → Hoàn tiền và báo lỗi
-            dprint(f"[ERROR] Save voucher exception: {e}")
-            dprint(f"[ERROR] Traceback: {traceback.format_exc()}")
-            
-            update_balance_atomic(user_id, price)
-            real_balance = get_balance_direct(user_id)
-            
+
+            # Log
+            log_voucher_save(user_id, username, voucher_cmd, 1, price, real_balance, "✅")
+
+        else:
+            # Format lỗi thân thiện
+            error_message = format_shopee_error(result)
+
             tg_send(
                 chat_id,
-                f"❌ <b>LỖI HỆ THỐNG</b>\n\n"
-                f"⚠️ Exception: {str(e)[:200]}\n\n"
-                f"💸 Đã hoàn tiền: <b>+{price:,}đ</b>\n"
-                f"💼 Số dư: <b>{real_balance:,}đ</b>",
+                f"{error_message}\n\n"
+                f"{fmt_hold_release(release, price)}"
+                f"💼 Số dư: <b>{fmt_balance(real_balance)}</b>",
                 build_main_keyboard()
             )
-            
-            log_voucher_save(user_id, username, voucher_cmd, 1, 0, real_balance, f"❌ EXCEPTION")
-        
+
+            # Log
+            log_voucher_save(user_id, username, voucher_cmd, 1, 0, real_balance, f"❌ {result}")
+
+    except Exception as e:
+        dprint(f"[ERROR] Save voucher exception: {e}")
+        dprint(f"[ERROR] Traceback: {traceback.format_exc()}")
+
+        if settled:
+            # Đã trừ / nhả xong, lỗi ở bước gửi tin / ghi log → không hoàn tiền lần 2
+            raise
+
+        # ❌ EXCEPTION trước khi settle → nhả hold; báo theo kết quả nhả thật
+        release, real_balance = hold_release(hold_id)
+        refund_line = fmt_hold_release(release, price)
+
+        tg_send(
+            chat_id,
+            f"❌ <b>LỖI HỆ THỐNG</b>\n\n"
+            f"⚠️ Exception: {str(e)[:200]}\n\n"
+            f"{refund_line}"
+            f"💼 Số dư: <b>{fmt_balance(real_balance)}</b>",
+            build_main_keyboard()
+        )
+
+        log_voucher_save(user_id, username, voucher_cmd, 1, 0, real_balance, f"❌ EXCEPTION")
+
+
+@CALLBACK_ROUTER.prefix("SOLD_OUT:")
+def _cb_sold_out(ctx, arg):
+    cb_id = ctx.cb_id
+    tg_answer_callback(cb_id, "⚠️ Voucher này tạm hết mã. Vui lòng quay lại sau!", True)
+
+
+@CALLBACK_ROUTER.prefix("BUY:", needs=("ban",), priority="purchase")
+def _cb_buy(ctx, arg):
+    cb_id, user_id = ctx.cb_id, ctx.user_id
+    cmd = arg
+
+    # ✅ RATE LIMIT - Ngăn spam click BUY
+    last_callback_time = CALLBACK_COOLDOWN.get(user_id, 0)
+    if time.time() - last_callback_time < CALLBACK_COOLDOWN_SECONDS:
+        tg_answer_callback(cb_id, "⏳ Chậm lại 1 chút", True)
+        dprint(f"⏳ Callback rate-limited: user {user_id}")
         return
 
-    if data.startswith("SOLD_OUT:"):
-        tg_answer_callback(cb_id, "⚠️ Voucher này tạm hết mã. Vui lòng quay lại sau!", True)
+    CALLBACK_COOLDOWN[user_id] = time.time()
+
+    # Đọc ví SAU rate limit → spam click không tốn query
+    exists, balance, status = ctx.wallet()
+    if not exists:
+        tg_answer_callback(cb_id, "❌ Bạn chưa có ID", True)
         return
 
-    if data.startswith("BUY:"):
-        cmd = data.split(":", 1)[1]
+    if status != "active":
+        tg_answer_callback(cb_id, "❌ Tài khoản chưa được kích hoạt", True)
+        return
 
-        # ✅ RATE LIMIT - Ngăn spam click BUY
-        last_callback_time = CALLBACK_COOLDOWN.get(user_id, 0)
-        if time.time() - last_callback_time < CALLBACK_COOLDOWN_SECONDS:
-            tg_answer_callback(cb_id, "⏳ Chậm lại 1 chút", True)
-            dprint(f"⏳ Callback rate-limited: user {user_id}")
-            return
-        
-        CALLBACK_COOLDOWN[user_id] = time.time()
+    if user_id in PENDING_VOUCHER:
+        old_pending = PENDING_VOUCHER[user_id]
+        old_cmd = old_pending["cmd"] if isinstance(old_pending, dict) else old_pending
+        dprint(f"Cleared old pending: {old_cmd}")
 
-        exists, balance, status = get_user_data(user_id)
-        if not exists:
-            tg_answer_callback(cb_id, "❌ Bạn chưa có ID", True)
-            return
+    # ✅ Lưu với timestamp
+    PENDING_VOUCHER[user_id] = {
+        "cmd": cmd,
+        "ts": time.time()
+    }
+
+    tg_answer_callback(cb_id)
+    tg_send(
+        user_id,
+        f"👉 Gửi <b>cookie</b> vào đây để lưu <b>{cmd}</b>\n\n"
+        f"⭐ <b>Hỗ trợ lưu tối đa 10 cookie</b>\n"
+        f"💡 Gửi mỗi cookie 1 dòng"
+    )
 
-        if status != "active":
-            tg_answer_callback(cb_id, "❌ Tài khoản chưa được kích hoạt", True)
-            return
 
-        if user_id in PENDING_VOUCHER:
-            old_pending = PENDING_VOUCHER[user_id]
-            old_cmd = old_pending["cmd"] if isinstance(old_pending, dict) else old_pending
-            dprint(f"Cleared old pending: {old_cmd}")
+@CALLBACK_ROUTER.prefix("SYSTEM:")
+def _cb_system(ctx, arg):
+    cb_id, chat_id, cb_msg_id = ctx.cb_id, ctx.chat_id, ctx.cb_msg_id
+    action = arg.split(":")[0]
 
-        # ✅ Lưu với timestamp
-        PENDING_VOUCHER[user_id] = {
-            "cmd": cmd,
-            "ts": time.time()
+    if action == "bot_list":
+        bot_list_menu = {
+            "inline_keyboard": [
+                [{"text": "🔴 Bot Lưu Voucher", "url": "https://t.me/nganmiu_bot"}],
+                [{"text": "📦 Bot Check Đơn Hàng", "url": "https://t.me/ShopeeXCheck_Bot"}],
+                [{"text": "📲 Bot Thuê Số (Sắp mở)", "callback_data": "SYSTEM:coming_soon"}],
+                [{"text": "🔙 Quay lại", "callback_data": "SYSTEM:back"}],
+            ]
         }
 
         tg_answer_callback(cb_id)
-        tg_send(
-            user_id,
-            f"👉 Gửi <b>cookie</b> vào đây để lưu <b>{cmd}</b>\n\n"
-            f"⭐ <b>Hỗ trợ lưu tối đa 10 cookie</b>\n"
-            f"💡 Gửi mỗi cookie 1 dòng"
+        tg_edit_message(
+            chat_id,
+            cb_msg_id,
+            "📱 <b>DANH SÁCH BOT NGÂNMIU</b>\n\n"
+            "🤖 Hệ sinh thái bot của chúng tôi:\n\n"
+            "🔴 <b>Bot Lưu Voucher</b>\n"
+            "└ Lưu voucher Shopee tự động\n\n"
+            "📦 <b>Bot Check Đơn Hàng</b>\n"
+            "└ Kiểm tra trạng thái đơn hàng\n\n"
+            "📲 <b>Bot Thuê Số</b> (Sắp ra mắt)\n"
+            "└ Thuê số điện thoại nhận OTP",
+            bot_list_menu
         )
         return
 
-    # ===== SYSTEM MENU CALLBACKS =====
-    if data.startswith("SYSTEM:"):
-        action = data.split(":")[1]
-        
-        if action == "bot_list":
-            bot_list_menu = {
-                "inline_keyboard": [
-                    [{"text": "🔴 Bot Lưu Voucher", "url": "https://t.me/nganmiu_bot"}],
-                    [{"text": "📦 Bot Check Đơn Hàng", "url": "https://t.me/ShopeeXCheck_Bot"}],
-                    [{"text": "📲 Bot Thuê Số (Sắp mở)", "callback_data": "SYSTEM:coming_soon"}],
-                    [{"text": "🔙 Quay lại", "callback_data": "SYSTEM:back"}],
-                ]
-            }
-            
-            tg_answer_callback(cb_id)
-            tg_edit_message(
-                chat_id,
-                cb_msg_id,
-                "📱 <b>DANH SÁCH BOT NGÂNMIU</b>\n\n"
-                "🤖 Hệ sinh thái bot của chúng tôi:\n\n"
-                "🔴 <b>Bot Lưu Voucher</b>\n"
-                "└ Lưu voucher Shopee tự động\n\n"
-                "📦 <b>Bot Check Đơn Hàng</b>\n"
-                "└ Kiểm tra trạng thái đơn hàng\n\n"
-                "📲 <b>Bot Thuê Số</b> (Sắp ra mắt)\n"
-                "└ Thuê số điện thoại nhận OTP",
-                bot_list_menu
-            )
-            return
-        
-        if action == "coming_soon":
-            tg_answer_callback(cb_id, "🚧 Tính năng đang phát triển!", True)
-            return
-        
-        if action == "back":
-            system_menu = {
-                "inline_keyboard": [
-                    [{"text": "👤 Admin hỗ trợ", "url": "https://t.me/BonBonxHPx"}],
-                    [{"text": "👥 Group Hỗ Trợ", "url": "https://t.me/botxshopee"}],
-                    [{"text": "📱 Danh sách Bot", "callback_data": "SYSTEM:bot_list"}],
-                    [{"text": "🔴 Bot Lưu Voucher", "url": "https://t.me/nganmiu_bot"}],
-                    [{"text": "📦 Bot Check Đơn Hàng", "url": "https://t.me/ShopeeXCheck_Bot"}],
-                    [{"text": "📲 Bot Thuê Số", "callback_data": "SYSTEM:coming_soon"}],
-                ]
-            }
-            
-            tg_answer_callback(cb_id)
-            tg_edit_message(
-                chat_id,
-                cb_msg_id,
-                "🏠 <b>HỆ THỐNG BOT NGÂNMIU</b>\n\n"
-                "👋 Chào mừng bạn đến với hệ sinh thái bot NgânMiu!\n\n"
-                "📌 <b>Chọn một trong các dịch vụ bên dưới:</b>",
-                system_menu
-            )
-            return
+    if action == "coming_soon":
+        tg_answer_callback(cb_id, "🚧 Tính năng đang phát triển!", True)
+        return
+
+    if action == "back":
+        system_menu = {
+            "inline_keyboard": [
+                [{"text": "👤 Admin hỗ trợ", "url": "https://t.me/BonBonxHPx"}],
+                [{"text": "👥 Group Hỗ Trợ", "url": "https://t.me/botxshopee"}],
+                [{"text": "📱 Danh sách Bot", "callback_data": "SYSTEM:bot_list"}],
+                [{"text": "🔴 Bot Lưu Voucher", "url": "https://t.me/nganmiu_bot"}],
+                [{"text": "📦 Bot Check Đơn Hàng", "url": "https://t.me/ShopeeXCheck_Bot"}],
+                [{"text": "📲 Bot Thuê Số", "callback_data": "SYSTEM:coming_soon"}],
+            ]
+        }
+
+        tg_answer_callback(cb_id)
+        tg_edit_message(
+            chat_id,
+            cb_msg_id,
+            "🏠 <b>HỆ THỐNG BOT NGÂNMIU</b>\n\n"
+            "👋 Chào mừng bạn đến với hệ sinh thái bot NgânMiu!\n\n"
+            "📌 <b>Chọn một trong các dịch vụ bên dưới:</b>",
+            system_menu
+        )
+        return
+
+
+@CALLBACK_ROUTER.fallback()
+def _cb_unknown(ctx, arg):
+    tg_answer_callback(ctx.cb_id, "⚠️ Thao tác không hỗ trợ", True)
+
+
+def handle_callback_query(cb):
+    from_user = cb.get("from", {})
+    user_id = from_user.get("id")
+    if not user_id:
+        return
 
-    tg_answer_callback(cb_id, "⚠️ Thao tác không hỗ trợ", True)
+    ctx = RouteContext(
+        user_id,
+        cb.get("message", {}).get("chat", {}).get("id"),
+        from_user.get("username", ""),
+        cb=cb
+    )
+    CALLBACK_ROUTER.dispatch(ctx.data, ctx)
 
 # =========================================================
 # TỔNG KẾT KINH DOANH
@@ -3325,6 +4860,12 @@ def get_today_stats():
     stats["napten_users"] = len(stats["napten_users"])
     stats["active_users"] = len(stats["active_users"])
 
+    try:
+        stats["ledger"] = ledger_daily_totals(today)
+    except Exception as e:
+        dprint(f"Error reading wallet_ledger: {e}")
+        stats["ledger"] = {}
+
     return stats
 
 def format_tongket_message(stats):
@@ -3391,6 +4932,12 @@ def format_tongket_message(stats):
 • Tổng: <b>{stats['active_users']}</b> user
 """
 
+    if stats.get("ledger"):
+        msg += "\n━━━━━━━━━━━━━━━━━━\n📒 <b>SỔ CÁI VÍ (PG)</b>"
+        for kind, (count, amount, users) in sorted(stats["ledger"].items()):
+            msg += f"\n• {kind}: <b>{count}</b> lượt | <b>{amount:+,}đ</b> | {users} user"
+        msg += "\n"
+
     return msg
 
 def handle_tongket_command(chat_id, user_id):
@@ -3429,8 +4976,27 @@ def handle_stats_command(chat_id, user_id):
 • Count: {len(BROADCAST_USER_CACHE) if BROADCAST_USER_CACHE else 0}
 • Age: {int(time.time() - BROADCAST_USER_CACHE_TIME)}s
 
-💬 <b>Message Dedup:</b>
-• Tracked: {len(PROCESSED_MESSAGES)}
+📣 <b>Cache Bus:</b>
+{format_cache_bus_stats()}
+
+⚡ <b>Wallet Cache (Redis):</b>
+{format_wallet_cache_stats()}
+
+💬 <b>Update Dedup:</b>
+• Tracked (LRU): {len(PROCESSED_UPDATE_KEYS)}/{DEDUP_LRU_SIZE}
+• Trùng (local/redis): {DEDUP_STATS['dup_local']}/{DEDUP_STATS['dup_redis']}
+
+🧵 <b>Update Lanes:</b>
+{format_priority_stats(UPDATE_DISPATCHER.snapshot())}
+
+🐘 <b>PG Pool:</b>
+{format_pg_pool_stats()}
+
+🐢 <b>Top Query (tổng thời gian):</b>
+{format_query_stats()}
+
+🧭 <b>Routes:</b>
+{format_route_stats()}
 
 ━━━━━━━━━━━━━━━━━━
 <b>✅ Cache hit → Không gọi Sheet</b>
@@ -3446,451 +5012,474 @@ def handle_stats_command(chat_id, user_id):
 def handle_update(update):
     dprint("UPDATE:", update)
 
-    # ✅ UPDATE_ID DEDUPLICATION - Tránh Telegram resend khi lag
+    if is_duplicate_update(update):
+        return
+
+    flow_begin(update)
+    try:
+        process_update(update)
+    except Exception as e:
+        update_failed(update, e)
+        raise
+    finally:
+        flow_end()
+
+def update_failed(update, e):
+    """
+    Xử lý lỗi chung cho mọi đường chạy update (lane sync, ASGI async).
+    Gọi trong context của flow (trước flow_end).
+    Chỉ bỏ đánh dấu dedup khi lỗi xảy ra TRƯỚC mọi side effect (vd PG bận lúc đọc context):
+    chạy lại lúc đó không gửi trùng tin / gọi Shopee / ghi Sheet lần 2.
+    Returns: True nếu đã bỏ đánh dấu dedup (chạy lại update là an toàn)
+    """
+    retryable = not flow_touched()
+    try:
+        e.update_retryable = retryable
+    except Exception:
+        pass
+    if isinstance(e, PgUnavailable):
+        # DB quá tải / mất kết nối → báo user thử lại thay vì trả lời sai (số dư 0, chưa có ID...)
+        print(f"⚠️ PG unavailable for update {update.get('update_id')}: {e}")
+        chat_id = (update.get("message") or update.get("callback_query", {}).get("message") or {}).get("chat", {}).get("id")
+        if chat_id:
+            tg_send(chat_id, "⚠️ <b>Hệ thống đang bận</b>\nVui lòng thử lại sau ít giây.")
+    if not retryable:
+        # Đã có side effect → giữ đánh dấu dedup; stream chuyển entry sang dead-letter để xem tay
+        print(f"⚠️ Update {update.get('update_id')} lỗi sau side effect → không chạy lại: {e}")
+        return False
+    forget_update(update)
+    return True
+
+def _update_dedup_keys(update):
+    """Key dedup: update_id + (chat_id, message_id)"""
+    keys = []
     update_id = update.get("update_id")
-    
     if update_id:
-        if update_id in PROCESSED_UPDATE_IDS:
-            dprint(f"⚠️ DUPLICATE UPDATE_ID DETECTED: {update_id} - SKIPPING")
-            return
-        
-        # ✅ deque tự động drop oldest khi đầy (maxlen=2000)
-        PROCESSED_UPDATE_IDS.append(update_id)
+        keys.append(f"u:{update_id}")
 
-    # ✅ MESSAGE DEDUPLICATION
-    global PROCESSED_MESSAGES
     msg = update.get("message", {})
     message_id = msg.get("message_id")
-
     if message_id:
         chat_id = msg.get("chat", {}).get("id")
-        msg_key = f"{chat_id}_{message_id}"
+        keys.append(f"m:{chat_id}_{message_id}")
+    return keys
 
-        if msg_key in PROCESSED_MESSAGES:
-            dprint(f"⚠️ DUPLICATE MESSAGE DETECTED: {msg_key} - SKIPPING")
-            return
+def is_duplicate_update(update):
+    """
+    ✅ Dedup update_id + (chat_id, message_id)
+    Returns: True nếu update đã xử lý rồi (bỏ qua)
+    """
+    keys = _update_dedup_keys(update)
+    if not keys:
+        return False
 
-        PROCESSED_MESSAGES.add(msg_key)
+    # Tầng 1: LRU trong process
+    for key in keys:
+        if not PROCESSED_UPDATE_KEYS.add(key):
+            DEDUP_STATS["dup_local"] += 1
+            dprint(f"⚠️ DUPLICATE UPDATE DETECTED (local): {key} - SKIPPING")
+            return True
 
-        if len(PROCESSED_MESSAGES) > MAX_PROCESSED_MESSAGES:
-            old_msgs = list(PROCESSED_MESSAGES)[:100]
-            for old_msg in old_msgs:
-                PROCESSED_MESSAGES.discard(old_msg)
-            dprint(f"🗑️ Cleaned {len(old_msgs)} old messages from cache")
+    # Tầng 2: Redis SET NX EX (1 round trip cho tất cả key)
+    if RDS is not None:
+        try:
+            pipe = RDS.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(f"dedup:{key}", 1, nx=True, ex=DEDUP_TTL)
+            if not all(pipe.execute()):
+                DEDUP_STATS["dup_redis"] += 1
+                dprint(f"⚠️ DUPLICATE UPDATE DETECTED (redis): {keys} - SKIPPING")
+                return True
+        except Exception as e:
+            DEDUP_STATS["redis_errors"] += 1
+            dprint(f"Redis dedup error -> local only: {e}")
 
-    # ✅ CHECK BAN STATUS
-    msg = update.get("message") or update.get("callback_query", {}).get("message", {})
-    from_user = msg.get("from") or update.get("callback_query", {}).get("from", {})
-    user_id = from_user.get("id")
+    return False
 
-    if not user_id:
-        return
+def forget_update(update):
+    """Xoá đánh dấu dedup của update (dùng khi xử lý lỗi để cho phép retry)"""
+    keys = _update_dedup_keys(update)
+    for key in keys:
+        PROCESSED_UPDATE_KEYS.discard(key)
+    if RDS is not None and keys:
+        try:
+            RDS.delete(*[f"dedup:{key}" for key in keys])
+        except Exception as e:
+            dprint(f"Redis forget_update error: {e}")
 
-    ban_status = check_ban_status(user_id)
+@MESSAGE_ROUTER.exact("/tongket", priority="bulk")
+def _msg_tongket(ctx, arg):
+    handle_tongket_command(ctx.chat_id, ctx.user_id)
 
-    if ban_status["banned"]:
-        ban_type = ban_status["type"]
-        ban_until = ban_status["until"]
 
-        msg_text = (
-            "⛔ <b>TÀI KHOẢN BỊ KHÓA</b>\n\n"
-            "🚫 <b>Lý do:</b> Spam hệ thống\n"
-        )
+@MESSAGE_ROUTER.exact("/stats")
+def _msg_stats(ctx, arg):
+    handle_stats_command(ctx.chat_id, ctx.user_id)
 
-        if ban_type == "PERMANENT":
-            msg_text += "⏰ <b>Thời gian:</b> Vĩnh viễn\n\n"
-        else:
-            msg_text += (
-                f"⏰ <b>Thời gian:</b> 1 giờ\n"
-                f"⏱️ <b>Hết hạn:</b> {ban_until}\n\n"
-            )
 
-        msg_text += "📞 <b>Liên hệ:</b> @BonBonxHPx"
+@MESSAGE_ROUTER.exact("/update")
+def _msg_update(ctx, arg):
+    chat_id, user_id = ctx.chat_id, ctx.user_id
+    if user_id != ADMIN_ID:
+        tg_send(chat_id, "⛔ Chỉ admin")
+        return
 
-        chat_id = msg.get("chat", {}).get("id")
-        if chat_id:
-            tg_send(chat_id, msg_text)
+    # Xoá cache voucher / keyboard / user trên MỌI worker (không chỉ worker nhận lệnh)
+    publish_invalidation("config")
 
-        return
+    voucher_keyboard, voucher_info = get_voucher_keyboard_cached()
 
-    # ===== CALLBACK QUERY =====
-    if "callback_query" in update:
-        handle_callback_query(update["callback_query"])
-        return
+    # Admin vừa sửa ví / status tay → bỏ cache ví cũ
+    cleared = wallet_cache_clear()
 
-    # ===== MESSAGE =====
-    msg = update.get("message")
-    if not msg:
-        return
+    tg_send(
+        chat_id,
+        "✅ Đã cập nhật keyboard từ Sheet!\n\n"
+        "🎊 <b>Menu đã được refresh</b>\n"
+        f"🧹 Xoá cache ví: {cleared}",
+        build_main_keyboard(is_active=True)
+    )
 
-    chat_id = msg["chat"]["id"]
-    user_id = msg["from"]["id"]
-    username = msg["from"].get("username", "")
-    text = (msg.get("text") or "").strip()
+    tg_send(chat_id, voucher_info, voucher_keyboard)
 
-    # /tongket
-    if text == "/tongket":
-        handle_tongket_command(chat_id, user_id)
-        return
 
-    # /stats - XEM CACHE STATS
-    if text == "/stats":
-        handle_stats_command(chat_id, user_id)
+@MESSAGE_ROUTER.prefix("/thongbao", priority="bulk")
+def _msg_thongbao(ctx, arg):
+    chat_id, user_id, username, text = ctx.chat_id, ctx.user_id, ctx.username, ctx.text
+    msg = ctx.msg
+    if user_id != ADMIN_ID:
+        tg_send(chat_id, "⛔ Lệnh này chỉ dành cho Admin")
         return
 
-    # /update
-    if text == "/update":
-        if user_id != ADMIN_ID:
-            tg_send(chat_id, "⛔ Chỉ admin")
-            return
-
-        global VOUCHER_KEYBOARD_CACHE
-        VOUCHER_KEYBOARD_CACHE = {
-            "keyboard": None,
-            "info_text": None,
-            "last_update": 0
-        }
-
-        voucher_keyboard, voucher_info = get_voucher_keyboard_cached()
+    message_id = msg.get("message_id", 0)
 
+    parts = text.split(maxsplit=1)
+    if len(parts) < 2:
         tg_send(
             chat_id,
-            "✅ Đã cập nhật keyboard từ Sheet!\n\n"
-            "🎊 <b>Menu đã được refresh</b>",
-            build_main_keyboard(is_active=True)
+            "📢 <b>HƯỚNG DẪN BROADCAST</b>\n\n"
+            "Sử dụng: <code>/thongbao [nội dung]</code>\n\n"
+            "Ví dụ:\n"
+            "<code>/thongbao Đêm qua server bị lỗi dẫn tới bot không hoạt động, "
+            "Hiện tại BOT đã hoạt động bình thường trở lại.</code>"
         )
-
-        tg_send(chat_id, voucher_info, voucher_keyboard)
         return
 
-    if not text:
-        if user_id not in PENDING_VOUCHER:
-            return
+    if is_broadcast_message_processed(message_id):
+        tg_send(
+            chat_id,
+            "⚠️ <b>Thông báo này đã được gửi trước đó</b>\n"
+            "Bot đã tự động bỏ qua để tránh gửi lặp."
+        )
+        dprint(f"⚠️ DUPLICATE BROADCAST BLOCKED: msg_id={message_id}")
+        return
 
-    # ===== ADMIN: /thongbao =====
-    if text and text.startswith("/thongbao"):
-        if user_id != ADMIN_ID:
-            tg_send(chat_id, "⛔ Lệnh này chỉ dành cho Admin")
-            return
+    can_broadcast, wait_time = check_broadcast_cooldown_from_sheet()
+    if not can_broadcast:
+        tg_send(
+            chat_id,
+            f"⏳ <b>VUI LÒNG ĐỢI {wait_time}s</b>\n\n"
+            f"🔒 Broadcast gần đây chưa đủ thời gian cooldown\n\n"
+            f"<i>Hệ thống tự động chống spam broadcast.</i>"
+        )
+        dprint(f"⏳ COOLDOWN BLOCKED: wait {wait_time}s")
+        return
 
-        message_id = msg.get("message_id", 0)
+    message = parts[1].strip()
 
-        parts = text.split(maxsplit=1)
-        if len(parts) < 2:
-            tg_send(
-                chat_id,
-                "📢 <b>HƯỚNG DẪN BROADCAST</b>\n\n"
-                "Sử dụng: <code>/thongbao [nội dung]</code>\n\n"
-                "Ví dụ:\n"
-                "<code>/thongbao Đêm qua server bị lỗi dẫn tới bot không hoạt động, "
-                "Hiện tại BOT đã hoạt động bình thường trở lại.</code>"
-            )
-            return
+    global IS_BROADCASTING
+    if IS_BROADCASTING:
+        tg_send(
+            chat_id,
+            "⛔ <b>Đang có broadcast khác chạy</b>\n"
+            "Vui lòng đợi broadcast trước hoàn tất."
+        )
+        return
 
-        if is_broadcast_message_processed(message_id):
-            tg_send(
-                chat_id,
-                "⚠️ <b>Thông báo này đã được gửi trước đó</b>\n"
-                "Bot đã tự động bỏ qua để tránh gửi lặp."
-            )
-            dprint(f"⚠️ DUPLICATE BROADCAST BLOCKED: msg_id={message_id}")
-            return
+    IS_BROADCASTING = True
 
-        can_broadcast, wait_time = check_broadcast_cooldown_from_sheet()
-        if not can_broadcast:
-            tg_send(
-                chat_id,
-                f"⏳ <b>VUI LÒNG ĐỢI {wait_time}s</b>\n\n"
-                f"🔒 Broadcast gần đây chưa đủ thời gian cooldown\n\n"
-                f"<i>Hệ thống tự động chống spam broadcast.</i>"
-            )
-            dprint(f"⏳ COOLDOWN BLOCKED: wait {wait_time}s")
-            return
+    if not set_broadcast_state_to_sheet(user_id, "STARTED", message_id):
+        IS_BROADCASTING = False
+        tg_send(chat_id, "❌ Lỗi khi lưu trạng thái broadcast, vui lòng thử lại")
+        return
 
-        message = parts[1].strip()
+    dprint(f"📝 Broadcast STARTED | admin={user_id} | msg_id={message_id}")
 
-        global IS_BROADCASTING
-        if IS_BROADCASTING:
-            tg_send(
-                chat_id,
-                "⛔ <b>Đang có broadcast khác chạy</b>\n"
-                "Vui lòng đợi broadcast trước hoàn tất."
-            )
-            return
+    tg_send(
+        chat_id,
+        "✅ <b>ĐÃ NHẬN LỆNH BROADCAST</b>\n\n"
+        "⏳ Đang gửi thông báo...\n"
+        "📊 Kết quả sẽ được trả về sau khi hoàn tất."
+    )
 
-        IS_BROADCASTING = True
+    try:
+        dprint(f"🔔 Broadcasting: {message[:40]}...")
+        success, failed = broadcast_message(message, exclude_admin=False)
 
-        if not set_broadcast_state_to_sheet(user_id, "STARTED", message_id):
-            IS_BROADCASTING = False
-            tg_send(chat_id, "❌ Lỗi khi lưu trạng thái broadcast, vui lòng thử lại")
-            return
+        log_row(user_id, username, "BROADCAST", str(success), message[:50])
 
-        dprint(f"📝 Broadcast STARTED | admin={user_id} | msg_id={message_id}")
+        set_broadcast_state_to_sheet(user_id, "COMPLETED", message_id)
 
         tg_send(
             chat_id,
-            "✅ <b>ĐÃ NHẬN LỆNH BROADCAST</b>\n\n"
-            "⏳ Đang gửi thông báo...\n"
-            "📊 Kết quả sẽ được trả về sau khi hoàn tất."
+            f"✅ <b>BROADCAST HOÀN TẤT</b>\n\n"
+            f"👥 Thành công: <b>{success}</b>\n"
+            f"❌ Thất bại: <b>{failed}</b>"
         )
 
-        try:
-            dprint(f"🔔 Broadcasting: {message[:40]}...")
-            success, failed = broadcast_message(message, exclude_admin=False)
+    except Exception as e:
+        dprint(f"❌ Broadcast error: {e}")
+        set_broadcast_state_to_sheet(user_id, "FAILED", message_id)
+        tg_send(chat_id, f"❌ Lỗi khi broadcast: {str(e)}")
+
+    finally:
+        IS_BROADCASTING = False
 
-            log_row(user_id, username, "BROADCAST", str(success), message[:50])
 
-            set_broadcast_state_to_sheet(user_id, "COMPLETED", message_id)
+@MESSAGE_ROUTER.exact("/start", needs=("ban",))
+def _msg_start(ctx, arg):
+    chat_id, user_id, username = ctx.chat_id, ctx.user_id, ctx.username
+    # ✅ Check user mới (UserContext đã đọc ở bước check ban)
+    uctx = ctx.user()
+    is_new_user = not uctx.exists
 
+    ensure_user_exists(user_id, username)
+    if is_new_user:
+        # Vừa tạo: balance=0, status='new' (giống SQL_ENSURE_USER) → không cần SELECT lại
+        uctx.exists, uctx.balance, uctx.status = True, 0, "new"
+    exists, balance, status = uctx.as_wallet()
+
+    # ✅ User chưa kích hoạt (status != 'active') → Hiển thị nút kích hoạt
+    if status != "active":
+        activate_button = {
+            "inline_keyboard": [[
+                {"text": "🎁 Kích hoạt nhận 5,100đ", "callback_data": "activate_gift"}
+            ]]
+        }
+
+        if is_new_user:
+            # User mới
+            tg_send(
+                chat_id,
+                f"🎉 <b>CHÀO MỪNG BẠN MỚI!</b>\n\n"
+                f"👋 Xin chào <b>{username or 'bạn'}</b>\n\n"
+                f"💼 Số dư hiện tại: <b>{balance:,}đ</b>\n"
+                f"📊 Trạng thái: <b>Chưa kích hoạt</b>\n\n"
+                f"🎁 <b>Nhấn nút bên dưới để kích hoạt và nhận {NEW_USER_BONUS:,}đ!</b>",
+                activate_button
+            )
+        else:
+            # User cũ chưa active
             tg_send(
                 chat_id,
-                f"✅ <b>BROADCAST HOÀN TẤT</b>\n\n"
-                f"👥 Thành công: <b>{success}</b>\n"
-                f"❌ Thất bại: <b>{failed}</b>"
+                f"👋 <b>Chào mừng quay lại!</b>\n\n"
+                f"💼 Số dư hiện tại: <b>{balance:,}đ</b>\n"
+                f"📊 Trạng thái: <b>{status}</b>\n\n"
+                f"🎁 <b>Nhấn nút bên dưới để kích hoạt và nhận {ACTIVE_GIFT_AMOUNT:,}đ!</b>",
+                activate_button
             )
+        return
 
-        except Exception as e:
-            dprint(f"❌ Broadcast error: {e}")
-            set_broadcast_state_to_sheet(user_id, "FAILED", message_id)
-            tg_send(chat_id, f"❌ Lỗi khi broadcast: {str(e)}")
+    # ✅ User đã active - Không hiển thị nút kích hoạt
+    tg_send(
+        chat_id,
+        f"👋 <b>Chào mừng quay lại!</b>\n\n"
+        f"💼 Số dư: <b>{balance:,}đ</b>\n"
+        f"📊 Trạng thái: <b>Đã kích hoạt ✅</b>\n\n"
+        f"━━━━━━━━━━━━━━━━━━━━\n"
+        f"🆕 <b>TÍNH NĂNG MỊN</b>\n\n"
+        f"🔑 <b>Get Cookie QR</b>\n"
+        f"├ Quét mã QR để lấy Cookie Shopee\n"
+        f"├ Không cần nhập thủ công\n"
+        f"└ Cookie tự động lưu 7 ngày\n\n"
+        f"🖥️ <b>Tool ADD Voucher PC</b>\n"
+        f"├ Lưu voucher từ máy tính\n"
+        f"├ Tốc độ nhanh hơn 10 lần\n"
+        f"├ Hỗ trợ nhiều tài khoản cùng lúc\n"
+        f"└ Tải ngay: Bấm nút bên dưới\n\n"
+        f"📊 <b>Check Voucher</b>\n"
+        f"├ Kiểm tra trạng thái voucher\n"
+        f"├ Xem % đã dùng, lượt lưu\n"
+        f"└ Cập nhật real-time\n"
+        f"━━━━━━━━━━━━━━━━━━━━",
+        build_main_keyboard(is_active=True)
+    )
 
-        finally:
-            IS_BROADCASTING = False
 
-    # ===== /start =====
-    if text == "/start":
-        # ✅ Check user mới (PG-based)
-        r_check = pg_exec("SELECT tele_id FROM wallet WHERE tele_id=%s", (int(user_id),), fetchone=True) if PG_POOL else None
-        is_new_user = r_check is None
+@MESSAGE_ROUTER.exact("💎 Nạp tiền", "💳 Nạp tiền", needs=("ban",))
+def _msg_topup(ctx, arg):
+    chat_id, user_id, username = ctx.chat_id, ctx.user_id, ctx.username
+    ensure_user_exists(user_id, username)
 
-        ensure_user_exists(user_id, username)
-        exists, balance, status = get_user_data(user_id)
+    qr = build_sepay_qr(user_id)
 
-        # ✅ User chưa kích hoạt (status != 'active') → Hiển thị nút kích hoạt
-        if status != "active":
-            activate_button = {
-                "inline_keyboard": [[
-                    {"text": "🎁 Kích hoạt nhận 5,100đ", "callback_data": "activate_gift"}
-                ]]
-            }
-            
-            if is_new_user:
-                # User mới
-                tg_send(
-                    chat_id,
-                    f"🎉 <b>CHÀO MỪNG BẠN MỚI!</b>\n\n"
-                    f"👋 Xin chào <b>{username or 'bạn'}</b>\n\n"
-                    f"💼 Số dư hiện tại: <b>{balance:,}đ</b>\n"
-                    f"📊 Trạng thái: <b>Chưa kích hoạt</b>\n\n"
-                    f"🎁 <b>Nhấn nút bên dưới để kích hoạt và nhận {NEW_USER_BONUS:,}đ!</b>",
-                    activate_button
-                )
-            else:
-                # User cũ chưa active
-                tg_send(
-                    chat_id,
-                    f"👋 <b>Chào mừng quay lại!</b>\n\n"
-                    f"💼 Số dư hiện tại: <b>{balance:,}đ</b>\n"
-                    f"📊 Trạng thái: <b>{status}</b>\n\n"
-                    f"🎁 <b>Nhấn nút bên dưới để kích hoạt và nhận {ACTIVE_GIFT_AMOUNT:,}đ!</b>",
-                    activate_button
-                )
-            return
+    caption = (
+        "💳 <b>NẠP TIỀN TỰ ĐỘNG (SEPAY)</b>\n\n"
+        "📌 <b>NỘI DUNG CHUYỂN KHOẢN (BẮT BUỘC)</b>\n"
+        f"<code>SEVQR NAP {user_id}</code>\n\n"
+        "⚠️ <b>LƯU Ý</b>\n"
+        "• Nhập <b>ĐÚNG</b> nội dung để hệ thống tự cộng tiền\n"
+        "• Không sửa – không thêm ký tự khác\n\n"
+        "💰 <b>NẠP TỐI THIỂU:</b> <b>10.000đ</b>\n\n"
+        "🎁 <b>ƯU ĐÃI NẠP TIỀN</b>\n"
+        "• ≥ 20.000đ 🎁 +10%\n"
+        "• ≥ 50.000đ 🎁 +15%\n"
+        "• ≥ 100.000đ 🎁 +20%\n\n"
+        "⚡ <i>Tiền vào tài khoản trong vòng 0–30 giây</i>"
+    )
 
-        # ✅ User đã active - Không hiển thị nút kích hoạt
-        tg_send(
-            chat_id,
-            f"👋 <b>Chào mừng quay lại!</b>\n\n"
-            f"💼 Số dư: <b>{balance:,}đ</b>\n"
-            f"📊 Trạng thái: <b>Đã kích hoạt ✅</b>\n\n"
-            f"━━━━━━━━━━━━━━━━━━━━\n"
-            f"🆕 <b>TÍNH NĂNG MỊN</b>\n\n"
-            f"🔑 <b>Get Cookie QR</b>\n"
-            f"├ Quét mã QR để lấy Cookie Shopee\n"
-            f"├ Không cần nhập thủ công\n"
-            f"└ Cookie tự động lưu 7 ngày\n\n"
-            f"🖥️ <b>Tool ADD Voucher PC</b>\n"
-            f"├ Lưu voucher từ máy tính\n"
-            f"├ Tốc độ nhanh hơn 10 lần\n"
-            f"├ Hỗ trợ nhiều tài khoản cùng lúc\n"
-            f"└ Tải ngay: Bấm nút bên dưới\n\n"
-            f"📊 <b>Check Voucher</b>\n"
-            f"├ Kiểm tra trạng thái voucher\n"
-            f"├ Xem % đã dùng, lượt lưu\n"
-            f"└ Cập nhật real-time\n"
-            f"━━━━━━━━━━━━━━━━━━━━",
-            build_main_keyboard(is_active=True)
-        )
-        return
+    tg_send_photo(chat_id, qr, caption)
 
-    # ===== NẠP TIỀN =====
-    if text in ("💎 Nạp tiền", "💳 Nạp tiền"):
-        ensure_user_exists(user_id, username)
-
-        qr = build_sepay_qr(user_id)
-
-        caption = (
-            "💳 <b>NẠP TIỀN TỰ ĐỘNG (SEPAY)</b>\n\n"
-            "📌 <b>NỘI DUNG CHUYỂN KHOẢN (BẮT BUỘC)</b>\n"
-            f"<code>SEVQR NAP {user_id}</code>\n\n"
-            "⚠️ <b>LƯU Ý</b>\n"
-            "• Nhập <b>ĐÚNG</b> nội dung để hệ thống tự cộng tiền\n"
-            "• Không sửa – không thêm ký tự khác\n\n"
-            "💰 <b>NẠP TỐI THIỂU:</b> <b>10.000đ</b>\n\n"
-            "🎁 <b>ƯU ĐÃI NẠP TIỀN</b>\n"
-            "• ≥ 20.000đ 🎁 +10%\n"
-            "• ≥ 50.000đ 🎁 +15%\n"
-            "• ≥ 100.000đ 🎁 +20%\n\n"
-            "⚡ <i>Tiền vào tài khoản trong vòng 0–30 giây</i>"
-        )
 
-        tg_send_photo(chat_id, qr, caption)
-        return
+@MESSAGE_ROUTER.exact("🔑 Get Cookie QR", needs=("ban",))
+def _msg_get_cookie_qr(ctx, arg):
+    handle_get_cookie_qr(ctx.chat_id, ctx.user_id, ctx.username, ctx.user())
 
-    # ===== GET COOKIE QR =====
-    if text == "🔑 Get Cookie QR":
-        handle_get_cookie_qr(chat_id, user_id, username)
-        return
 
-    # ===== USER DATA =====
-    exists, balance, status = get_user_data(user_id)
+@MESSAGE_ROUTER.exact("💰 Số dư", "/balance", needs=("ban", "user"))
+def _msg_balance(ctx, arg):
+    chat_id, user_id = ctx.chat_id, ctx.user_id
+    # ✅ RATE LIMIT: 1 lần/3s per user
+    last_balance_check = CALLBACK_COOLDOWN.get(f"balance_{user_id}", 0)
+    if time.time() - last_balance_check < 3:
+        dprint(f"⏳ Balance check rate-limited: user {user_id}")
+        return  # Silent ignore (không spam user)
+
+    CALLBACK_COOLDOWN[f"balance_{user_id}"] = time.time()
+
+    exists, balance, status = ctx.wallet()
+
     if not exists:
-        tg_send(chat_id, "❌ Bạn chưa có ID. Bấm /start để kích hoạt.")
+        tg_send(chat_id, "❌ Không tìm thấy tài khoản. Bấm /start để kích hoạt.")
         return
 
-    # ===== SỐ DƯ =====
-    if text in ("💰 Số dư", "/balance"):
-        # ✅ RATE LIMIT: 1 lần/3s per user
-        last_balance_check = CALLBACK_COOLDOWN.get(f"balance_{user_id}", 0)
-        if time.time() - last_balance_check < 3:
-            dprint(f"⏳ Balance check rate-limited: user {user_id}")
-            return  # Silent ignore (không spam user)
-        
-        CALLBACK_COOLDOWN[f"balance_{user_id}"] = time.time()
-        
-        exists, balance, status = get_user_data(user_id)
+    dprint(f"💰 Check balance for user {user_id}: {balance:,}đ (status: {status})")
 
-        if not exists:
-            tg_send(chat_id, "❌ Không tìm thấy tài khoản. Bấm /start để kích hoạt.")
-            return
-        
-        dprint(f"💰 Check balance for user {user_id}: {balance:,}đ (status: {status})")
-        
-        tg_send(
-            chat_id,
-            f"💰 <b>Số dư:</b> <b>{balance:,}đ</b>\n"
-            f"📌 Trạng thái: <b>{status}</b>",
-            build_main_keyboard(is_active=(status == "active"))
-        )
-        return
+    tg_send(
+        chat_id,
+        f"💰 <b>Số dư:</b> <b>{balance:,}đ</b>\n"
+        f"📌 Trạng thái: <b>{status}</b>",
+        build_main_keyboard(is_active=(status == "active"))
+    )
+
+
+@MESSAGE_ROUTER.exact("📜 Lịch sử nạp tiền", "/topup_history", needs=("ban", "user"))
+def _msg_topup_history(ctx, arg):
+    tg_send(ctx.chat_id, topup_history_text(ctx.user_id))
 
-    # ===== LỊCH SỬ =====
-    if text in ("📜 Lịch sử nạp tiền", "/topup_history"):
-        tg_send(chat_id, topup_history_text(user_id))
+
+@MESSAGE_ROUTER.exact("🖥️ Tải & Lấy Pass Tool ADD PC", needs=("ban", "user"))
+def _msg_tool_pc(ctx, arg):
+    chat_id, user_id, username = ctx.chat_id, ctx.user_id, ctx.username
+    if PG_POOL is None:
+        tg_send(chat_id, "❌ Hệ thống đang lỗi. Thử lại sau.")
         return
 
-    # ===== TẢI & LẤY PASS TOOL ADD PC =====
-    if text == "🖥️ Tải & Lấy Pass Tool ADD PC":
-        if PG_POOL is None:
-            tg_send(chat_id, "❌ Hệ thống đang lỗi. Thử lại sau.")
-            return
+    import secrets
+    new_pass = secrets.token_hex(8)  # 16 ký tự hex ngẫu nhiên
 
-        import secrets
-        new_pass = secrets.token_hex(8)  # 16 ký tự hex ngẫu nhiên
+    pg_exec("UPDATE wallet SET pass=%s, updated_at=NOW() WHERE tele_id=%s", (new_pass, int(user_id)))
+    wallet_cache_invalidate(user_id)
 
-        pg_exec("UPDATE wallet SET pass=%s, updated_at=NOW() WHERE tele_id=%s", (new_pass, int(user_id)))
+    # mirror sheet (fire-and-forget)
+    if SHEET_READY:
+        try:
+            row = get_user_row(user_id)
+            if row:
+                # cột 7 = pass
+                ws_money.update_cell(row, 7, new_pass)
+        except Exception:
+            pass
 
-        # mirror sheet (fire-and-forget)
-        if SHEET_READY:
-            try:
-                row = get_user_row(user_id)
-                if row:
-                    # cột 7 = pass
-                    ws_money.update_cell(row, 7, new_pass)
-            except Exception:
-                pass
+    # ✅ LẤY LINK TOOL ĐỘNG TỪ VOUCHERSTOCK
+    tool_link = get_tool_pc_link()
 
-        # ✅ LẤY LINK TOOL ĐỘNG TỪ VOUCHERSTOCK
-        tool_link = get_tool_pc_link()
-        
-        if not tool_link:
-            # Fallback link mặc định nếu không tìm thấy
-            tool_link = "https://t.me/botxshopee/2580"
-            dprint("⚠️ Dùng link Tool PC mặc định (không tìm thấy trong sheet)")
+    if not tool_link:
+        # Fallback link mặc định nếu không tìm thấy
+        tool_link = "https://t.me/botxshopee/2580"
+        dprint("⚠️ Dùng link Tool PC mặc định (không tìm thấy trong sheet)")
 
-        tg_send(
-            chat_id,
-            f"🖥️ <b>TOOL ADD VOUCHER PC</b>\n\n"
-            f"📋 <b>Telegram ID:</b> <code>{user_id}</code>\n"
-            f"🔐 <b>Password:</b> <code>{new_pass}</code>\n\n"
-            f"━━━━━━━━━━━━━━━━━━\n\n"
-            f"📥 <b>TẢI TOOL:</b>\n"
-            f"🔗 <a href='{tool_link}'>Tải ToolADDPC.exe</a>\n\n"
-            f"━━━━━━━━━━━━━━━━━━\n\n"
-            f"📖 <b>HƯỚNG DẪN SỬ DỤNG:</b>\n"
-            f"1️⃣ Bấm link bên trên để tải file\n"
-            f"2️⃣ Chạy ToolADDPC.exe\n"
-            f"3️⃣ Nhập Telegram ID + Password (copy bên trên)\n"
-            f"4️⃣ Bấm LOGIN và bắt đầu lưu voucher\n\n"
-            f"💡 <b>Tính năng:</b>\n"
-            f"• Lưu nhiều voucher cùng lúc\n"
-            f"• Hỗ trợ nhiều cookie\n"
-            f"• Get Cookie QR ngay trong tool\n"
-            f"• Tự động trừ tiền từ số dư bot\n\n"
-            f"⚠️ <b>Lưu ý:</b>\n"
-            f"• Windows có thể cảnh báo → Bấm 'Run anyway'\n"
-            f"• Mỗi lần bấm nút sẽ tạo Password mới\n"
-            f"• Tool chỉ chạy trên Windows 10/11\n\n"
-            f"❓ Cần hỗ trợ? → @BonBonxHPx"
-        )
-        
-        # Log download
-        log_row(user_id, username, "GET_TOOL_INFO", "0", f"Lấy thông tin Tool PC | Pass: {new_pass[:4]}***")
-        return
+    tg_send(
+        chat_id,
+        f"🖥️ <b>TOOL ADD VOUCHER PC</b>\n\n"
+        f"📋 <b>Telegram ID:</b> <code>{user_id}</code>\n"
+        f"🔐 <b>Password:</b> <code>{new_pass}</code>\n\n"
+        f"━━━━━━━━━━━━━━━━━━\n\n"
+        f"📥 <b>TẢI TOOL:</b>\n"
+        f"🔗 <a href='{tool_link}'>Tải ToolADDPC.exe</a>\n\n"
+        f"━━━━━━━━━━━━━━━━━━\n\n"
+        f"📖 <b>HƯỚNG DẪN SỬ DỤNG:</b>\n"
+        f"1️⃣ Bấm link bên trên để tải file\n"
+        f"2️⃣ Chạy ToolADDPC.exe\n"
+        f"3️⃣ Nhập Telegram ID + Password (copy bên trên)\n"
+        f"4️⃣ Bấm LOGIN và bắt đầu lưu voucher\n\n"
+        f"💡 <b>Tính năng:</b>\n"
+        f"• Lưu nhiều voucher cùng lúc\n"
+        f"• Hỗ trợ nhiều cookie\n"
+        f"• Get Cookie QR ngay trong tool\n"
+        f"• Tự động trừ tiền từ số dư bot\n\n"
+        f"⚠️ <b>Lưu ý:</b>\n"
+        f"• Windows có thể cảnh báo → Bấm 'Run anyway'\n"
+        f"• Mỗi lần bấm nút sẽ tạo Password mới\n"
+        f"• Tool chỉ chạy trên Windows 10/11\n\n"
+        f"❓ Cần hỗ trợ? → @BonBonxHPx"
+    )
 
-    # ===== HỆ THỐNG BOT =====
-    if text == "🧩 Hệ Thống Bot":
-        system_menu = {
-            "inline_keyboard": [
-                [
-                    {"text": "👤 Admin hỗ trợ", "url": "https://t.me/BonBonxHPx"},
-                    {"text": "👥 Group", "url": "https://t.me/botxshopee"}
-                ],
-                [
-                    {"text": "🔴 Bot Lưu Voucher", "url": "https://t.me/nganmiu_bot"}
-                ],
-                [
-                    {"text": "📦 Bot Check Đơn Hàng", "url": "https://t.me/ShopeeXCheck_Bot"}
-                ],
-                [
-                    {"text": "📲 Bot Thuê Số", "callback_data": "SYSTEM:coming_soon"}
-                ]
+    # Log download
+    log_row(user_id, username, "GET_TOOL_INFO", "0", f"Lấy thông tin Tool PC | Pass: {new_pass[:4]}***")
+
+
+@MESSAGE_ROUTER.exact("🧩 Hệ Thống Bot", needs=("ban", "user"))
+def _msg_system_menu(ctx, arg):
+    chat_id = ctx.chat_id
+    system_menu = {
+        "inline_keyboard": [
+            [
+                {"text": "👤 Admin hỗ trợ", "url": "https://t.me/BonBonxHPx"},
+                {"text": "👥 Group", "url": "https://t.me/botxshopee"}
+            ],
+            [
+                {"text": "🔴 Bot Lưu Voucher", "url": "https://t.me/nganmiu_bot"}
+            ],
+            [
+                {"text": "📦 Bot Check Đơn Hàng", "url": "https://t.me/ShopeeXCheck_Bot"}
+            ],
+            [
+                {"text": "📲 Bot Thuê Số", "callback_data": "SYSTEM:coming_soon"}
             ]
-        }
-        
-        tg_send(
-            chat_id,
-            "🏠 <b>HỆ THỐNG BOT NGÂNMIU</b>\n\n"
-            "👋 Chào mừng bạn đến với hệ sinh thái bot NgânMiu!\n\n"
-            "📌 <b>Chọn một trong các dịch vụ bên dưới:</b>",
-            system_menu
-        )
-        return
+        ]
+    }
 
-    # ===== VOUCHER =====
-    if text in ("🎁 Lưu Voucher", "🎟️Lưu Voucher", "Voucher", "🎟️ Voucher"):
-        tg_send(
-            chat_id,
-            build_voucher_info_text(),
-            build_quick_voucher_keyboard()
-        )
-        return
+    tg_send(
+        chat_id,
+        "🏠 <b>HỆ THỐNG BOT NGÂNMIU</b>\n\n"
+        "👋 Chào mừng bạn đến với hệ sinh thái bot NgânMiu!\n\n"
+        "📌 <b>Chọn một trong các dịch vụ bên dưới:</b>",
+        system_menu
+    )
 
-    # ===== CHECK VOUCHER =====
-    if text in ("📊 Check Voucher", "📊 Check voucher", "/checkvoucher"):
-        handle_check_voucher(user_id, username)
-        return
 
+@MESSAGE_ROUTER.exact("🎁 Lưu Voucher", "🎟️Lưu Voucher", "Voucher", "🎟️ Voucher", needs=("ban", "user"))
+def _msg_voucher_menu(ctx, arg):
+    chat_id = ctx.chat_id
+    tg_send(
+        chat_id,
+        build_voucher_info_text(),
+        build_quick_voucher_keyboard()
+    )
+
+
+@MESSAGE_ROUTER.exact("📊 Check Voucher", "📊 Check voucher", "/checkvoucher", needs=("ban", "user"), priority="bulk")
+def _msg_check_voucher(ctx, arg):
+    handle_check_voucher(ctx.user_id, ctx.username)
+
+
+@MESSAGE_ROUTER.fallback(needs=("ban", "user"), priority=_fallback_message_priority)
+def _msg_fallback(ctx, arg):
+    """Cookie đang chờ, /comboX, /voucherX và lệnh không hợp lệ"""
+    chat_id, user_id, username, text = ctx.chat_id, ctx.user_id, ctx.username, ctx.text
+    exists, balance, status = ctx.wallet()
+    
     # ===== CHẶN LƯU NẾU CHƯA ACTIVE =====
     if status != "active" and (
         text.startswith("/voucher")
@@ -3904,13 +5493,13 @@ def handle_update(update):
     # ===== ĐANG CHỜ COOKIE HOẶC LINK =====
     if user_id in PENDING_VOUCHER and not text.startswith("/"):
         pending_data = PENDING_VOUCHER.pop(user_id)
-        
+
         # ✅ Check nếu là dict (có timestamp) hay string cũ
         if isinstance(pending_data, dict):
             cmd = pending_data["cmd"]
             pending_ts = pending_data["ts"]
             pre_saved_cookie = pending_data.get("cookie")  # ← Cookie từ QUICK_SAVE
-            
+
             # ✅ Check expired (quá 120s)
             if time.time() - pending_ts > PENDING_VOUCHER_TTL:
                 tg_send(
@@ -3942,62 +5531,55 @@ def handle_update(update):
         num_cookies = len(cookies)
         dprint(f"📊 Received {num_cookies} cookies")
 
-        # ✅ Đọc balance từ PostgreSQL
-        exists, balance, status = get_user_data(user_id)
-        if not exists:
-            tg_send(chat_id, "❌ Không tìm thấy ID")
-            return
-
+        # ✅ Ví đã được router đọc (need "user"); lệnh trừ tiền tự kiểm tra số dư
         dprint(f"💰 Balance: {balance:,}đ")
 
         # ----- DYNAMIC COMBO -----
         if cmd.startswith("combo"):
             # 🔥 BƯỚC 1: TÍNH GIÁ TRƯỚC (không lưu voucher)
             ok, total_price, err_msg = calculate_combo_price(cmd, num_cookies)
-            
+
             if not ok:
                 tg_send(chat_id, f"❌ <b>{cmd.upper()} THẤT BẠI</b>\n{err_msg}")
                 return
-            
-            # 🔥 BƯỚC 2: TRỪ TIỀN TRƯỚC
-            success, new_bal = deduct_balance_atomic(user_id, total_price)
-            
-            if not success:
+
+            # 🔥 BƯỚC 2: GIỮ TIỀN TRƯỚC (hold - chưa trừ số dư)
+            hold_id, available = hold_place(user_id, total_price)
+
+            if not hold_id:
                 tg_send(
                     chat_id,
                     f"❌ Không đủ số dư\n"
                     f"💰 Cần: {total_price:,}đ\n"
-                    f"💼 Số dư hiện tại: {new_bal:,}đ"
+                    f"💼 Số dư hiện tại: {available:,}đ"
                 )
                 return
-            
-            # 🔥 BƯỚC 3: ĐÃ TRỪ TIỀN - BÂY GIỜ MỚI LƯU VOUCHER
+
+            # 🔥 BƯỚC 3: ĐÃ GIỮ TIỀN - BÂY GIỜ MỚI LƯU VOUCHER
             ok, _, cookies_saved, total_cookies, vouchers_per_cookie, failed = process_combo_multi_cookies(cookies, cmd)
-            
+
+            # 🔥 BƯỚC 4: SETTLE 1 LẦN - lưu được → trừ, không → nhả hold
+            if ok:
+                _, real_balance = hold_finish(hold_id, user_id, total_price)
+            else:
+                release, real_balance = hold_release(hold_id)
+
             if not ok:
-                # Không lưu được → HOÀN TIỀN ATOMIC
-                update_balance_atomic(user_id, total_price)  # ← ATOMIC
-                
-                # UI: Hiển thị balance TRỰC TIẾP từ Sheet
-                real_balance = get_balance_direct(user_id)
-                
                 tg_send(
                     chat_id,
                     f"❌ <b>{cmd.upper()} THẤT BẠI</b>\n"
-                    f"💸 Đã hoàn tiền: +{total_price:,}đ\n"
-                    f"💰 Số dư: <b>{real_balance:,}đ</b>"
+                    f"{fmt_hold_release(release, total_price)}"
+                    f"💰 Số dư: <b>{fmt_balance(real_balance)}</b>"
                 )
                 return
 
             log_row(user_id, username, cmd.upper(), str(total_price), f"Lưu {cmd.upper()} {cookies_saved}/{total_cookies} thành công")
 
-            # ✅ UI: Luôn hiển thị balance TRỰC TIẾP từ Sheet
-            real_balance = get_balance_direct(user_id)
-            
+            # ✅ UI: real_balance = số dư sau settle (RETURNING)
             if cookies_saved == total_cookies:
-                msg_text = f"✅ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
+                msg_text = f"✅ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
             else:
-                msg_text = f"⚠️ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
+                msg_text = f"⚠️ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
 
             tg_send(chat_id, msg_text)
             tg_send(chat_id, "👉 <b>Bấm để lưu tiếp nhanh</b>", build_quick_buy_keyboard(cmd))
@@ -4013,57 +5595,48 @@ def handle_update(update):
         price = int(v.get("Giá", 0))
         total_price = price * num_cookies
 
-        # ✅ ATOMIC DEDUCT - Trừ tiền TRƯỚC khi lưu voucher
-        success, new_bal = deduct_balance_atomic(user_id, total_price)
-        
-        if not success:
+        # ✅ HOLD - Giữ tiền TRƯỚC khi lưu voucher (chưa trừ số dư)
+        hold_id, available = hold_place(user_id, total_price)
+
+        if not hold_id:
             tg_send(
                 chat_id, 
                 f"❌ Không đủ số dư\n"
                 f"💰 Cần: {total_price:,}đ ({price:,}đ × {num_cookies})\n"
-                f"💼 Số dư hiện tại: {new_bal:,}đ"
+                f"💼 Số dư hiện tại: {available:,}đ"
             )
             # ✅ KHÔNG track_error - không đủ tiền là lỗi nghiệp vụ
             return
 
-        # ✅ ĐÃ TRỪ TIỀN - Bây giờ mới lưu voucher
+        # ✅ ĐÃ GIỮ TIỀN - Bây giờ mới lưu voucher
         success_count, total_count, failed_details = save_voucher_multi_cookies(cookies, v)
 
+        # ✅ SETTLE 1 LẦN: trừ đúng số cookie thành công, phần còn lại tự nhả (không cần hoàn tiền)
+        actual_price = price * success_count
+        if success_count:
+            _, real_balance = hold_finish(hold_id, user_id, actual_price)
+        else:
+            release, real_balance = hold_release(hold_id)
+
         if success_count == 0:
-            # ✅ HOÀN TIỀN ATOMIC vì không lưu được cookie nào
-            update_balance_atomic(user_id, total_price)  # ← ATOMIC
-            
-            # UI: Hiển thị balance TRỰC TIẾP từ Sheet
-            real_balance = get_balance_direct(user_id)
-            
             tg_send(
                 chat_id,
                 f"❌ Không lưu được cookie nào\n"
-                f"💸 Đã hoàn tiền: +{total_price:,}đ\n"
-                f"💰 Số dư hiện tại: <b>{real_balance:,}đ</b>"
+                f"{fmt_hold_release(release, total_price)}"
+                f"💰 Số dư hiện tại: <b>{fmt_balance(real_balance)}</b>"
             )
             # ✅ KHÔNG track_error - cookie lỗi/Shopee lỗi là lỗi nghiệp vụ
             return
 
-        # ✅ Lưu được một số cookie
-        actual_price = price * success_count
-        
-        # ✅ Hoàn tiền ATOMIC cho cookie thất bại
         if success_count < num_cookies:
-            refund = price * (num_cookies - success_count)
-            update_balance_atomic(user_id, refund)  # ← ATOMIC
-            
-            dprint(f"💸 Refunded {refund:,}đ for {num_cookies - success_count} failed cookies")
+            dprint(f"💸 Released {price * (num_cookies - success_count):,}đ for {num_cookies - success_count} failed cookies")
 
         log_row(user_id, username, "VOUCHER", str(actual_price), f"Lưu {cmd} {success_count}/{total_count} thành công")
-        
-        # ✅ UI: Luôn hiển thị balance TRỰC TIẾP từ Sheet
-        real_balance = get_balance_direct(user_id)
 
         if success_count == total_count:
-            msg_text = f"✅ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
+            msg_text = f"✅ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
         else:
-            msg_text = f"⚠️ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
+            msg_text = f"⚠️ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
 
         tg_send(chat_id, msg_text)
         tg_send(chat_id, "👉 <b>Bấm để lưu tiếp nhanh</b>", build_quick_buy_keyboard(cmd))
@@ -4105,7 +5678,7 @@ def handle_update(update):
                 "cmd": cmd,
                 "ts": time.time()
             }
-            
+
             tg_send(
                 chat_id,
                 f"👉 Gửi <b>cookie</b> để lưu {cmd}\n\n"
@@ -4124,50 +5697,48 @@ def handle_update(update):
 
         # 🔥 BƯỚC 1: TÍNH GIÁ TRƯỚC
         ok, total_price, err_msg = calculate_combo_price(cmd, num_cookies)
-        
+
         if not ok:
             tg_send(chat_id, f"❌ {cmd.upper()} THẤT BẠI\n{err_msg}")
             return
 
-        # 🔥 BƯỚC 2: TRỪ TIỀN TRƯỚC
-        success, new_bal = deduct_balance_atomic(user_id, total_price)
-        
-        if not success:
+        # 🔥 BƯỚC 2: GIỮ TIỀN TRƯỚC (hold - chưa trừ số dư)
+        hold_id, available = hold_place(user_id, total_price)
+
+        if not hold_id:
             tg_send(
                 chat_id,
                 f"❌ Không đủ số dư\n"
                 f"💰 Cần: {total_price:,}đ\n"
-                f"💼 Số dư hiện tại: {new_bal:,}đ"
+                f"💼 Số dư hiện tại: {available:,}đ"
             )
             return
-        
-        # 🔥 BƯỚC 3: ĐÃ TRỪ TIỀN - BÂY GIỜ MỚI LƯU
+
+        # 🔥 BƯỚC 3: ĐÃ GIỮ TIỀN - BÂY GIỜ MỚI LƯU
         ok, _, cookies_saved, total_cookies, vouchers_per_cookie, failed = process_combo_multi_cookies(cookies, cmd)
 
+        # 🔥 BƯỚC 4: SETTLE 1 LẦN - lưu được → trừ, không → nhả hold
+        if ok:
+            _, real_balance = hold_finish(hold_id, user_id, total_price)
+        else:
+            release, real_balance = hold_release(hold_id)
+
         if not ok:
-            # Không lưu được → HOÀN TIỀN ATOMIC
-            update_balance_atomic(user_id, total_price)  # ← ATOMIC
-            
-            # UI: Hiển thị balance TRỰC TIẾP từ Sheet
-            real_balance = get_balance_direct(user_id)
-            
             tg_send(
                 chat_id,
                 f"❌ {cmd.upper()} THẤT BẠI\n"
-                f"💸 Đã hoàn tiền: +{total_price:,}đ\n"
-                f"💰 Số dư: <b>{real_balance:,}đ</b>"
+                f"{fmt_hold_release(release, total_price)}"
+                f"💰 Số dư: <b>{fmt_balance(real_balance)}</b>"
             )
             return
 
         log_row(user_id, username, cmd.upper(), str(total_price), f"Lưu {cmd.upper()} {cookies_saved}/{total_cookies} thành công")
 
-        # ✅ UI: Luôn hiển thị balance TRỰC TIẾP từ Sheet
-        real_balance = get_balance_direct(user_id)
-        
+        # ✅ UI: real_balance = số dư sau settle (RETURNING)
         if cookies_saved == total_cookies:
-            msg_text = f"✅ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
+            msg_text = f"✅ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
         else:
-            msg_text = f"⚠️ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
+            msg_text = f"⚠️ Lưu {cmd.upper()} <b>{cookies_saved}/{total_cookies}</b> thành công | -{total_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
 
         tg_send(chat_id, msg_text, build_main_keyboard(is_active=True))
         return
@@ -4185,7 +5756,7 @@ def handle_update(update):
                 "cmd": cmd,
                 "ts": time.time()
             }
-            
+
             tg_send(
                 chat_id,
                 f"👉 Gửi <b>cookie</b> để lưu {cmd}\n\n"
@@ -4194,185 +5765,1565 @@ def handle_update(update):
             )
             return
 
-        cookies = parse_cookies(cookie_text)
+        cookies = parse_cookies(cookie_text)
+
+        if not cookies:
+            tg_send(chat_id, "❌ Không tìm thấy cookie hợp lệ")
+            return
+
+        num_cookies = len(cookies)
+
+        # ✅ Ví đã được router đọc (need "user"); lệnh trừ tiền tự kiểm tra số dư
+        dprint(f"💰 Balance: {balance:,}đ")
+
+        v, err = get_voucher(cmd)
+        if err:
+            tg_send(chat_id, f"❌ {err}")
+            # ✅ KHÔNG track_error - lỗi nghiệp vụ
+            return
+
+        price = int(v.get("Giá", 0))
+        total_price = price * num_cookies
+
+        # ✅ HOLD - Giữ tiền TRƯỚC (chưa trừ số dư)
+        hold_id, available = hold_place(user_id, total_price)
+
+        if not hold_id:
+            tg_send(
+                chat_id,
+                f"❌ Không đủ số dư\n"
+                f"💰 Cần: {total_price:,}đ\n"
+                f"💼 Số dư hiện tại: {available:,}đ"
+            )
+            # ✅ KHÔNG track_error - lỗi nghiệp vụ
+            return
+
+        # ✅ ĐÃ GIỮ TIỀN - Bây giờ lưu voucher
+        success_count, total_count, failed_details = save_voucher_multi_cookies(cookies, v)
+
+        # ✅ SETTLE 1 LẦN: trừ đúng số cookie thành công, phần còn lại tự nhả
+        actual_price = price * success_count
+        if success_count:
+            _, real_balance = hold_finish(hold_id, user_id, actual_price)
+        else:
+            release, real_balance = hold_release(hold_id)
+
+        if success_count == 0:
+            tg_send(
+                chat_id,
+                f"❌ Không lưu được cookie nào\n"
+                f"{fmt_hold_release(release, total_price)}"
+                f"💰 Số dư hiện tại: <b>{fmt_balance(real_balance)}</b>"
+            )
+            # ✅ KHÔNG track_error - lỗi nghiệp vụ
+            return
+
+        log_row(user_id, username, "VOUCHER", str(actual_price), f"Lưu {cmd} {success_count}/{total_count} thành công")
+
+        if success_count == total_count:
+            msg_text = f"✅ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
+        else:
+            msg_text = f"⚠️ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{fmt_balance(real_balance)}</b>"
+
+        tg_send(chat_id, msg_text, build_main_keyboard(is_active=True))
+        return
+
+    # ===== FALLBACK =====
+    tg_send(
+        chat_id,
+        "❌ <b>Lệnh không hợp lệ</b>\nDùng /start để xem menu.",
+        build_main_keyboard(is_active=True)
+    )
+
+
+def process_update(update, uctx=None):
+    """Xử lý update (đã qua dedup) qua bảng route. uctx: UserContext đã đọc sẵn (bản async) → không đọc lại"""
+    # ===== CALLBACK QUERY =====
+    if "callback_query" in update:
+        handle_callback_query(update["callback_query"])
+        return
+
+    # ===== MESSAGE =====
+    msg = update.get("message")
+    if not msg:
+        return
+
+    from_user = msg.get("from", {})
+    user_id = from_user.get("id")
+    if not user_id:
+        return
+
+    ctx = RouteContext(
+        user_id,
+        msg["chat"]["id"],
+        from_user.get("username", ""),
+        msg=msg,
+        user=uctx if uctx is not None and uctx.user_id == int(user_id) else None,
+    )
+
+    if not ctx.text and user_id not in PENDING_VOUCHER:
+        return
+
+    MESSAGE_ROUTER.dispatch(ctx.text, ctx)
+
+# =========================================================
+# SEPAY WEBHOOK
+# =========================================================
+@app.route("/webhook-sepay", methods=["POST", "GET"])
+def webhook_sepay():
+    if request.method == "GET":
+        return "OK", 200
+
+    data = request.get_json(force=True, silent=True) or {}
+    if not data:
+        return "EMPTY", 200
+
+    tx_id = str(
+        data.get("id")
+        or data.get("transaction_id")
+        or data.get("tx_id")
+        or data.get("referenceCode")
+        or ""
+    ).strip()
+
+    try:
+        amount = int(
+            data.get("transferAmount")
+            or data.get("amount")
+            or data.get("amount_in")
+            or 0
+        )
+    except Exception:
+        amount = 0
+
+    desc = " ".join([
+        str(data.get("content") or ""),
+        str(data.get("description") or ""),
+        str(data.get("remark") or ""),
+        str(data.get("note") or "")
+    ]).strip()
+
+    if not tx_id or amount <= 0:
+        print("[SEPAY] INVALID DATA:", data)
+        return "INVALID", 200
+
+    # PG là nơi duy nhất chống nạp trùng → chưa sẵn sàng thì để SePay gửi lại sau
+    if PG_POOL is None:
+        print("[SEPAY] PG NOT READY:", tx_id)
+        return "DB_NOT_READY", 503
+
+    m = re.search(r"(?:SEVQR\s*)?NAP\s*(\d{6,})", desc, re.I)
+    if not m:
+        print("[SEPAY] NO USER FOUND | DESC =", desc)
+        return "NO_USER", 200
+
+    user_id = int(m.group(1))
+
+    if amount < MIN_TOPUP_AMOUNT:
+        tg_send(
+            user_id,
+            f"❌ <b>Nạp tối thiểu {MIN_TOPUP_AMOUNT:,}đ</b>"
+        )
+        return "TOO_SMALL", 200
+
+    percent, bonus = calc_topup_bonus(amount)
+    total_add = amount + bonus
+
+    # ✅ EXACTLY-ONCE - ghi processed_tx + cộng tiền trong 1 statement (tự tạo ví nếu chưa có)
+    # PG lỗi (mất kết nối, timeout, deadlock...) → 503 → SePay tự gửi lại, không mất / không cộng trùng
+    # Cộng tiền chạy ngay trong request; phần còn lại đưa sang pool "payment"
+    try:
+        credited, new_balance = credit_topup_once(
+            tx_id, user_id, amount, total_add, note=f"{amount:,} + bonus {bonus:,}"
+        )
+    except PgUnavailable as e:
+        print(f"[SEPAY] PG ERROR tx={tx_id}: {e}")
+        return "DB_ERROR", 503, {"Retry-After": str(WEBHOOK_RETRY_AFTER)}
+    if not credited:
+        print("[SEPAY] DUPLICATE TX:", tx_id)
+        return "DUPLICATE", 200
+
+    if not UPDATE_DISPATCHER.submit(
+        "payment", user_id, sepay_after_credit,
+        user_id, amount, bonus, percent, tx_id, new_balance
+    ):
+        # Pool payment đầy → làm luôn, không bao giờ bỏ thông báo nạp tiền
+        sepay_after_credit(user_id, amount, bonus, percent, tx_id, new_balance)
+
+    return "OK", 200
+
+def sepay_after_credit(user_id, amount, bonus, percent, tx_id, new_balance):
+    """Ghi Sheet + log + báo user sau khi đã cộng tiền (chạy trên pool payment)"""
+    total_add = amount + bonus
+    note = f"+{int(percent * 100)}%={bonus}" if bonus > 0 else ""
+
+    save_topup_to_sheet(
+        user_id=user_id,
+        username="",
+        amount=amount,
+        loai="SEPAY",
+        tx_id=tx_id,
+        note=note
+    )
+
+    log_row(user_id, "", "TOPUP_SEPAY", str(total_add), tx_id)
+
+    # ✅ Số dư lấy từ RETURNING của lệnh cộng tiền (không SELECT lại)
+    real_balance = new_balance
+    
+    msg = (
+        "💰 <b>NẠP TIỀN THÀNH CÔNG</b>\n"
+        f"➕ Gốc: <b>{amount:,}đ</b>\n"
+    )
+
+    if bonus > 0:
+        msg += f"🎁 Thưởng: <b>{bonus:,}đ</b>\n"
+
+    msg += f"💼 Số dư: <b>{fmt_balance(real_balance)}</b>"
+
+    tg_send(user_id, msg)
+
+# =========================================================
+# 🧵 UPDATE WORKER POOL - THREAD CỐ ĐỊNH + HÀNG ĐỢI CÓ GIỚI HẠN
+# =========================================================
+# Update của cùng 1 user luôn vào cùng lane và không bao giờ chạy song song với nhau
+# → xử lý tuần tự đúng thứ tự (BUY rồi mới tới cookie), user khác chạy song song.
+UPDATE_LANES = int(os.getenv("UPDATE_LANES", os.getenv("UPDATE_WORKERS", "8")))
+UPDATE_LANE_QUEUE_SIZE = int(os.getenv("UPDATE_LANE_QUEUE_SIZE", "50"))
+
+# ⚖️ PRIORITY CLASSES: ưu tiên + ngân sách hàng đợi riêng cho từng class BÊN TRONG mỗi lane
+# → tiền nạp / lưu voucher của user khác trong lane được chạy trước /checkvoucher, broadcast
+#   payment     : việc sau khi cộng tiền SePay (thông báo, ghi Sheet)
+#   purchase    : BUY / QUICK_SAVE / gửi cookie / /voucherX /comboX
+#   interactive : menu, /start, số dư...
+#   bulk        : /checkvoucher, /thongbao, /tongket
+PRIORITY_CLASSES = ("payment", "purchase", "interactive", "bulk")
+PRIORITY_QUEUE_SIZE = {
+    "payment": UPDATE_LANE_QUEUE_SIZE,
+    "purchase": UPDATE_LANE_QUEUE_SIZE,
+    "interactive": UPDATE_LANE_QUEUE_SIZE,
+    "bulk": int(os.getenv("BULK_LANE_QUEUE_SIZE", "10")),
+}
+# Ngân sách worker (thread) mỗi lane theo class - việc dài không chiếm hết thread của lane:
+#   bulk chạy tối đa LANE_BULK_WORKERS việc cùng lúc, bulk + interactive tối đa thêm LANE_INTERACTIVE_WORKERS,
+#   LANE_RESERVED_WORKERS thread chỉ payment / purchase dùng được
+# → /checkvoucher, /thongbao đang chạy không chặn tiền nạp / mua hàng của user khác cùng lane
+LANE_BULK_WORKERS = max(1, int(os.getenv("LANE_BULK_WORKERS", "1")))
+LANE_INTERACTIVE_WORKERS = max(1, int(os.getenv("LANE_INTERACTIVE_WORKERS", "1")))
+LANE_RESERVED_WORKERS = max(1, int(os.getenv("LANE_RESERVED_WORKERS", "1")))
+PRIORITY_WORKER_LIMIT = {
+    "bulk": LANE_BULK_WORKERS,
+    "interactive": LANE_BULK_WORKERS + LANE_INTERACTIVE_WORKERS,
+    "purchase": LANE_BULK_WORKERS + LANE_INTERACTIVE_WORKERS + LANE_RESERVED_WORKERS,
+    "payment": LANE_BULK_WORKERS + LANE_INTERACTIVE_WORKERS + LANE_RESERVED_WORKERS,
+}
+WEBHOOK_RETRY_AFTER = int(os.getenv("WEBHOOK_RETRY_AFTER", "5"))  # giây, gửi kèm 503
+# Stream / poll: class trong lane đầy → giữ update ở bộ đệm này thay vì chặn cả vòng đọc
+DISPATCH_BACKLOG_SIZE = int(os.getenv("DISPATCH_BACKLOG_SIZE", "1000"))
+
+class BoundedWorkQueue:
+    """
+    Pool thread cố định + hàng đợi có giới hạn.
+    - submit() trả False khi hàng đợi đầy (không tạo thêm thread)
+    - Thread chỉ start khi submit lần đầu trong process hiện tại
+    - snapshot() trả depth / wait time / số lần từ chối để chỉnh size
+    """
+
+    def __init__(self, name, workers, maxsize):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self._q = queue.Queue(maxsize=max(1, int(maxsize)))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._waits = deque(maxlen=500)  # wait time gần nhất (giây) để tính p95
+        self.stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "errors": 0,
+            "in_flight": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+            self._pid = pid
+
+    def submit(self, fn, *args, block=False, timeout=None):
+        """Đưa job vào hàng đợi. Returns: True nếu nhận, False nếu đầy."""
+        self._ensure_started()
+        try:
+            self._q.put((time.time(), fn, args), block=block, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.stats["rejected"] += 1
+            return False
+        with self._lock:
+            self.stats["submitted"] += 1
+        return True
+
+    def _run(self):
+        while True:
+            enqueued_at, fn, args = self._q.get()
+            waited = time.time() - enqueued_at
+            with self._lock:
+                self.stats["in_flight"] += 1
+                self.stats["wait_total"] += waited
+                if waited > self.stats["wait_max"]:
+                    self.stats["wait_max"] = waited
+                self._waits.append(waited)
+            try:
+                fn(*args)
+            except Exception as e:
+                with self._lock:
+                    self.stats["errors"] += 1
+                print(f"[{self.name}] job error: {e}")
+                dprint(traceback.format_exc())
+            finally:
+                with self._lock:
+                    self.stats["in_flight"] -= 1
+                    self.stats["completed"] += 1
+                self._q.task_done()
+
+    def drain(self, deadline):
+        """Chờ tới khi hết job (queue + đang chạy) hoặc quá deadline. Returns: True nếu sạch."""
+        while time.time() < deadline:
+            with self._lock:
+                busy = self.stats["in_flight"]
+            if not busy and self._q.empty():
+                return True
+            time.sleep(0.1)
+        return False
+
+    def take_pending(self):
+        """Lấy ra các job chưa chạy (dùng khi shutdown). Returns: [(fn, args)]"""
+        jobs = []
+        while True:
+            try:
+                _, fn, args = self._q.get_nowait()
+            except queue.Empty:
+                return jobs
+            self._q.task_done()
+            jobs.append((fn, args))
+
+    def snapshot(self):
+        with self._lock:
+            s = dict(self.stats)
+            waits = sorted(self._waits)
+        done = s["completed"] + s["in_flight"]
+        s["name"] = self.name
+        s["workers"] = self.workers
+        s["depth"] = self._q.qsize()
+        s["capacity"] = self._q.maxsize
+        s["wait_avg_ms"] = round(s.pop("wait_total") / done * 1000, 1) if done else 0.0
+        s["wait_max_ms"] = round(s.pop("wait_max") * 1000, 1)
+        s["wait_p95_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0.0
+        return s
+
+# Ghi Sheet (mirror ví, thêm user mới) chạy nền trên 1 thread, đầy thì bỏ (Sheet chỉ để theo dõi)
+SHEET_MIRROR_QUEUE = BoundedWorkQueue("sheet-mirror", 1, int(os.getenv("SHEET_MIRROR_QUEUE_SIZE", "1000")))
+
+def extract_update_user_id(update):
+    """Lấy user_id của update (message / callback_query). Returns: int hoặc None"""
+    for key in ("message", "edited_message", "callback_query"):
+        part = update.get(key)
+        if isinstance(part, dict):
+            uid = (part.get("from") or {}).get("id")
+            if uid:
+                return int(uid)
+    return None
+
+def update_lane_key(update):
+    """Key chọn lane: user_id, không có user thì update_id"""
+    key = extract_update_user_id(update)
+    if key is None:
+        key = int(update.get("update_id") or 0)
+    return key
+
+def classify_update(update):
+    """Xếp update vào priority class theo route mà nó sẽ đi vào (không đọc DB)"""
+    cb = update.get("callback_query")
+    if isinstance(cb, dict):
+        user_id = (cb.get("from") or {}).get("id")
+        return CALLBACK_ROUTER.priority_for(cb.get("data", ""), user_id)
+
+    msg = update.get("message")
+    if isinstance(msg, dict):
+        user_id = (msg.get("from") or {}).get("id")
+        return MESSAGE_ROUTER.priority_for((msg.get("text") or "").strip(), user_id)
+
+    return "interactive"
+
+class PriorityLane:
+    """
+    1 lane = vài thread (PRIORITY_WORKER_LIMIT), mỗi user trong lane có hàng đợi riêng.
+    - User đang có việc chạy → việc sau của user chờ: update của 1 user chạy đúng thứ tự, kể cả khác class
+    - Class tính lúc nhận; việc trở thành việc đầu sau khi việc trước của user xong thì tính lại
+      (PENDING_VOUCHER đã set) - mỗi việc tính tối đa 2 lần, không quét cả lane mỗi lần chọn
+    - Chọn: class ưu tiên cao trước, cùng class thì FIFO (heap theo thời điểm nhận)
+    - Ngân sách worker: class c chỉ chạy khi số việc đang chạy của c và các class thấp hơn
+      < PRIORITY_WORKER_LIMIT[c] → luôn còn thread rảnh cho payment / purchase
+    - Ngân sách hàng đợi theo class lúc nhận → bulk đầy không từ chối payment / purchase
+    """
+
+    def __init__(self, name, queue_size_by_class, worker_limit=None):
+        self.name = name
+        self._capacity = {k: max(1, int(v)) for k, v in queue_size_by_class.items()}
+        self._worker_limit = dict(worker_limit or PRIORITY_WORKER_LIMIT)
+        self.workers = max(self._worker_limit.values())
+        self._cond = threading.Condition()
+        self._users = {}       # key → deque[job]; job = [enqueued_at, klass, fn, args, update, run_class]
+        self._running = set()  # key của user đang có việc chạy
+        self._ready = {k: [] for k in PRIORITY_CLASSES}  # heap (enqueued_at, seq, key) việc đầu sẵn sàng
+        self._seq = itertools.count()
+        self._pid = None
+        self._waits = {k: deque(maxlen=500) for k in PRIORITY_CLASSES}
+        self.stats = {
+            k: {
+                "depth": 0,
+                "submitted": 0,
+                "rejected": 0,
+                "completed": 0,
+                "errors": 0,
+                "in_flight": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+            }
+            for k in PRIORITY_CLASSES
+        }
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._cond:
+            if self._pid == pid:
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"{self.name}-w{i}", daemon=True).start()
+            self._pid = pid
+
+    def submit(self, klass, key, fn, args, update=None, block=False, timeout=None):
+        """Returns: True nếu nhận, False nếu ngân sách của class đầy"""
+        self._ensure_started()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            st = self.stats[klass]
+            while st["depth"] >= self._capacity[klass]:
+                remaining = None if deadline is None else deadline - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    st["rejected"] += 1
+                    return False
+                self._cond.wait(remaining)
+            jobs = self._users.setdefault(key, deque())
+            job = [time.time(), klass, fn, args, update, klass]
+            jobs.append(job)
+            if len(jobs) == 1 and key not in self._running:
+                self._push_ready(key, job)
+            st["depth"] += 1
+            st["submitted"] += 1
+            self._cond.notify_all()
+        return True
+
+    def _push_ready(self, key, job):
+        heapq.heappush(self._ready[job[5]], (job[0], next(self._seq), key))
+
+    def _can_run(self, klass):
+        """Chạy thêm 1 việc klass vẫn giữ mọi ngân sách gộp có chứa klass (class đó và các class cao hơn)"""
+        idx = PRIORITY_CLASSES.index(klass)
+        for i in range(idx + 1):
+            busy = sum(self.stats[k]["in_flight"] for k in PRIORITY_CLASSES[i:])
+            if busy >= self._worker_limit[PRIORITY_CLASSES[i]]:
+                return False
+        return True
+
+    def _pick(self):
+        """Chọn việc kế tiếp (đang giữ lock). Returns: (key, job) | None nếu chưa có việc chạy được"""
+        for klass in PRIORITY_CLASSES:
+            heap = self._ready[klass]
+            if not heap or not self._can_run(klass):
+                continue
+            _, _, key = heapq.heappop(heap)
+            jobs = self._users[key]
+            job = jobs.popleft()
+            if not jobs:
+                del self._users[key]
+            self._running.add(key)
+            return key, job
+        return None
+
+    def _finish(self, key):
+        """Việc của user xong (đang giữ lock) → việc kế tiếp của user thành việc đầu, tính lại class"""
+        self._running.discard(key)
+        jobs = self._users.get(key)
+        if not jobs:
+            return
+        head = jobs[0]
+        if head[4] is not None:
+            try:
+                head[5] = classify_update(head[4])
+            except Exception:
+                pass
+        self._push_ready(key, head)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                picked = self._pick()
+                while picked is None:
+                    self._cond.wait()
+                    picked = self._pick()
+                key, (enqueued_at, klass, fn, args, _, run_class) = picked
+                waited = time.time() - enqueued_at
+                self.stats[klass]["depth"] -= 1
+                st = self.stats[run_class]
+                st["in_flight"] += 1
+                st["wait_total"] += waited
+                if waited > st["wait_max"]:
+                    st["wait_max"] = waited
+                self._waits[run_class].append(waited)
+                self._cond.notify_all()
+            try:
+                fn(*args)
+            except Exception as e:
+                with self._cond:
+                    st["errors"] += 1
+                print(f"[{self.name}] job error: {e}")
+                dprint(traceback.format_exc())
+            finally:
+                with self._cond:
+                    st["in_flight"] -= 1
+                    st["completed"] += 1
+                    self._finish(key)
+                    self._cond.notify_all()
+
+    def busy(self):
+        with self._cond:
+            return bool(self._users) or bool(self._running)
+
+    def take_pending(self):
+        """Lấy ra các job chưa chạy theo thứ tự nhận (dùng khi shutdown). Returns: [(enqueued_at, fn, args)]"""
+        with self._cond:
+            jobs = [(j[0], j[2], j[3]) for q in self._users.values() for j in q]
+            self._users.clear()
+            for heap in self._ready.values():
+                heap.clear()
+            for st in self.stats.values():
+                st["depth"] = 0
+            self._cond.notify_all()
+        return jobs
+
+    def snapshot(self, klass):
+        with self._cond:
+            s = dict(self.stats[klass])
+            waits = sorted(self._waits[klass])
+        done = s["completed"] + s["in_flight"]
+        s["name"] = self.name
+        s["capacity"] = self._capacity[klass]
+        s["worker_limit"] = self._worker_limit[klass]
+        s["wait_avg_ms"] = round(s.pop("wait_total") / done * 1000, 1) if done else 0.0
+        s["wait_max_ms"] = round(s.pop("wait_max") * 1000, 1)
+        s["wait_p95_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0.0
+        return s
+
+class PriorityDispatcher:
+    """
+    Lane theo hash user_id (cùng user → cùng lane → tuần tự), priority chỉ áp dụng trong lane.
+    Class đầy chỉ từ chối việc của class đó trong lane đó.
+    """
+
+    def __init__(self, name, lanes, queue_size_by_class):
+        self.lanes = [PriorityLane(f"{name}-{i}", queue_size_by_class) for i in range(max(1, int(lanes)))]
+
+    def _lane(self, key):
+        return self.lanes[int(key or 0) % len(self.lanes)]
+
+    def dispatch(self, fn, update, *args, block=False, timeout=None):
+        """Chạy fn(update, *args) trên lane của user. Returns: True nếu nhận, False nếu class đầy."""
+        key = update_lane_key(update)
+        # Class lúc nhận chỉ dùng để tính ngân sách; thứ tự chạy tính lại lúc chọn việc
+        klass = classify_update(update)
+        return self._lane(key).submit(klass, key, fn, (update,) + args, update=update, block=block, timeout=timeout)
+
+    def submit(self, klass, key, fn, *args, block=False, timeout=None):
+        """Chạy fn(*args) trên lane theo key (vd user_id) - cho job không phải update"""
+        return self._lane(key).submit(klass, int(key or 0), fn, args, block=block, timeout=timeout)
+
+    def drain(self, deadline):
+        """Chờ tới khi hết job hoặc quá deadline. Returns: True nếu sạch."""
+        while time.time() < deadline:
+            if not any(lane.busy() for lane in self.lanes):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def take_pending(self):
+        jobs = sorted((job for lane in self.lanes for job in lane.take_pending()), key=lambda j: j[0])
+        return [(fn, args) for _, fn, args in jobs]
+
+    def snapshot(self):
+        out = {}
+        for klass in PRIORITY_CLASSES:
+            lanes = [lane.snapshot(klass) for lane in self.lanes]
+            out[klass] = {
+                "lanes": len(lanes),
+                "depth": sum(l["depth"] for l in lanes),
+                "in_flight": sum(l["in_flight"] for l in lanes),
+                "completed": sum(l["completed"] for l in lanes),
+                "errors": sum(l["errors"] for l in lanes),
+                "rejected": sum(l["rejected"] for l in lanes),
+                "wait_max_ms": max((l["wait_max_ms"] for l in lanes), default=0.0),
+                "per_lane": lanes,
+            }
+        return out
+
+UPDATE_DISPATCHER = PriorityDispatcher("lane", UPDATE_LANES, PRIORITY_QUEUE_SIZE)
+
+class DispatchBacklog:
+    """
+    Bộ đệm cho vòng đọc stream / poll: class trong lane đầy → giữ update lại, vòng đọc chạy tiếp
+    (payment / purchase không phải chờ sau /checkvoucher).
+    User đã có update trong bộ đệm → update sau của user đó cũng xếp sau để giữ thứ tự.
+    Chỉ chạy trên thread của vòng đọc.
+    persist=True (poll): update vào bộ đệm được lưu runtime_checkpoint (kind "update") → vòng đọc
+    được xác nhận offset qua nó; crash / restart thì resume_checkpoints chạy lại.
+    Lưu không được (PG lỗi) → unsaved_min_update_id() chặn offset, Telegram giữ update.
+    """
+
+    def __init__(self, dispatcher, limit, persist=False):
+        self.dispatcher = dispatcher
+        self.limit = max(1, int(limit))
+        self.persist = persist
+        self._items = deque()  # [key, fn, update, args, saved]
+        self._keys = {}        # key → số update đang chờ
+
+    def __len__(self):
+        return len(self._items)
+
+    def offer(self, fn, update, *args):
+        """Returns: False nếu chính bộ đệm cũng đầy (caller tự chờ + flush)"""
+        key = update_lane_key(update)
+        if not self._keys.get(key) and self.dispatcher.dispatch(fn, update, *args):
+            return True
+        if len(self._items) >= self.limit:
+            return False
+        self._items.append([key, fn, update, args, self._save(fn, update)])
+        self._keys[key] = self._keys.get(key, 0) + 1
+        return True
+
+    def _save(self, fn, update):
+        if not self.persist or fn is not handle_update or PG_POOL is None:
+            return False
+        try:
+            checkpoint_save(
+                f"update:{update.get('update_id')}", "update", extract_update_user_id(update), update, strict=True
+            )
+            return True
+        except Exception as e:
+            dprint(f"backlog checkpoint error: {e}")
+            return False
+
+    def flush(self):
+        blocked = set()
+        keep = deque()
+        for item in self._items:
+            key, fn, update, args, saved = item
+            if key in blocked or not self.dispatcher.dispatch(fn, update, *args):
+                blocked.add(key)
+                if not saved:
+                    item[4] = self._save(fn, update)
+                keep.append(item)
+                continue
+            if saved:
+                # Đã vào lane → shutdown tự checkpoint nếu chưa chạy; xoá bản lưu của bộ đệm
+                try:
+                    checkpoint_take(f"update:{update.get('update_id')}")
+                except Exception as e:
+                    dprint(f"backlog checkpoint take error: {e}")
+            self._keys[key] -= 1
+            if not self._keys[key]:
+                del self._keys[key]
+        self._items = keep
+
+    def unsaved_min_update_id(self):
+        """update_id nhỏ nhất trong bộ đệm chưa lưu checkpoint (None nếu không có)"""
+        ids = [int(item[2].get("update_id") or 0) for item in self._items if not item[4]]
+        return min(ids) if ids else None
+
+    def take_all(self):
+        """Shutdown: lấy hết (fn, update, args) còn trong bộ đệm (vòng đọc đã dừng)"""
+        items = [(fn, update, args) for _, fn, update, args, _ in self._items]
+        self._items = deque()
+        self._keys = {}
+        return items
+
+    def offer_wait(self, fn, update, stop, *args):
+        """offer(), bộ đệm đầy thì chờ + flush tới khi nhận. Returns: False nếu stop được set."""
+        while not self.offer(fn, update, *args):
+            if stop.wait(0.2):
+                return False
+            self.flush()
+        return True
+
+# =========================================================
+# 🌊 REDIS STREAMS INGEST - WEBHOOK CHỈ XADD, CONSUMER RIÊNG XỬ LÝ
+# =========================================================
+# UPDATE_INGEST_MODE:
+#   "thread" (mặc định) → webhook đẩy thẳng vào UPDATE_DISPATCHER trong process web
+#   "stream"            → webhook chỉ XADD vào Redis Stream rồi trả về ngay,
+#                         process consumer (python telegram_bot_pg_redis.py consume) xử lý
+UPDATE_INGEST_MODE = os.getenv("UPDATE_INGEST_MODE", "thread").strip().lower()
+UPDATE_STREAM_KEY = os.getenv("UPDATE_STREAM_KEY", "tg:updates").strip()
+UPDATE_STREAM_DEAD_KEY = os.getenv("UPDATE_STREAM_DEAD_KEY", "tg:updates:dead").strip()
+UPDATE_STREAM_GROUP = os.getenv("UPDATE_STREAM_GROUP", "bot").strip()
+UPDATE_STREAM_MAXLEN = int(os.getenv("UPDATE_STREAM_MAXLEN", "100000"))
+STREAM_READ_COUNT = 50
+STREAM_BLOCK_MS = 5000
+STREAM_CLAIM_IDLE_MS = int(os.getenv("STREAM_CLAIM_IDLE_MS", "60000"))  # pending quá 60s → claim lại
+STREAM_CLAIM_INTERVAL = 15  # giây giữa 2 lần quét pending
+STREAM_MAX_DELIVERIES = int(os.getenv("STREAM_MAX_DELIVERIES", "5"))  # quá 5 lần → dead-letter
+
+STREAM_STOP = threading.Event()
+
+def stream_ingest_enabled():
+    return UPDATE_INGEST_MODE == "stream"
+
+def stream_enqueue_update(update):
+    """XADD raw update vào stream. Returns: True nếu ghi được."""
+    if RDS is None:
+        return False
+    try:
+        RDS.xadd(
+            UPDATE_STREAM_KEY,
+            {"u": json.dumps(update, ensure_ascii=False)},
+            maxlen=UPDATE_STREAM_MAXLEN,
+            approximate=True,
+        )
+        return True
+    except Exception as e:
+        print("[STREAM] xadd error:", e)
+        return False
+
+def _stream_ensure_group():
+    try:
+        RDS.xgroup_create(UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def _stream_dead_letter(entry_id, fields, reason, deliveries=0):
+    """Chuyển entry sang dead-letter stream + ACK để không retry nữa"""
+    try:
+        RDS.xadd(UPDATE_STREAM_DEAD_KEY, {
+            "u": fields.get("u", ""),
+            "src_id": entry_id,
+            "reason": reason,
+            "deliveries": str(deliveries),
+            "ts": now_str(),
+        }, maxlen=UPDATE_STREAM_MAXLEN, approximate=True)
+        RDS.xack(UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP, entry_id)
+        print(f"[STREAM] DEAD-LETTER {entry_id}: {reason} (deliveries={deliveries})")
+    except Exception as e:
+        print(f"[STREAM] dead-letter error {entry_id}: {e}")
+
+def _process_stream_entry(update, entry_id):
+    """
+    Chạy trên lane của user. Chỉ ACK khi handle_update chạy xong không exception.
+    Lỗi trước side effect → nằm lại PEL để retry; lỗi sau side effect → dead-letter ngay
+    (retry chỉ gặp dedup, không làm lại gì).
+    """
+    try:
+        handle_update(update)
+    except Exception as e:
+        if not getattr(e, "update_retryable", True):
+            _stream_dead_letter(entry_id, {"u": json.dumps(update, ensure_ascii=False)}, f"failed_after_side_effect: {e}")
+        raise
+    RDS.xack(UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP, entry_id)
+
+STREAM_BACKLOG = DispatchBacklog(UPDATE_DISPATCHER, DISPATCH_BACKLOG_SIZE)
+
+def _stream_dispatch_entries(entries, deliveries=None):
+    for entry_id, fields in entries:
+        if fields is None:
+            # entry đã bị trim khỏi stream nhưng còn trong PEL
+            RDS.xack(UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP, entry_id)
+            continue
+        n = (deliveries or {}).get(entry_id, 1)
+        if n > STREAM_MAX_DELIVERIES:
+            _stream_dead_letter(entry_id, fields, "max_deliveries", n)
+            continue
+        try:
+            update = json.loads(fields.get("u") or "")
+        except Exception:
+            _stream_dead_letter(entry_id, fields, "invalid_json", n)
+            continue
+        # Class đầy → vào bộ đệm, entry chưa ACK; chỉ chờ khi bộ đệm cũng đầy (tự giảm tốc độ đọc)
+        if not STREAM_BACKLOG.offer_wait(_process_stream_entry, update, STREAM_STOP, entry_id):
+            return  # đang dừng → entry nằm lại PEL, được claim lại sau
+
+def _stream_reclaim_pending(consumer):
+    """Claim lại entry pending quá lâu (consumer chết / exception) để retry"""
+    start_id = "0-0"
+    while not STREAM_STOP.is_set():
+        res = RDS.xautoclaim(
+            UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP, consumer,
+            min_idle_time=STREAM_CLAIM_IDLE_MS, start_id=start_id, count=100,
+        )
+        start_id, entries = res[0], res[1]
+        if entries:
+            deliveries = {}
+            for p in RDS.xpending_range(
+                UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP,
+                min=entries[0][0], max=entries[-1][0], count=len(entries), consumername=consumer,
+            ):
+                deliveries[p["message_id"]] = int(p["times_delivered"])
+            dprint(f"[STREAM] Reclaimed {len(entries)} pending entries")
+            _stream_dispatch_entries(entries, deliveries)
+        if not start_id or start_id == "0-0":
+            return
+
+def run_stream_consumer():
+    """
+    Vòng lặp consumer: XREADGROUP → lane theo user → XACK khi xong.
+    Entry lỗi nằm lại trong PEL, được XAUTOCLAIM retry, quá STREAM_MAX_DELIVERIES → dead-letter.
+    """
+    if RDS is None:
+        print("❌ Stream consumer cần REDIS_URL")
+        return
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    _stream_ensure_group()
+    print(f"🌊 Stream consumer started: {UPDATE_STREAM_KEY} group={UPDATE_STREAM_GROUP} consumer={consumer}")
+
+    last_claim = 0
+    while not STREAM_STOP.is_set():
+        try:
+            if time.time() - last_claim >= STREAM_CLAIM_INTERVAL:
+                last_claim = time.time()
+                _stream_reclaim_pending(consumer)
+
+            STREAM_BACKLOG.flush()
+            resp = RDS.xreadgroup(
+                UPDATE_STREAM_GROUP, consumer, {UPDATE_STREAM_KEY: ">"},
+                count=STREAM_READ_COUNT, block=200 if len(STREAM_BACKLOG) else STREAM_BLOCK_MS,
+            )
+            for _stream, entries in resp or []:
+                _stream_dispatch_entries(entries)
+        except Exception as e:
+            print(f"[STREAM] consumer error: {e}")
+            dprint(traceback.format_exc())
+            time.sleep(1)
 
-        if not cookies:
-            tg_send(chat_id, "❌ Không tìm thấy cookie hợp lệ")
-            return
+    print("🌊 Stream consumer stopped")
 
-        num_cookies = len(cookies)
+# =========================================================
+# 📥 LONG POLLING (getUpdates) - CHẾ ĐỘ NHẬN UPDATE THAY CHO WEBHOOK
+# =========================================================
+# python telegram_bot_pg_redis.py poll
+# - Kéo tối đa 100 update / lần, long timeout 50s → 1 HTTP call cho cả batch
+# - Offset lưu Redis (hoặc file nếu không có Redis) → restart vẫn đọc tiếp backlog
+# - Update đưa vào cùng UPDATE_DISPATCHER như webhook (lane theo user)
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))
+POLL_LIMIT = min(100, int(os.getenv("POLL_LIMIT", "100")))
+POLL_OFFSET_KEY = os.getenv("POLL_OFFSET_KEY", "tg:poll_offset").strip()
+POLL_OFFSET_FILE = os.getenv("POLL_OFFSET_FILE", ".poll_offset").strip()
+POLL_DELETE_WEBHOOK = os.getenv("POLL_DELETE_WEBHOOK", "1").strip() in ("1", "true", "True")
+POLL_ALLOWED_UPDATES = ["message", "callback_query"]
+
+POLL_STOP = threading.Event()
+POLL_BACKLOG = DispatchBacklog(UPDATE_DISPATCHER, DISPATCH_BACKLOG_SIZE, persist=True)
+POLL_STATS = {"batches": 0, "updates": 0, "errors": 0, "offset": 0, "last_batch_size": 0}
+
+def load_poll_offset():
+    if RDS is not None:
+        try:
+            return int(RDS.get(POLL_OFFSET_KEY) or 0)
+        except Exception as e:
+            print("[POLL] load offset redis error:", e)
+    try:
+        with open(POLL_OFFSET_FILE, "r", encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        print("[POLL] load offset file error:", e)
+        return 0
 
-        # ✅ Đọc balance từ PostgreSQL
-        exists, balance, status = get_user_data(user_id)
-        if not exists:
-            tg_send(chat_id, "❌ Không tìm thấy ID")
+def save_poll_offset(offset):
+    if RDS is not None:
+        try:
+            RDS.set(POLL_OFFSET_KEY, int(offset))
             return
+        except Exception as e:
+            print("[POLL] save offset redis error:", e)
+    try:
+        tmp = f"{POLL_OFFSET_FILE}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(str(int(offset)))
+        os.replace(tmp, POLL_OFFSET_FILE)
+    except Exception as e:
+        print("[POLL] save offset file error:", e)
 
-        dprint(f"💰 Balance: {balance:,}đ")
+def run_polling():
+    """
+    Vòng lặp getUpdates → UPDATE_DISPATCHER.
+    getUpdates(offset) xác nhận với Telegram mọi update < offset → Telegram xoá luôn. Vì vậy:
+    - seen: update_id kế tiếp chưa từng nhận (update đã vào lane / bộ đệm đã lưu checkpoint)
+    - offset gửi đi = min(seen, update nhỏ nhất trong bộ đệm CHƯA lưu được checkpoint)
+      → update chưa lưu được vẫn nằm ở Telegram; nhận lại thì bỏ qua (id < seen, đang trong bộ đệm)
+    Update đã lưu checkpoint: crash / restart → resume_checkpoints chạy lại.
+    """
+    session = requests.Session()
 
-        v, err = get_voucher(cmd)
-        if err:
-            tg_send(chat_id, f"❌ {err}")
-            # ✅ KHÔNG track_error - lỗi nghiệp vụ
-            return
+    if POLL_DELETE_WEBHOOK:
+        # getUpdates trả 409 nếu webhook đang bật. Giữ lại update đang chờ để replay.
+        try:
+            session.post(f"{BASE_URL}/deleteWebhook", data={"drop_pending_updates": False}, timeout=15)
+        except Exception as e:
+            print("[POLL] deleteWebhook error:", e)
 
-        price = int(v.get("Giá", 0))
-        total_price = price * num_cookies
+    seen = load_poll_offset()
+    POLL_STATS["offset"] = seen
+    backoff = 1
+    print(f"📥 Long polling started | offset={seen} timeout={POLL_TIMEOUT}s limit={POLL_LIMIT}")
 
-        # ✅ ATOMIC DEDUCT - Trừ tiền TRƯỚC
-        success, new_bal = deduct_balance_atomic(user_id, total_price)
-        
-        if not success:
-            tg_send(
-                chat_id,
-                f"❌ Không đủ số dư\n"
-                f"💰 Cần: {total_price:,}đ\n"
-                f"💼 Số dư hiện tại: {new_bal:,}đ"
+    def _confirm_offset():
+        unsaved = POLL_BACKLOG.unsaved_min_update_id()
+        return seen if unsaved is None else min(seen, unsaved)
+
+    while not POLL_STOP.is_set():
+        try:
+            POLL_BACKLOG.flush()
+            offset = _confirm_offset()
+            r = session.get(
+                f"{BASE_URL}/getUpdates",
+                params={
+                    "offset": offset,
+                    "timeout": 1 if len(POLL_BACKLOG) else POLL_TIMEOUT,
+                    "limit": POLL_LIMIT,
+                    "allowed_updates": json.dumps(POLL_ALLOWED_UPDATES),
+                },
+                timeout=POLL_TIMEOUT + 10,
             )
-            # ✅ KHÔNG track_error - lỗi nghiệp vụ
-            return
+            data = r.json()
+            if not data.get("ok"):
+                raise Exception(f"getUpdates {r.status_code}: {data.get('description')}")
+
+            updates = data.get("result") or []
+            fresh = 0
+            for update in updates:
+                update_id = int(update["update_id"])
+                if update_id < seen:
+                    continue  # đang nằm trong bộ đệm (chưa lưu được) → đã có
+                # Class đầy → bộ đệm; chỉ chờ khi bộ đệm cũng đầy, không bỏ update
+                if not POLL_BACKLOG.offer_wait(handle_update, update, POLL_STOP):
+                    break
+                seen = update_id + 1
+                fresh += 1
+
+            if updates:
+                offset = _confirm_offset()
+                save_poll_offset(offset)
+                POLL_STATS["batches"] += 1
+                POLL_STATS["updates"] += fresh
+                POLL_STATS["last_batch_size"] = fresh
+                POLL_STATS["offset"] = offset
+                dprint(f"[POLL] Dispatched {fresh} updates, offset={offset}")
+            backoff = 1
 
-        # ✅ ĐÃ TRỪ TIỀN - Bây giờ lưu voucher
-        success_count, total_count, failed_details = save_voucher_multi_cookies(cookies, v)
+        except Exception as e:
+            POLL_STATS["errors"] += 1
+            print(f"[POLL] error: {e} (retry in {backoff}s)")
+            POLL_STOP.wait(backoff)
+            backoff = min(backoff * 2, 30)
 
-        if success_count == 0:
-            # ✅ HOÀN TIỀN ATOMIC
-            update_balance_atomic(user_id, total_price)  # ← ATOMIC
-            
-            # UI: Hiển thị balance TRỰC TIẾP từ Sheet
-            real_balance = get_balance_direct(user_id)
-            
-            tg_send(
-                chat_id,
-                f"❌ Không lưu được cookie nào\n"
-                f"💸 Đã hoàn tiền: +{total_price:,}đ\n"
-                f"💰 Số dư hiện tại: <b>{real_balance:,}đ</b>"
+    print("📥 Long polling stopped")
+
+def stream_snapshot():
+    if not stream_ingest_enabled() or RDS is None:
+        return None
+    try:
+        pending = RDS.xpending(UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP)
+        return {
+            "length": RDS.xlen(UPDATE_STREAM_KEY),
+            "pending": int(pending.get("pending") or 0),
+            "dead": RDS.xlen(UPDATE_STREAM_DEAD_KEY),
+        }
+    except Exception as e:
+        return {"error": str(e)}
+
+def collect_metrics():
+    """Gom metrics runtime (dùng cho /metrics và /stats)"""
+    return {
+        "ingest_mode": UPDATE_INGEST_MODE,
+        "dedup": dict(DEDUP_STATS, tracked=len(PROCESSED_UPDATE_KEYS)),
+        "pg_pool": PG_POOL.snapshot() if PG_POOL is not None else None,
+        "pg_read_pool": PG_READ_POOL.snapshot() if PG_READ_POOL is not None else None,
+        "pg_queries": PG_QUERY_STATS.snapshot(),
+        "wallet_cache": dict(WALLET_CACHE_STATS, ttl=WALLET_CACHE_TTL),
+        "cache_bus": dict(CACHE_BUS_STATS),
+        "routes": {
+            "message": MESSAGE_ROUTER.snapshot(),
+            "callback": CALLBACK_ROUTER.snapshot(),
+        },
+        "update_dispatcher": UPDATE_DISPATCHER.snapshot(),
+        "update_stream": stream_snapshot(),
+        "polling": dict(POLL_STATS) if POLL_STATS["batches"] or POLL_STATS["errors"] else None,
+    }
+
+def format_dispatcher_stats(s):
+    """Format snapshot của UpdateDispatcher cho Telegram (tổng + lane đông nhất)"""
+    lines = [
+        f"• Lanes: {s['lanes']} | Queue: {s['depth']} | In-flight: {s['in_flight']}",
+        f"• Done: {s['completed']} | Lỗi: {s['errors']} | Từ chối (503): {s['rejected']}",
+        f"• Wait max: {s['wait_max_ms']} ms",
+    ]
+    busiest = sorted(s["per_lane"], key=lambda l: l["depth"], reverse=True)[:3]
+    for l in busiest:
+        if l["depth"] or l["in_flight"]:
+            lines.append(
+                f"  └ {l['name']}: {l['depth']}/{l['capacity']} | "
+                f"wait p95 {l['wait_p95_ms']} ms"
             )
-            # ✅ KHÔNG track_error - lỗi nghiệp vụ
-            return
+    return "\n".join(lines)
 
-        # ✅ Hoàn tiền ATOMIC cho cookie thất bại
-        actual_price = price * success_count
-        if success_count < num_cookies:
-            refund = price * (num_cookies - success_count)
-            update_balance_atomic(user_id, refund)  # ← ATOMIC
+def format_pg_pool_stats():
+    if PG_POOL is None:
+        return "• Không dùng PG"
+    s = PG_POOL.snapshot()
+    out = (
+        f"• Open: {s['open']}/{s['size']} | Đang dùng: {s['in_use']} | Đang chờ: {s['waiting']}\n"
+        f"• Wait avg/max: {s['wait_avg_ms']}/{s['wait_max_ms']} ms | Timeout: {s['timeouts']} | Lỗi connect: {s['connect_errors']}\n"
+        f"• Reconnect: {s['reconnects']} | Bỏ conn chết/quá tuổi: {s['evicted_dead']}/{s['evicted_age']}"
+    )
+    if PG_READ_POOL is not None:
+        r = PG_READ_POOL.snapshot()
+        out += (
+            f"\n• Replica: {r['open']}/{r['size']} | Đang dùng: {r['in_use']} | "
+            f"Acquire: {r['acquired']} | Timeout: {r['timeouts']}"
+        )
+    return out
 
-        log_row(user_id, username, "VOUCHER", str(actual_price), f"Lưu {cmd} {success_count}/{total_count} thành công")
+def format_query_stats(top=5):
+    """Top câu SQL theo tổng thời gian DB"""
+    rows = PG_QUERY_STATS.snapshot(top)
+    if not rows:
+        return "• Chưa có query"
+    return "\n".join(
+        f"• <code>{r['sql'][:60]}</code>\n"
+        f"  └ {r['count']}x | tổng {r['total_ms']}ms | p50/p95/p99 {r['p50_ms']}/{r['p95_ms']}/{r['p99_ms']}ms"
+        f" | chậm {r['slow']} | lỗi {r['errors']}"
+        for r in rows
+    )
 
-        # ✅ UI: Luôn hiển thị balance TRỰC TIẾP từ Sheet
-        real_balance = get_balance_direct(user_id)
-        
-        if success_count == total_count:
-            msg_text = f"✅ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
-        else:
-            msg_text = f"⚠️ Lưu <b>{success_count}/{total_count}</b> thành công | -{actual_price:,}đ | Còn: <b>{real_balance:,}đ</b>"
+def format_priority_stats(snap):
+    """Format snapshot của PriorityDispatcher: mỗi class 1 khối"""
+    return "\n".join(
+        f"<i>{klass}</i>\n{format_dispatcher_stats(s)}"
+        for klass, s in snap.items()
+    )
 
-        tg_send(chat_id, msg_text, build_main_keyboard(is_active=True))
+# =========================================================
+# 📣 CACHE INVALIDATION BUS - REDIS PUB/SUB GIỮA CÁC WORKER
+# =========================================================
+# Mỗi worker giữ cache RAM riêng (voucher stock, keyboard, broadcast, row Sheet).
+# Sự kiện xoá cache được publish lên 1 channel, thread listener ở mọi worker áp dụng.
+#   catalog : voucher stock + keyboard
+#   user    : 1 user đổi (status / dòng Sheet) → row cache + danh sách broadcast
+#   users   : danh sách user đổi (user mới / ban) → danh sách broadcast
+#   config  : tất cả ở trên
+CACHE_BUS_CHANNEL = os.getenv("CACHE_BUS_CHANNEL", "cache:invalidate")
+CACHE_BUS_STATS = {"published": 0, "received": 0, "applied": 0, "errors": 0}
+CACHE_BUS_THREAD = None
+CACHE_BUS_PID = None
+
+def _bus_origin():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _invalidate_catalog(data):
+    VOUCHER_STOCK_CACHE["rows"] = None
+    VOUCHER_STOCK_CACHE["ts"] = 0
+    VOUCHER_KEYBOARD_CACHE["keyboard"] = None
+    VOUCHER_KEYBOARD_CACHE["info_text"] = None
+    VOUCHER_KEYBOARD_CACHE["last_update"] = 0
+
+def _invalidate_users(data):
+    global BROADCAST_USER_CACHE, BROADCAST_USER_CACHE_TIME
+    BROADCAST_USER_CACHE = None
+    BROADCAST_USER_CACHE_TIME = 0
+
+def _invalidate_user(data):
+    if data.get("user_id"):
+        invalidate_user_row_cache(int(data["user_id"]))
+    _invalidate_users(data)
+
+def _invalidate_config(data):
+    _invalidate_catalog(data)
+    _invalidate_users(data)
+    USER_ROW_CACHE.clear()
+
+CACHE_EVENTS = {
+    "catalog": _invalidate_catalog,
+    "user": _invalidate_user,
+    "users": _invalidate_users,
+    "config": _invalidate_config,
+}
+
+def apply_invalidation(kind, data=None):
+    handler = CACHE_EVENTS.get(kind)
+    if handler is None:
+        dprint(f"⚠️ Cache bus: unknown event {kind}")
         return
+    handler(data or {})
+    CACHE_BUS_STATS["applied"] += 1
 
-    # ===== FALLBACK =====
-    tg_send(
-        chat_id,
-        "❌ <b>Lệnh không hợp lệ</b>\nDùng /start để xem menu.",
-        build_main_keyboard(is_active=True)
+def publish_invalidation(kind, **data):
+    """Xoá cache ngay trên process này + báo mọi worker khác (Redis pub/sub)"""
+    apply_invalidation(kind, data)
+    if RDS is None:
+        return
+    try:
+        RDS.publish(CACHE_BUS_CHANNEL, json.dumps({"kind": kind, "data": data, "origin": _bus_origin()}))
+        CACHE_BUS_STATS["published"] += 1
+    except Exception as e:
+        CACHE_BUS_STATS["errors"] += 1
+        dprint(f"cache bus publish error: {e}")
+
+def _cache_bus_listen():
+    while not SHUTTING_DOWN.is_set():
+        pubsub = None
+        try:
+            pubsub = RDS.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CACHE_BUS_CHANNEL)
+            while not SHUTTING_DOWN.is_set():
+                msg = pubsub.get_message(timeout=1.0)
+                if not msg:
+                    continue
+                CACHE_BUS_STATS["received"] += 1
+                event = json.loads(msg["data"])
+                if event.get("origin") == _bus_origin():
+                    continue  # đã áp dụng lúc publish
+                apply_invalidation(event.get("kind"), event.get("data"))
+        except Exception as e:
+            CACHE_BUS_STATS["errors"] += 1
+            dprint(f"cache bus listener error: {e}")
+            time.sleep(2)
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+def start_cache_bus():
+    """Mỗi process (sau fork) 1 thread listener"""
+    global CACHE_BUS_THREAD, CACHE_BUS_PID
+    if RDS is None:
+        return
+    if CACHE_BUS_PID == os.getpid() and CACHE_BUS_THREAD is not None and CACHE_BUS_THREAD.is_alive():
+        return
+    CACHE_BUS_PID = os.getpid()
+    CACHE_BUS_THREAD = threading.Thread(target=_cache_bus_listen, name="cache-bus", daemon=True)
+    CACHE_BUS_THREAD.start()
+
+def format_cache_bus_stats():
+    st = CACHE_BUS_STATS
+    alive = CACHE_BUS_THREAD is not None and CACHE_BUS_THREAD.is_alive()
+    return (
+        f"• Listener: {'✅' if alive else '❌'} | Channel: {CACHE_BUS_CHANNEL}\n"
+        f"• Publish: {st['published']} | Nhận: {st['received']} | Áp dụng: {st['applied']} | Lỗi: {st['errors']}"
     )
 
 # =========================================================
-# SEPAY WEBHOOK
+# 🛑 GRACEFUL SHUTDOWN + CHECKPOINT
 # =========================================================
-@app.route("/webhook-sepay", methods=["POST", "GET"])
-def webhook_sepay():
-    if request.method == "GET":
-        return "OK", 200
+# Khi redeploy (SIGTERM / gunicorn worker_exit):
+#   1. Ngừng nhận update mới (webhook trả 503, dừng consumer / polling)
+#   2. Chờ lane chạy hết việc đang dở, tối đa SHUTDOWN_GRACE_SECONDS
+#   3. Còn sót → ghi bảng runtime_checkpoint:
+#        update:<id>   update đã nhận nhưng chưa chạy → process mới chạy lại
+#        qr:<session>  QR đang watch → process mới watch tiếp phần thời gian còn lại
+#        flow:<id>     flow đã trừ tiền nhưng chưa xong → process mới hoàn tiền + báo admin
+SHUTDOWN_GRACE_SECONDS = int(os.getenv("SHUTDOWN_GRACE_SECONDS", "20"))
+SHUTTING_DOWN = threading.Event()
+SHUTDOWN_LOCK = threading.Lock()
+SHUTDOWN_DONE = False
+
+# Flow update đang chạy: {token: {"update_id", "user_id", "debited", ...}}
+# Token nằm trong contextvar → đúng cho cả thread lane lẫn task asyncio
+# (asyncio.to_thread copy context → code sync offload vẫn thấy flow của task)
+INFLIGHT_FLOWS = {}
+INFLIGHT_FLOWS_LOCK = threading.Lock()
+_FLOW_TOKEN = contextvars.ContextVar("flow_token", default=None)
+_FLOW_SEQ = itertools.count(1)
+
+def _current_flow():
+    """Flow của context hiện tại (gọi khi đang giữ INFLIGHT_FLOWS_LOCK)"""
+    return INFLIGHT_FLOWS.get(_FLOW_TOKEN.get())
+
+def flow_begin(update):
+    """Gọi trong context sẽ chạy update (thread lane / task async), không offload"""
+    pg_reset_request_writes()
+    token = next(_FLOW_SEQ)
+    _FLOW_TOKEN.set(token)
+    with INFLIGHT_FLOWS_LOCK:
+        INFLIGHT_FLOWS[token] = {
+            "update_id": update.get("update_id"),
+            "user_id": extract_update_user_id(update),
+            "debited": 0,
+            "abandoned": False,
+            "steps": {},
+            "holds": set(),
+            "touched": False,
+            "voucher": False,
+        }
 
-    data = request.get_json(force=True, silent=True) or {}
-    if not data:
-        return "EMPTY", 200
+def flow_end():
+    with INFLIGHT_FLOWS_LOCK:
+        flow = INFLIGHT_FLOWS.pop(_FLOW_TOKEN.get(), None)
+    _FLOW_TOKEN.set(None)
+    # Hold chưa settle (handler lỗi giữa chừng) → nhả ngay, không chờ hết hạn
+    for hold_id in (flow or {}).get("holds", ()):
+        try:
+            hold_settle(hold_id, 0)
+        except Exception as e:
+            dprint(f"release hold {hold_id} error: {e}")
+    # Flow đã bị checkpoint lúc shutdown nhưng vẫn kịp chạy xong → xoá checkpoint
+    if flow and flow["abandoned"]:
+        checkpoint_take(f"flow:{flow['update_id']}")
 
-    tx_id = str(
-        data.get("id")
-        or data.get("transaction_id")
-        or data.get("tx_id")
-        or data.get("referenceCode")
-        or ""
-    ).strip()
+def flow_touch(voucher=False):
+    """
+    Đánh dấu flow đã có side effect không lặp lại an toàn
+    (gửi tin, gọi Shopee / QR API, ghi Sheet, ghi sổ cái) → lỗi sau đó không chạy lại update.
+    voucher=True: đã gọi API lưu voucher → kết quả không biết chắc, resume không tự hoàn tiền.
+    """
+    with INFLIGHT_FLOWS_LOCK:
+        flow = _current_flow()
+        if flow:
+            flow["touched"] = True
+            if voucher:
+                flow["voucher"] = True
+
+def flow_touched():
+    with INFLIGHT_FLOWS_LOCK:
+        flow = _current_flow()
+        return bool(flow and (flow["touched"] or flow["steps"] or flow["holds"] or flow["debited"]))
+
+def flow_note(user_id, debit):
+    """Ghi nhận tiền trừ (+) / hoàn (-) của flow hiện tại"""
+    with INFLIGHT_FLOWS_LOCK:
+        flow = _current_flow()
+        if flow and flow["user_id"] == int(user_id):
+            flow["debited"] += int(debit)
+
+def flow_track_hold(hold_id):
+    with INFLIGHT_FLOWS_LOCK:
+        flow = _current_flow()
+        if flow:
+            flow["holds"].add(int(hold_id))
+
+def flow_untrack_hold(hold_id):
+    with INFLIGHT_FLOWS_LOCK:
+        flow = _current_flow()
+        if flow:
+            flow["holds"].discard(int(hold_id))
+
+def flow_ledger_key(user_id, kind):
+    """
+    Idempotency key cho sổ cái: upd:<update_id>:<kind>:<n> (lần thứ n trong update này).
+    Update chạy lại (retry / resume) đi cùng đường → cùng key → không trừ / hoàn 2 lần.
+    """
+    with INFLIGHT_FLOWS_LOCK:
+        flow = _current_flow()
+        if not flow or flow["user_id"] != int(user_id) or flow["update_id"] is None:
+            return None
+        n = flow["steps"][kind] = flow["steps"].get(kind, 0) + 1
+        return f"upd:{flow['update_id']}:{kind}:{n}"
+
+def checkpoint_save(cid, kind, tele_id, payload, strict=False):
+    pg_exec(
+        """
+        INSERT INTO runtime_checkpoint (id, kind, tele_id, payload)
+        VALUES (%s, %s, %s, %s::jsonb)
+        ON CONFLICT (id) DO UPDATE SET payload=EXCLUDED.payload, created_at=NOW()
+        """,
+        (cid, kind, tele_id, json.dumps(payload, ensure_ascii=False)), strict=strict,
+    )
 
-    try:
-        amount = int(
-            data.get("transferAmount")
-            or data.get("amount")
-            or data.get("amount_in")
-            or 0
-        )
-    except Exception:
-        amount = 0
+def checkpoint_take(cid):
+    """Xoá và trả về 1 checkpoint (None nếu không còn) - mỗi checkpoint chỉ được xử lý 1 lần"""
+    return pg_exec(
+        "DELETE FROM runtime_checkpoint WHERE id=%s RETURNING kind, tele_id, payload",
+        (cid,), fetchone=True
+    )
 
-    desc = " ".join([
-        str(data.get("content") or ""),
-        str(data.get("description") or ""),
-        str(data.get("remark") or ""),
-        str(data.get("note") or "")
-    ]).strip()
+# Job không phải update được phép checkpoint: tên → (class, hàm); args[0] = user_id, args JSON được
+CHECKPOINT_JOBS = {
+    "sepay_after_credit": ("payment", sepay_after_credit),
+}
 
-    if not tx_id or amount <= 0:
-        print("[SEPAY] INVALID DATA:", data)
-        return "INVALID", 200
+def _checkpoint_update(update):
+    checkpoint_save(f"update:{update.get('update_id')}", "update", extract_update_user_id(update), update)
 
-    if is_tx_exists(tx_id):
-        print("[SEPAY] DUPLICATE TX:", tx_id)
-        return "DUPLICATE", 200
+def _checkpoint_pending_updates(deadline):
+    """
+    Job chưa chạy trong lane + bộ đệm poll / stream:
+    - update → checkpoint "update"; job trong CHECKPOINT_JOBS → checkpoint "job"
+    - job stream / bộ đệm stream chưa XACK → nằm lại PEL, consumer sau tự claim
+    - job khác → chạy luôn nếu còn thời gian, không thì ghi log rõ job bị bỏ
+    """
+    count = 0
+    for fn, update, args in POLL_BACKLOG.take_all():
+        if fn is handle_update:
+            _checkpoint_update(update)
+            count += 1
+    stream_left = len(STREAM_BACKLOG.take_all())
+    for fn, args in UPDATE_DISPATCHER.take_pending():
+        if fn is handle_update and args:
+            _checkpoint_update(args[0])
+            count += 1
+        elif fn is _process_stream_entry:
+            stream_left += 1
+        elif fn.__name__ in CHECKPOINT_JOBS and args:
+            payload = {"fn": fn.__name__, "args": list(args)}
+            digest = hashlib.md5(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+            checkpoint_save(f"job:{fn.__name__}:{digest}", "job", args[0], payload)
+            count += 1
+        elif time.time() < deadline:
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"🛑 Shutdown: job {fn.__name__} lỗi khi chạy nốt: {e}")
+        else:
+            print(f"🛑 Shutdown: BỎ job {fn.__name__} args={args!r} (quá hạn, không checkpoint được)")
+    if stream_left:
+        print(f"🛑 Shutdown: {stream_left} entry stream chưa XACK → consumer sau claim lại")
+    return count
 
-    m = re.search(r"(?:SEVQR\s*)?NAP\s*(\d{6,})", desc, re.I)
-    if not m:
-        print("[SEPAY] NO USER FOUND | DESC =", desc)
-        return "NO_USER", 200
+def _checkpoint_qr_sessions():
+    with qr_lock:
+        sessions = [(sid, dict(sess)) for sid, sess in qr_sessions.items() if not sess.get("cancelled")]
+    for sid, sess in sessions:
+        checkpoint_save(f"qr:{sid}", "qr_watch", sess.get("user_id"), {
+            "session_id": sid,
+            "chat_id": sess.get("chat_id"),
+            "username": sess.get("username", ""),
+            "created": sess.get("created"),
+        })
+    return len(sessions)
+
+def _checkpoint_inflight_flows():
+    with INFLIGHT_FLOWS_LOCK:
+        flows = [f for f in INFLIGHT_FLOWS.values() if f["debited"] > 0]
+        for f in flows:
+            f["abandoned"] = True
+    for f in flows:
+        checkpoint_save(f"flow:{f['update_id']}", "flow", f["user_id"], {
+            "update_id": f["update_id"],
+            "debited": f["debited"],
+            "voucher": f["voucher"],
+        })
+    return len(flows)
 
-    user_id = int(m.group(1))
+def shutdown(reason=""):
+    """Dừng nhận việc, chờ việc đang dở, checkpoint phần còn lại. Gọi nhiều lần vẫn an toàn."""
+    global SHUTDOWN_DONE
+    with SHUTDOWN_LOCK:
+        if SHUTDOWN_DONE:
+            return
+        SHUTDOWN_DONE = True
 
-    if amount < MIN_TOPUP_AMOUNT:
-        tg_send(
-            user_id,
-            f"❌ <b>Nạp tối thiểu {MIN_TOPUP_AMOUNT:,}đ</b>"
-        )
-        return "TOO_SMALL", 200
+    print(f"🛑 Shutdown ({reason}) - draining up to {SHUTDOWN_GRACE_SECONDS}s...")
+    SHUTTING_DOWN.set()
+    STREAM_STOP.set()
+    POLL_STOP.set()
 
-    percent, bonus = calc_topup_bonus(amount)
-    total_add = amount + bonus
+    deadline = time.time() + SHUTDOWN_GRACE_SECONDS
+    drained = UPDATE_DISPATCHER.drain(deadline)
 
-    ensure_user_exists(user_id, "")
-    
-    # ✅ ATOMIC UPDATE - An toàn với concurrent webhooks
-    new_balance = update_balance_atomic(user_id, total_add)
+    with qr_lock:
+        watchers = list(QR_WATCHERS)
+    for t in watchers:
+        t.join(max(0.0, deadline - time.time()))
 
-    note = f"+{int(percent * 100)}%={bonus}" if bonus > 0 else ""
+    if PG_POOL is None:
+        print(f"🛑 Shutdown done (drained={drained}, no PG → không checkpoint)")
+        return
 
-    save_topup_to_sheet(
-        user_id=user_id,
-        username="",
-        amount=amount,
-        loai="SEPAY",
-        tx_id=tx_id,
-        note=note
+    try:
+        n_updates = _checkpoint_pending_updates(deadline)
+        n_qr = _checkpoint_qr_sessions()
+        n_flows = _checkpoint_inflight_flows()
+    except PgUnavailable as e:
+        print(f"🛑 Shutdown: checkpoint lỗi (PG unavailable): {e}")
+        return
+    print(f"🛑 Shutdown done | drained={drained} | checkpoint: {n_updates} update, {n_qr} QR, {n_flows} flow")
+
+def _flow_ledger_debit(tele_id, update_id):
+    """
+    Tiền flow còn đang trừ theo sổ cái: upd:<update_id>:* (trừ / hoàn trong flow)
+    + shutdown:<update_id>:refund (lần resume trước đã hoàn) → resume lại không hoàn 2 lần.
+    """
+    r = pg_exec(
+        """
+        SELECT COALESCE(-SUM(amount), 0) FROM wallet_ledger
+        WHERE tele_id=%s AND (idem_key LIKE %s OR idem_key = %s)
+        """,
+        (int(tele_id), f"upd:{int(update_id)}:%", f"shutdown:{int(update_id)}:refund"),
+        fetchone=True, strict=True
     )
+    return int(r[0] or 0)
 
-    log_row(user_id, "", "TOPUP_SEPAY", str(total_add), tx_id)
+def _resume_flow(cid, tele_id, payload):
+    """
+    Flow mua dở khi tắt process:
+    - Sổ cái là nguồn sự thật: chỉ hoàn phần đã trừ mà chưa hoàn (không tin con số trong RAM)
+    - Đã gọi API lưu voucher → không biết voucher có được lưu → KHÔNG tự hoàn, chuyển admin
+    """
+    update_id = payload.get("update_id")
+    debited = int(payload.get("debited") or 0)
+    if update_id is None:
+        # Không có update_id → không có key sổ cái để đối chiếu → admin xử lý tay
+        if ADMIN_ID:
+            tg_send(
+                ADMIN_ID,
+                f"⚠️ Flow dở khi tắt process | user <code>{tele_id}</code> | không có update_id | "
+                f"RAM ghi trừ {debited:,}đ → kiểm tra sổ cái và hoàn tay nếu cần"
+            )
+        return
+    try:
+        outstanding = min(debited, _flow_ledger_debit(tele_id, update_id))
+    except PgUnavailable:
+        checkpoint_save(cid, "flow", tele_id, payload)  # đọc sổ cái lỗi → giữ lại, resume sau
+        raise
+
+    if outstanding <= 0:
+        # Flow đã tự hoàn / lệnh trừ chưa commit → không còn gì để hoàn
+        if ADMIN_ID and debited:
+            tg_send(
+                ADMIN_ID,
+                f"ℹ️ Flow dở khi tắt process | user <code>{tele_id}</code> | update {update_id} | "
+                f"RAM ghi trừ {debited:,}đ nhưng sổ cái không còn khoản trừ → không hoàn"
+            )
+        return
 
-    # ✅ Đọc balance từ PG để hiển thị cho user
-    real_balance = get_balance_direct(user_id)
-    
-    msg = (
-        "💰 <b>NẠP TIỀN THÀNH CÔNG</b>\n"
-        f"➕ Gốc: <b>{amount:,}đ</b>\n"
+    if payload.get("voucher"):
+        tg_send(
+            tele_id,
+            f"⚠️ <b>Giao dịch bị gián đoạn do bảo trì</b>\n"
+            f"⏳ Admin đang kiểm tra voucher đã lưu, tiền sẽ được hoàn nếu chưa lưu được."
+        )
+        if ADMIN_ID:
+            tg_send(
+                ADMIN_ID,
+                f"⚠️ Flow dở khi tắt process | user <code>{tele_id}</code> | update {update_id} | "
+                f"đã trừ {outstanding:,}đ, ĐÃ gọi lưu voucher → chưa hoàn\n"
+                f"Kiểm tra voucher rồi hoàn tay nếu cần (key <code>shutdown:{update_id}:refund</code>)."
+            )
+        return
+
+    try:
+        ok, new_bal = update_balance_atomic(
+            tele_id, outstanding, kind="refund", key=f"shutdown:{update_id}:refund"
+        )
+    except PgUnavailable:
+        ok = False
+    if not ok:
+        checkpoint_save(cid, "flow", tele_id, payload)
+        print(f"⚠️ resume checkpoint {cid}: hoàn tiền lỗi, giữ lại checkpoint")
+        return
+    log_row(tele_id, "", "REFUND_SHUTDOWN", str(outstanding), f"update {update_id}")
+    tg_send(
+        tele_id,
+        f"⚠️ <b>Giao dịch bị gián đoạn do bảo trì</b>\n"
+        f"💸 Đã hoàn tiền: <b>+{outstanding:,}đ</b>\n"
+        f"💼 Số dư: <b>{new_bal:,}đ</b>"
     )
+    if ADMIN_ID:
+        tg_send(
+            ADMIN_ID,
+            f"⚠️ Flow dở khi tắt process | user <code>{tele_id}</code> | "
+            f"update {update_id} | chưa gọi lưu voucher → đã hoàn {outstanding:,}đ"
+        )
 
-    if bonus > 0:
-        msg += f"🎁 Thưởng: <b>{bonus:,}đ</b>\n"
+def resume_checkpoints():
+    """Process mới: chạy lại update, watch tiếp QR, hoàn tiền flow dở, trừ lại capture lỗi"""
+    try:
+        n = hold_reconcile_pending()
+        if n:
+            print(f"🔒 Reconciled {n} hold capture(s)")
+    except Exception as e:
+        print(f"⚠️ hold reconcile lỗi: {e}")
+    rows = pg_exec("SELECT id FROM runtime_checkpoint ORDER BY created_at", fetchall=True) or []
+    for (cid,) in rows:
+        taken = checkpoint_take(cid)
+        if not taken:
+            continue  # worker khác đã nhận
+        kind, tele_id, payload = taken
+        try:
+            if kind == "update":
+                if not UPDATE_DISPATCHER.dispatch(handle_update, payload, block=True, timeout=5):
+                    # Lane đầy → trả checkpoint lại, lần khởi động / resume sau chạy tiếp
+                    checkpoint_save(cid, kind, tele_id, payload)
+                    print(f"⚠️ resume checkpoint {cid}: lane đầy, giữ lại checkpoint")
+
+            elif kind == "qr_watch":
+                created = float(payload.get("created") or 0)
+                if time.time() - created >= QR_TIMEOUT or not payload.get("chat_id"):
+                    continue
+                sid = payload["session_id"]
+                with qr_lock:
+                    qr_sessions[sid] = {
+                        "user_id": tele_id,
+                        "created": created,
+                        "status": "waiting",
+                        "qr_image": "",
+                        "cookie": "",
+                        "cancelled": False,
+                        "chat_id": payload["chat_id"],
+                        "username": payload.get("username", ""),
+                    }
+                start_qr_watcher(sid, payload["chat_id"], tele_id, payload.get("username", ""), started_at=created)
 
-    msg += f"💼 Số dư: <b>{real_balance:,}đ</b>"
+            elif kind == "flow":
+                _resume_flow(cid, tele_id, payload)
 
-    tg_send(user_id, msg)
+            elif kind == "job":
+                klass, fn = CHECKPOINT_JOBS.get(payload.get("fn"), (None, None))
+                if fn is None:
+                    print(f"⚠️ resume checkpoint {cid}: job không rõ {payload.get('fn')}, bỏ qua")
+                    continue
+                if not UPDATE_DISPATCHER.submit(klass, tele_id, fn, *payload.get("args", [])):
+                    checkpoint_save(cid, kind, tele_id, payload)
+                    print(f"⚠️ resume checkpoint {cid}: lane đầy, giữ lại checkpoint")
+        except Exception as e:
+            print(f"⚠️ resume checkpoint {cid} lỗi: {e}")
 
-    return "OK", 200
+    if rows:
+        print(f"✅ Resumed {len(rows)} checkpoint(s)")
+
+def install_signal_handlers():
+    """SIGTERM / SIGINT → shutdown() rồi thoát (cho python ... / consume / poll)"""
+    import signal
+
+    def _handle(signum, frame):
+        shutdown(f"signal {signum}")
+        sys.exit(0)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            signal.signal(sig, _handle)
+        except Exception:
+            pass
 
 # =========================================================
 # TELEGRAM WEBHOOK
@@ -4380,10 +7331,46 @@ def webhook_sepay():
 @app.route("/webhook", methods=["POST"])
 def webhook():
     update = request.get_json(force=True)
-    t = threading.Thread(target=handle_update, args=(update,), daemon=True)
-    t.start()
+
+    # ✅ Stream mode: chỉ ghi vào Redis Stream, consumer xử lý sau
+    if stream_ingest_enabled():
+        if not stream_enqueue_update(update):
+            return "stream unavailable", 503, {"Retry-After": str(WEBHOOK_RETRY_AFTER)}
+        return "ok"
+
+    # ✅ Đang tắt process → 503, Telegram gửi lại cho process mới
+    if SHUTTING_DOWN.is_set():
+        return "shutting down", 503, {"Retry-After": str(WEBHOOK_RETRY_AFTER)}
+
+    # ✅ Lane của user đầy → 503 để Telegram tự gửi lại sau (không tạo thread mới)
+    if not UPDATE_DISPATCHER.dispatch(handle_update, update):
+        dprint(f"⚠️ Update lane full, rejecting update {update.get('update_id')}")
+        return "busy", 503, {"Retry-After": str(WEBHOOK_RETRY_AFTER)}
     return "ok"
 
+@app.errorhandler(PgUnavailable)
+def pg_unavailable(e):
+    """SePay / Tool PC gặp DB bận → 503 để bên gọi retry, không trả kết quả sai"""
+    print(f"⚠️ PG unavailable: {e}")
+    return {"ok": False, "error": "database unavailable"}, 503, {"Retry-After": str(WEBHOOK_RETRY_AFTER)}
+
+# /metrics lộ số liệu nội bộ (pool, queue, dedup...) → bắt buộc xác thực
+# - METRICS_TOKEN có → header "Authorization: Bearer <token>" (Prometheus bearer_token)
+# - Không có → dùng chung X-Tool-Key như /tool/*
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            return {"ok": False, "error": "Unauthorized"}, 401
+    else:
+        ok, err = _tool_auth()
+        if not ok:
+            return err
+    return collect_metrics(), 200
+
 @app.route("/", methods=["GET"])
 def home():
     pg_ok = PG_POOL is not None
@@ -4519,15 +7506,13 @@ def tool_get_wallet():
     except ValueError:
         return {"ok": False, "error": "tele_id must be numeric"}, 400
 
-    row = pg_exec(
-        "SELECT username, balance, status, pass FROM wallet WHERE tele_id=%s",
-        (tele_id,), fetchone=True
-    )
-    if not row:
+    # Tool PC poll liên tục → đọc qua cache Redis
+    uctx = load_user_context(tele_id)
+    if not uctx.exists:
         return {"ok": False, "error": "User not found"}, 404
 
-    username, balance, status, stored_pass = row
-    status_lower = (status or "").strip().lower()
+    username, balance, stored_pass = uctx.username, uctx.balance, uctx.password
+    status_lower = uctx.status.lower()
 
     # Ban check
     if status_lower in ("banned", "banned_qr_spam", "ban_1h"):
@@ -4545,9 +7530,10 @@ def tool_get_wallet():
 @app.route("/tool/deduct", methods=["POST"])
 def tool_deduct():
     """
-    POST /tool/deduct  body: {"tele_id": 123, "pass": "abc", "amount": 5000}
+    POST /tool/deduct  body: {"tele_id": 123, "pass": "abc", "amount": 5000, "request_id": "..."}
     → {"ok": true, "balance": 3000}
-    Atomic: WHERE balance >= amount → không race condition.
+    Atomic: wallet_apply khoá dòng + ghi sổ cái → không race condition.
+    request_id (tuỳ chọn): tool gửi lại cùng request_id → không trừ lần 2.
     """
     auth_ok, auth_err = _tool_auth()
     if not auth_ok:
@@ -4557,6 +7543,7 @@ def tool_deduct():
     tele_id  = str(body.get("tele_id", "")).strip()
     password = str(body.get("pass", "")).strip()
     amount   = body.get("amount", 0)
+    req_id   = str(body.get("request_id", "")).strip()
 
     if not tele_id:
         return {"ok": False, "error": "tele_id required"}, 400
@@ -4571,17 +7558,13 @@ def tool_deduct():
     except (ValueError, TypeError):
         return {"ok": False, "error": "Invalid tele_id or amount"}, 400
 
-    # Read current state
-    row = pg_exec(
-        "SELECT balance, status, pass FROM wallet WHERE tele_id=%s",
-        (tele_id,), fetchone=True
-    )
-    if not row:
+    # Read current state (cache Redis; lệnh trừ bên dưới vẫn kiểm tra số dư trong PG)
+    uctx = load_user_context(tele_id)
+    if not uctx.exists:
         return {"ok": False, "error": "User not found"}, 404
 
-    balance, status, stored_pass = row
-    balance      = int(balance or 0)
-    status_lower = (status or "").strip().lower()
+    balance, stored_pass = uctx.balance, uctx.password
+    status_lower = uctx.status.lower()
 
     # Ban check
     if status_lower in ("banned", "banned_qr_spam", "ban_1h"):
@@ -4595,25 +7578,12 @@ def tool_deduct():
     if balance < amount:
         return {"ok": False, "error": "Insufficient balance", "balance": balance}, 400
 
-    # Atomic deduct — WHERE balance >= amount chống race condition
-    result = pg_exec(
-        "UPDATE wallet SET balance = balance - %s, updated_at = NOW() "
-        "WHERE tele_id=%s AND balance >= %s RETURNING balance",
-        (amount, tele_id, amount), fetchone=True
+    # Atomic deduct — khoá dòng ví chống race condition, mirror Sheet chạy nền
+    ok, new_balance = deduct_balance_atomic(
+        tele_id, amount, kind="tool", key=f"tool:{req_id}" if req_id else None
     )
-    if not result:
-        return {"ok": False, "error": "Deduct failed (concurrent request?)"}, 500
-
-    new_balance = int(result[0])
-
-    # Mirror Sheet (fire-and-forget)
-    if SHEET_READY:
-        try:
-            row_num = get_user_row(tele_id)
-            if row_num:
-                ws_money.update_cell(row_num, 3, str(new_balance))
-        except Exception:
-            pass
+    if not ok:
+        return {"ok": False, "error": "Deduct failed (concurrent request?)", "balance": new_balance}, 500
 
     dprint(f"🛠️ TOOL DEDUCT: tele_id={tele_id} amount={amount} new_balance={new_balance}")
     return {"ok": True, "balance": new_balance}, 200
@@ -4661,10 +7631,22 @@ def tool_log():
         return {"ok": False, "error": str(e)}, 500
 
 
+# `consume` với UPDATE_INGEST_MODE=thread: web tự xử lý update, stream không có ai ghi
+# → thoát ngay, không init (không mở PG / Redis, không nhận checkpoint của web)
+CONSUMER_DISABLED = __name__ == "__main__" and sys.argv[1:2] == ["consume"] and not stream_ingest_enabled()
+
+# Init lúc import (1 process) - đặt cuối file vì init_runtime dùng hàm khai báo phía trên
+if not BOT_DEFER_INIT and not CONSUMER_DISABLED:
+    init_runtime()
+
 # =========================================================
 # LOCAL RUNNER
 # =========================================================
 if __name__ == "__main__":
+    if CONSUMER_DISABLED:
+        print(f"ℹ️ UPDATE_INGEST_MODE={UPDATE_INGEST_MODE} → không cần stream consumer, thoát")
+        sys.exit(0)
+
     print("=" * 60)
     print(" NgânMiu.Store Telegram Bot")
     print(" V7 - PG PRIMARY | Ban→status | Pass Tool PC")
@@ -4673,6 +7655,22 @@ if __name__ == "__main__":
     print("SHEET_READY:", SHEET_READY)
     print("MAX_COOKIES_PER_REQUEST:", MAX_COOKIES_PER_REQUEST)
     print("CACHE ENABLED: ROW_CACHE + BROADCAST_CACHE")
+    print("INGEST MODE:", UPDATE_INGEST_MODE)
     print("=" * 60)
 
+    ensure_runtime()
+    install_signal_handlers()
+
+    # python telegram_bot_pg_redis.py consume → chạy consumer Redis Stream (không mở HTTP)
+    if len(sys.argv) > 1 and sys.argv[1] == "consume":
+        run_stream_consumer()
+        shutdown("consumer stopped")
+        sys.exit(0)
+
+    # python telegram_bot_pg_redis.py poll → nhận update bằng getUpdates thay cho webhook
+    if len(sys.argv) > 1 and sys.argv[1] == "poll":
+        run_polling()
+        shutdown("polling stopped")
+        sys.exit(0)
+
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")), debug=False)